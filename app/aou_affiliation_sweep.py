@@ -0,0 +1,161 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import argparse
+import threading
+import traceback
+
+import kickshaws as ks
+import aoulib
+
+import common
+import aou_session
+import redcap_export
+import datastore as store
+from wf_aou_confirm_affiliation import (AOU_WCM_PAIRED, PMI_ID_FIELD,
+                                        UNKNOWN, pairing_for_org)
+
+'''
+===============================================================================
+
+-----------------------
+  aou_affiliation_sweep
+-----------------------
+
+Resolves WCM affiliation ('aou-wcm-paired') for every participant in bulk,
+so that wf_aou_confirm_affiliation finds the answer in the datastore and
+DETs rarely have to wait on the AoU API.
+
+A sweep:
+
+  1. Pulls all participants from the AoU Data Ops API in one query (the
+     filter comes from "api-params"; "page-size" is sent as _count). If
+     exactly "page-size" participants come back, the result was probably
+     cut off at one page: that's logged as an error, and "page-size"
+     should be raised above the participant count. Participants beyond
+     the first page are then left to the request path.
+  2. For each configured project, exports record_id and the PMI ID field
+     from REDCap and matches participants by PMI ID.
+  3. Maps each participant's organization to yes/no (see
+     wf_aou_confirm_affiliation.pairing_for_org); participants whose
+     organization is unset are left alone, for the request path to retry.
+  4. Writes only the values that differ from what's stored, in bulk
+     (datastore.put_many).
+
+Configured by the optional "aou-affiliation-sweep" map in
+transmitter-config.json. When it's enabled, main calls start_schedule,
+which runs a sweep at startup (if "run-at-startup") and then every
+"interval-minutes" on a daemon thread, so new enrollments are picked up by
+the next sweep.
+
+Usage (from the application folder), to run one sweep by hand:
+
+    python aou_affiliation_sweep.py
+    python aou_affiliation_sweep.py --dry-run
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+sweep_cfg = common.get_app_config().get('aou-affiliation-sweep', {})
+
+def _pmi_key(pmi_id):
+  '''PMI IDs appear with and without the leading 'P'; compare without.'''
+  pmi_id = str(pmi_id).strip()
+  return pmi_id[1:] if pmi_id[:1] in ('P', 'p') else pmi_id
+
+def fetch_pairings():
+  '''Returns a map of PMI ID (without 'P') -> YES / NO for every
+  participant the API query returns with a known organization.'''
+  params = dict(sweep_cfg.get('api-params', {}))
+  params['_count'] = sweep_cfg.get('page-size', 1000)
+  api_data = aoulib.get_records(aou_session.spec(), aou_session.session(),
+                                params)
+  if len(api_data) >= params['_count']:
+    log.error('AoU API returned {} participant(s), a full page (page-size); '
+              'the rest were probably not fetched. Raise page-size in '
+              'aou-affiliation-sweep.'.format(len(api_data)))
+  pairings = {}
+  for api_rcd in api_data:
+    pairing = pairing_for_org(api_rcd.get('organization', ''))
+    if pairing != UNKNOWN and api_rcd.get('participantId'):
+      pairings[_pmi_key(api_rcd['participantId'])] = pairing
+  log.info('AoU API returned {} participant(s); {} with a known '
+           'organization.'.format(len(api_data), len(pairings)))
+  return pairings
+
+def _redcap_spec(redcap_server_tag, pid):
+  study_config = common.get_study_config('aou')
+  handler_tag = redcap_server_tag + str(pid)
+  env_tag = study_config['handler-tag-to-env-tag'][handler_tag]
+  return study_config[env_tag]['redcap-spec']
+
+def sweep_project(redcap_server_tag, pid, pairings, dry_run=False):
+  '''Bring one project's 'aou-wcm-paired' values in line with pairings.
+  Returns counts: records, matched, written.'''
+  records = redcap_export.export_records(_redcap_spec(redcap_server_tag, pid),
+                                         fields=['record_id', PMI_ID_FIELD])
+  stored = store.latest_for_attr(redcap_server_tag, str(pid), AOU_WCM_PAIRED)
+  rows, matched = [], 0
+  for record in records:
+    pmi_id = record.get(PMI_ID_FIELD, '')
+    pairing = pairings.get(_pmi_key(pmi_id)) if pmi_id else None
+    if pairing is None:
+      continue
+    matched += 1
+    record_id = str(record['record_id'])
+    if stored.get(record_id) != pairing:
+      rows.append((redcap_server_tag, str(pid), record_id, AOU_WCM_PAIRED,
+                   pairing))
+  if not dry_run:
+    store.put_many(rows)
+  counts = {'records': len(records), 'matched': matched, 'written': len(rows)}
+  log.info('Affiliation sweep of {}{}{}: {}'.format(
+           redcap_server_tag, pid, ' (dry run)' if dry_run else '', counts))
+  return counts
+
+def sweep(dry_run=False):
+  '''One full sweep of every configured project. Returns a map of
+  handler tag -> counts.'''
+  pairings = fetch_pairings()
+  rslt = {}
+  for redcap_server_tag, pid in sweep_cfg.get('projects', []):
+    rslt[redcap_server_tag + str(pid)] = sweep_project(
+                                           redcap_server_tag, pid, pairings,
+                                           dry_run)
+  return rslt
+
+def _sweep_and_reschedule(interval_seconds):
+  try:
+    sweep()
+  except Exception:
+    log.error('Affiliation sweep failed: ' + traceback.format_exc())
+  t = threading.Timer(interval_seconds, _sweep_and_reschedule,
+                      (interval_seconds,))
+  t.daemon = True
+  t.start()
+
+def start_schedule():
+  '''Start sweeping in the background, if enabled. See main.'''
+  if not sweep_cfg.get('enabled', False):
+    return
+  interval_seconds = sweep_cfg.get('interval-minutes', 360) * 60
+  first = 0 if sweep_cfg.get('run-at-startup', True) else interval_seconds
+  log.info('Scheduling affiliation sweeps every {}s.'.format(interval_seconds))
+  t = threading.Timer(first, _sweep_and_reschedule, (interval_seconds,))
+  t.daemon = True
+  t.start()
+
+def main():
+  parser = argparse.ArgumentParser(
+             description='Prefetch AoU affiliation for all participants.')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='Report what would be written; write nothing.')
+  args = parser.parse_args()
+  for handler_tag, counts in sorted(sweep(args.dry_run).items()):
+    print('{}: {}'.format(handler_tag, counts))
+  store.flush()
+
+if __name__ == '__main__': main()
@@ -10,9 +10,11 @@ import kickshaws as ks
 # local
 import redcap_handler_template
 import redcap_intake_workflow
+import wf_datastore_snapshot
 import wf_aou_confirm_affiliation
 import workflow_aou_events
 import wf_tpl_oncore_enroll
+import workflow_dag
 
 '''
 Handler for REDCap AoU Enrollment Projects.
@@ -24,11 +26,25 @@ log = ks.smart_logger()
 
 study_tag = 'aou'
 
-def compose_handler(redcap_server_tag, project_id):
-  workflow_chain = [redcap_intake_workflow.go,
-                    wf_aou_confirm_affiliation.go,
-                    workflow_aou_events.go
-                    ]
+def compose_handler(redcap_server_tag, project_id, parallel=None):
+  '''parallel: run the chain as a workflow_dag.Dag, so that independent
+  workflows (the REDCap fetch and the datastore snapshot) overlap.
+  Defaults to whether "workflow-dag" is enabled in transmitter-config.json.
+  '''
+  if parallel is None:
+    parallel = workflow_dag.enabled()
+  if parallel:
+    workflow_chain = workflow_dag.Dag([redcap_intake_workflow.STAGE,
+                                       wf_datastore_snapshot.STAGE,
+                                       wf_aou_confirm_affiliation.STAGE,
+                                       workflow_aou_events.STAGE
+                                       ])
+  else:
+    workflow_chain = [redcap_intake_workflow.go,
+                      wf_datastore_snapshot.go,
+                      wf_aou_confirm_affiliation.go,
+                      workflow_aou_events.go
+                      ]
   return redcap_handler_template.compose_handler(
     redcap_server_tag,
     project_id,
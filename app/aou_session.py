@@ -0,0 +1,89 @@
+import time
+import threading
+
+import kickshaws as ks
+import aoulib
+
+import common
+import tracing
+import httpclient
+
+'''
+===============================================================================
+
+-----------------------
+      aou_session
+-----------------------
+
+One authenticated AoU Data Ops API session for the whole process.
+
+aoulib.make_authed_session loads the service account key and does an OAuth
+handshake, so it's too costly to call per lookup. session() makes one on
+first use and hands the same one to every caller until it's older than
+"max-age-seconds" (default 45 minutes -- under the usual one-hour access
+token lifetime), then makes a fresh one. Call invalidate() after an auth
+error to force a new session on the next call.
+
+The session gets httpclient's pooled keep-alive adapters, so concurrent
+lookups share TLS connections instead of reconnecting.
+
+spec() is enclave/aou-api-spec.json, read once.
+
+Settings come from the optional "aou-api-session" map in
+transmitter-config.json.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+SPEC_PATH = 'enclave/aou-api-spec.json'
+
+session_cfg = common.get_app_config().get('aou-api-session', {})
+MAX_AGE_SECONDS = session_cfg.get('max-age-seconds', 2700)
+
+_lock = threading.Lock()
+_spec = None
+_session = None
+_session_made_at = 0
+
+def spec():
+  global _spec
+  with _lock:
+    if _spec is None:
+      _spec = ks.slurp_json(SPEC_PATH)
+    return _spec
+
+def _pooled(sess):
+  '''Share httpclient's connection pooling, if sess is a requests
+  Session (aoulib's is).'''
+  if hasattr(sess, 'mount'):
+    httpclient.mount_pool(sess)
+  return sess
+
+def session():
+  '''The shared authenticated session, made or refreshed as needed.'''
+  global _session, _session_made_at
+  path_to_key = spec()['path-to-key-file']
+  with _lock:
+    if (_session is None
+        or time.time() - _session_made_at >= MAX_AGE_SECONDS):
+      log.info('Making a new AoU API session.')
+      with tracing.span('aou.make_authed_session'):
+        _session = _pooled(aoulib.make_authed_session(path_to_key))
+      _session_made_at = time.time()
+    return _session
+
+def invalidate():
+  '''Drop the shared session; the next session() call makes a new one.'''
+  global _session
+  with _lock:
+    _session = None
+
+def invalidate_if_auth_error(ex):
+  '''Call with an exception from an API call; drops the session if the
+  API rejected our credentials (HTTP 401/403).'''
+  response = getattr(ex, 'response', None)
+  if getattr(response, 'status_code', None) in (401, 403):
+    log.info('AoU API rejected the session; will re-authenticate.')
+    invalidate()
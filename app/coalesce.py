@@ -0,0 +1,82 @@
+from threading import Lock, Thread
+
+'''
+===============================================================================
+
+-----------------------
+        coalesce
+-----------------------
+
+Folds bursts of requests for the same key into as few runs as possible.
+
+REDCap sends a DET on every form save, so one edit session produces a burst
+of DETs for one record. Each run of the workflow chain re-reads the record
+from scratch, so once a run is pending, further DETs for that record add
+nothing: only the newest state needs processing.
+
+For each key, at most one run is in progress and at most one is pending:
+
+  o If nothing is running for the key, the caller runs it now, on its own
+    thread, and gets that run's result.
+  o If a run is in progress, the request becomes the pending one (replacing
+    any pending request, which is then never run) and submit returns None
+    straight away.
+  o When a run finishes and a request is pending, the pending request is
+    run on a new (daemon) thread, and so on until nothing is pending. The
+    caller whose run just finished gets its own result right away; it
+    isn't held for the follow-up runs, whose results are discarded.
+
+Counters: `received` (submits), `runs` (times run was called) and `saved`
+(requests replaced before they ran).
+
+===============================================================================
+'''
+
+class Coalescer(object):
+
+  def __init__(self):
+    self._lock = Lock()
+    self._pending = {} # key -> pending request, or None; present while busy
+    self.received = 0
+    self.runs = 0
+    self.saved = 0
+
+  def submit(self, k, request, run):
+    '''Returns run(request)'s result. Returns None if the request was
+    folded into a run that will be done on another thread.'''
+    with self._lock:
+      self.received += 1
+      if k in self._pending:
+        if self._pending[k] is not None:
+          self.saved += 1
+        self._pending[k] = request
+        return None
+      self._pending[k] = None
+    return self._run(k, request, run)
+
+  def _run(self, k, request, run):
+    with self._lock:
+      self.runs += 1
+    try:
+      return run(request)
+    finally:
+      self._run_pending(k, run)
+
+  def _run_pending(self, k, run):
+    '''Start the key's pending run, if any, on a thread of its own;
+    otherwise the key is no longer busy.'''
+    with self._lock:
+      request = self._pending[k]
+      if request is None:
+        del self._pending[k]
+        return
+      self._pending[k] = None
+    t = Thread(target=self._run, args=(k, request, run))
+    t.daemon = True
+    t.start()
+
+  def stats(self):
+    with self._lock:
+      return {'received': self.received
+             ,'runs': self.runs
+             ,'saved': self.saved}
@@ -6,6 +6,12 @@ import json
 import datetime
 from common import *
 from kickshaws import *
+import copy
+import time
+import threading
+import traceback
+import tracing
+import metrics
 
 def get_app_config():
   try:
@@ -33,6 +39,10 @@ get_study_config=setup__get_study_config()
 def ip_is_allowed(ip, ip_allowed_list):
   return ip in ip_allowed_list
   
+CHAINS = metrics.counter('transmitter_workflow_chains_total',
+                         'Workflow chains run, by outcome (completed, '
+                         'short-circuited, error).', ['outcome'])
+
 def run_workflow_chain(request, chain):
   '''chain should be a collection of workflow functions
   -- actual function objects (not names as strings).
@@ -47,39 +57,90 @@ def run_workflow_chain(request, chain):
   request-shaped map returned by the final workflow
   function; otherwise, returns the 'response' value
   when a short-circuit occurred.
+  Each workflow (and each external call it makes) is timed; the timings
+  end up in the returned map under 'timings' -- see tracing.
   '''
   log.info('Entered.')
   x = request
-  for f in chain:
-    x = f(x)
-    if x.get('done','') == 'yes':
-      log.info('Finished early; exiting workflow chain.')  
-      return x
-  log.info('Workflow chain done. Exiting.')
+  outcome = 'error'
+  try:
+    with tracing.trace(request) as spans:
+      for f in chain:
+        with tracing.span('workflow.' + tracing.workflow_name(f)):
+          x = f(x)
+        if x.get('done','') == 'yes':
+          log.info('Finished early; exiting workflow chain.')  
+          outcome = 'short-circuited'
+          break
+      else:
+        log.info('Workflow chain done. Exiting.')
+        outcome = 'completed'
+  finally:
+    CHAINS.inc((outcome,))
+  x[tracing.TIMINGS_KEY] = spans
   return x
 
-def imux_handlers(handler1, handler2):
-  '''imux (aka inverse multiplex), takes two handlers,
+def _isolated(req):
+  '''A copy of req that a handler can change freely.'''
+  try:
+    return copy.deepcopy(req)
+  except Exception:
+    # Something Metaphor put in the map can't be copied; fall back to
+    # copying the map itself.
+    log.info('Could not deep-copy request; using a shallow copy.')
+    return dict(req)
+
+def imux_handlers(*handlers, **kw):
+  '''imux (aka inverse multiplex), takes any number of handlers,
   and returns a single handler. (Recall that a handler
-  takes a single request and returns a single response.)'''
+  takes a single request and returns a single response.)
+  The handlers run concurrently, each on its own thread and with its
+  own copy of the request. Keyword args:
+    o timeout_seconds: how long to wait for each handler -- one number
+      for all, or a list with one per handler (default 30). A handler
+      that hasn't finished in time counts as a 504 (it's left to finish
+      in the background); one that raises counts as a 500.
+  Returns 200 if every handler returned 200; otherwise, the status of
+  the first (in argument order) handler that didn't.'''
+  timeouts = kw.get('timeout_seconds', 30)
+  if not isinstance(timeouts, (list, tuple)):
+    timeouts = [timeouts] * len(handlers)
   def imuxed_handle(req):
     log.info('in')
-    rslt1 = handler1(req)
-    print str(rslt1)
-    rslt2 = handler2(req)
-    print str(rslt2)
-    # Return 200 if both returned 200; else first non-200
+    rslts = [None] * len(handlers)
+    def run(i, handler, req_copy):
+      try:
+        rslts[i] = handler(req_copy)
+      except Exception:
+        log.error('handler{} raised: {}'.format(i + 1, traceback.format_exc()))
+        rslts[i] = {'status': 500}
+    threads = []
+    for i, handler in enumerate(handlers):
+      t = threading.Thread(target=run, args=(i, handler, _isolated(req)),
+                           name='imux-handler{}'.format(i + 1))
+      t.daemon = True
+      t.start()
+      threads.append(t)
+    start = time.time()
+    final = []
+    for i, t in enumerate(threads):
+      t.join(max(0, timeouts[i] - (time.time() - start)))
+      if t.is_alive():
+        log.info('handler{} timed out after {}s'.format(i + 1, timeouts[i]))
+        final.append({'status': 504})
+      else:
+        final.append(rslts[i])
+      log.info('handler{} result: {}'.format(i + 1, str(final[i])))
+    # Return 200 if all returned 200; else first non-200
     # status is what gets returned.
-    out_status = -1
-    if rslt1.get('status') == 200 and rslt2.get('status') == 200:
-      log.info('both handler1 and handler2 returned 200')
-      out_status = 200
-    elif rslt1.get('status') != 200:
-      log.info('handler1 returned non-200')
-      out_status = rslt1.get('status')
+    out_status = 200
+    for i, rslt in enumerate(final):
+      if rslt.get('status') != 200:
+        log.info('handler{} returned non-200'.format(i + 1))
+        out_status = rslt.get('status')
+        break
     else:
-      log.info('handler2 returned non-200')
-      out_status = rslt2.get('status')
+      log.info('all {} handlers returned 200'.format(len(handlers)))
     log.info('out')
     return {'status': out_status}
   return imuxed_handle
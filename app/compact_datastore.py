@@ -0,0 +1,112 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import argparse
+
+import kickshaws as ks
+import datastore as store
+
+'''
+===============================================================================
+
+-----------------------
+   compact_datastore
+-----------------------
+
+Moves superseded history out of the datastore table and into
+datastore_archive.
+
+A row is superseded when a newer version of the same key exists; the newest
+version of every key is never touched (and datastore_current isn't either).
+Only rows older than the cutoff are moved, so recent history stays in the
+live table. Each batch is copied into the archive and deleted from history
+in one transaction, and the copy ignores rows already archived, so an
+interrupted run can simply be rerun. Nothing is ever dropped: the full
+longitudinal record is the union of datastore and datastore_archive.
+
+MySQL backend only (the SQLite backend has no archive table).
+
+Usage (from the application folder):
+
+    python compact_datastore.py --older-than-days 365
+    python compact_datastore.py --older-than-days 365 --dry-run
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+BATCH_SIZE = 10000
+
+# Rows in [lo, hi) older than the cutoff that have a newer version of the
+# same key. Used for both the copy and the delete so they agree exactly.
+SUPERSEDED = '''from datastore d
+                where d.rid >= %s and d.rid < %s
+                  and d.ts < now() - interval %s day
+                  and exists
+                    (select 1
+                     from datastore n
+                     where n.env = d.env and n.projectid = d.projectid
+                       and n.recordid = d.recordid
+                       and n.attrname = d.attrname
+                       and (n.ts > d.ts or (n.ts = d.ts and n.rid > d.rid))) '''
+
+def rid_range(older_than_days):
+  qy = '''select min(rid) as lo, max(rid) as hi
+          from datastore
+          where ts < now() - interval %s day '''
+  rows = store.backend.query_rows(qy, (older_than_days,))
+  return rows[0]['lo'], rows[0]['hi']
+
+def count_superseded(lo, hi, older_than_days):
+  return store.backend.query_val('select count(*) ' + SUPERSEDED,
+                                 (lo, hi, older_than_days))
+
+def archive_batch(lo, hi, older_than_days):
+  vals = (lo, hi, older_than_days)
+  copy = ('''insert ignore into datastore_archive
+               (rid, ts, env, projectid, recordid, attrname, attrval)
+             select d.rid, d.ts, d.env, d.projectid, d.recordid,
+                    d.attrname, d.attrval ''' + SUPERSEDED)
+  # MySQL won't let a delete's subquery read the table being deleted from,
+  # so delete via a join against what was just archived.
+  delete = '''delete d
+              from datastore d
+              join datastore_archive a on a.rid = d.rid and a.ts = d.ts
+              where d.rid >= %s and d.rid < %s '''
+  store.backend.execute_tx([(copy, vals), (delete, (lo, hi))])
+
+def compact(older_than_days, dry_run=False):
+  '''Returns the number of rows archived (or that would be, if dry_run).'''
+  lo, hi = rid_range(older_than_days)
+  if lo is None:
+    log.info('No history older than {} days.'.format(older_than_days))
+    return 0
+  ttl = 0
+  for start in range(lo, hi + 1, BATCH_SIZE):
+    end = start + BATCH_SIZE
+    n = count_superseded(start, end, older_than_days)
+    if n and not dry_run:
+      archive_batch(start, end, older_than_days)
+    ttl += n
+    log.info('rid [{}, {}): {} superseded row(s){}.'.format(
+             start, end, n, '' if dry_run else ' archived'))
+  return ttl
+
+def main(argv):
+  parser = argparse.ArgumentParser(
+             description='Archive superseded datastore history.')
+  parser.add_argument('--older-than-days', type=int, required=True)
+  parser.add_argument('--dry-run', action='store_true')
+  args = parser.parse_args(argv)
+  if store.backend.name != 'mysql':
+    sys.exit('compact_datastore only supports the mysql db-backend.')
+  ttl = compact(args.older_than_days, args.dry_run)
+  msg = '{} superseded row(s) older than {} days {}.'.format(
+          ttl, args.older_than_days,
+          'found (dry run)' if args.dry_run else 'archived')
+  log.info(msg)
+  print(msg)
+
+if __name__ == '__main__': main(sys.argv[1:])
@@ -1,6 +1,10 @@
-import pymysqlwrapper as db
+import atexit
 from common import *
 from kickshaws import *
+import writebehind
+import ttlcache
+import tracing
+import metrics
 
 '''
 ===============================================================================
@@ -9,72 +13,271 @@ from kickshaws import *
       datastore
 -----------------------
 
-Interface for simple key-value-like storage in MySQL. Also timestamps
+Interface for simple key-value-like storage. Also timestamps
 each entry so that longitudinal versioning can be maintained for
 any particular key.
 
+Every put appends a version to a history table (datastore) and, in the
+same transaction, upserts the key's row in datastore_current. Reads only
+ever touch datastore_current.
+
+The storage engine is pluggable; "db-backend" in transmitter-config.json
+selects one:
+  o "mysql" (default) -- see datastore_mysql, the sql folder, and
+    compact_datastore for archiving old history. Queries run on pooled
+    connections sized by the optional "db-pool" map.
+  o "sqlite" -- see datastore_sqlite; an embedded database file at
+    "sqlite-path", in WAL mode.
+A backend is an object with check_conn(), latest(env, projectid,
+recordid, attrname) -> value or None, record(env, projectid, recordid) ->
+[(attrname, attrval)], attr_values(env, projectid, attrname) ->
+[(recordid, attrval)], and write_rows(rows), where each row is
+(env, projectid, recordid, attrname, attrval).
+
+Nothing connects at import time; call check_conn() at startup to fail
+fast on a connectivity problem.
+
+Writes can optionally be batched (see writebehind) by enabling the
+"db-write-batching" map in transmitter-config.json. Reads in this process
+still see batched writes that haven't reached the database yet. Call
+flush() -- or pass sync=True to put -- when a write must be durable
+before continuing.
+
+Reads can optionally be served from an in-process LRU/TTL cache (see
+ttlcache) by enabling the "db-read-cache" map in transmitter-config.json.
+put keeps cached entries current, and a read that a put overtakes doesn't
+fill the cache with the value it read, so the cache is safe as long as
+this process is the only writer; other writers' changes show up once the
+entries expire. cache_stats() reports hits and misses.
+
 ===============================================================================
 '''
 
-db_table = 'datastore'
-db_spec = get_app_config().get('db-spec')
+def make_backend(cfg):
+  '''Build the backend named by cfg (a transmitter-config map).'''
+  kind = cfg.get('db-backend', 'mysql')
+  if kind == 'mysql':
+    import datastore_mysql
+    return datastore_mysql.MySQLBackend(cfg.get('db-spec'),
+                                        cfg.get('db-pool', {}))
+  if kind == 'sqlite':
+    import datastore_sqlite
+    return datastore_sqlite.SQLiteBackend(cfg.get('sqlite-path',
+                                                  'datastore.sqlite3'))
+  raise ValueError('Unknown db-backend: ' + str(kind))
+
+backend = make_backend(get_app_config())
+
+def check_conn():
+  '''Should throw exception if there's a database connectivity issue.
+  Program should not proceed if so.'''
+  backend.check_conn()
+
+def _write_rows(rows):
+  with tracing.span('db.write_rows'):
+    backend.write_rows(rows)
+
+db_batching_cfg = get_app_config().get('db-write-batching', {})
+
+writer = None
+if db_batching_cfg.get('enabled', False):
+  writer = writebehind.BatchedWriter(
+             _write_rows,
+             max_rows=db_batching_cfg.get('max-rows', 100),
+             max_seconds=db_batching_cfg.get('max-seconds', 0.5),
+             max_pending=db_batching_cfg.get('max-pending', 10000))
+  # Don't lose queued rows on a clean shutdown.
+  atexit.register(writer.flush)
+
+db_cache_cfg = get_app_config().get('db-read-cache', {})
+
+# Keys are (env, projectid, recordid, attrname) for single values, with
+# None meaning "known absent", and (env, projectid, recordid) for record
+# snapshots. All parts are normalized via _norm.
+cache = None
+if db_cache_cfg.get('enabled', False):
+  cache = ttlcache.TTLCache(
+            max_entries=db_cache_cfg.get('max-entries', 10000),
+            ttl_seconds=db_cache_cfg.get('ttl-seconds', 300))
 
-# Should throw exception if there's a database connectivity issue.
-# Program should not proceed if so.
-db.check_conn(db_spec)
+def cache_stats():
+  '''Hit/miss counters for the read cache (None when it's off).'''
+  return cache.stats() if cache is not None else None
+
+def _cache_lookups():
+  stats = cache_stats()
+  if stats is None:
+    return None
+  return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+metrics.counter_func('transmitter_datastore_cache_lookups_total',
+                     'Datastore read cache lookups (when the cache is on).',
+                     _cache_lookups, ['result'])
+metrics.gauge_func('transmitter_datastore_cache_entries',
+                   'Entries in the datastore read cache.',
+                   lambda: (cache_stats() or {}).get('entries'))
+metrics.gauge_func('transmitter_datastore_pending_rows',
+                   'Rows queued for a batched write (when batching is on).',
+                   lambda: (len(writer.pending_rows())
+                            if writer is not None else None))
 
 #------------------------------------------------------------------------------
 
 def key_exists(redcap_env, projectid, recordid, attrname):
-  qy1 = '''select count(*) as ttl
-          from datastore
-          where env = %s and projectid = %s
-            and recordid = %s
-            and attrname = %s	'''
-  vals = redcap_env, projectid, recordid, attrname
-  ttl =	db.go(db_spec, qy1, vals, db.ReturnKind.SINGLEVAL)
-  if ttl > 0: return True
-  else: return False
+  return (get_latest_or_none(redcap_env, projectid, recordid, attrname)
+          is not None)
+
+def get_latest_or_none(redcap_env, projectid, recordid, attrname, snap=None):
+  '''Return the latest value for the key, or None if the key has never
+  been stored. One round trip; use this instead of key_exists followed
+  by get_latest_value. If a snapshot map for this record is passed (see
+  snapshot below), it's read from instead of the database.'''
+  if snap is not None:
+    return snap.get(attrname)
+  k = _norm((redcap_env, projectid, recordid, attrname))
+  if cache is not None:
+    cached = cache.get(k)
+    if cached is not ttlcache.MISSING:
+      return cached
+    since = cache.version()
+  if writer is not None:
+    pending = _pending_latest(redcap_env, projectid, recordid, attrname)
+    if pending is not None:
+      return pending
+  with tracing.span('db.latest'):
+    rslt = backend.latest(redcap_env, projectid, recordid, attrname)
+  if cache is not None:
+    # Skipped if a put landed while we read; rslt may predate it.
+    cache.put_if_unchanged(k, rslt, since)
+  return rslt
 
 def get_latest_value(redcap_env, projectid, recordid, attrname):
   '''Will return empty string if it can't find anything.'''
-  qy2 = '''select ifnull(attrval, 'nil') as attrval
-          from datastore
-          where env = %s and projectid = %s
-            and recordid = %s
-            and attrname = %s
-          order by ts DESC -- put latest value in first row '''
-  vals = redcap_env, projectid, recordid, attrname
-  # Grab the first value in the first row
-  rslt = db.go(db_spec, qy2, vals, db.ReturnKind.SINGLEVAL)
+  rslt = get_latest_or_none(redcap_env, projectid, recordid, attrname)
+  return '' if rslt is None else rslt
+
+def snapshot(redcap_env, projectid, recordid):
+  '''Return a map of attrname -> latest attrval for every key stored
+  for the record, in one round trip. Keys never stored are absent
+  from the map (so .get(k) gives None, matching get_latest_or_none).
+  Workflows receive this via the 'datastore-snapshot' baton key; see
+  wf_datastore_snapshot.'''
+  vals = redcap_env, projectid, recordid
+  if cache is not None:
+    cached = cache.get(_norm(vals))
+    if cached is not ttlcache.MISSING:
+      # Callers update their snapshot in place; hand out a copy.
+      return dict(cached)
+    since = cache.version()
+  snap = {}
+  with tracing.span('db.record'):
+    for attrname, attrval in backend.record(*vals):
+      snap[attrname] = attrval
+  if writer is not None:
+    key = _norm(vals)
+    for row in writer.pending_rows():
+      if _norm(row[:3]) == key:
+        snap[row[3]] = row[4]
+  if cache is not None:
+    cache.put_if_unchanged(_norm(vals), dict(snap), since)
+  return snap
+
+def latest_for_attr(redcap_env, projectid, attrname):
+  '''Return a map of recordid -> latest attrval for one attribute across
+  every record in the project, in one query (e.g., for bulk jobs that
+  compare against the store before writing). Not cached.'''
+  rslt = {}
+  with tracing.span('db.attr_values'):
+    for recordid, attrval in backend.attr_values(redcap_env, projectid,
+                                                 attrname):
+      rslt[recordid] = attrval
+  if writer is not None:
+    key = _norm((redcap_env, projectid))
+    for row in writer.pending_rows():
+      if _norm(row[:2]) == key and row[3] == attrname:
+        rslt[row[2]] = row[4]
   return rslt
 
-def put(redcap_env, projectid, recordid, attrname, attrval):
+def put_many(rows, chunk_size=500):
+  '''Put many (env, projectid, recordid, attrname, attrval) rows, written
+  chunk_size at a time, each chunk in one transaction. Anything batched
+  by earlier puts is flushed first, so ordering is kept. Returns once
+  every row is written.'''
+  flush()
+  rows = list(rows)
+  for i in range(0, len(rows), chunk_size):
+    _write_rows(rows[i:i + chunk_size])
+  if cache is not None:
+    for vals in rows:
+      _cache_put(vals)
+
+def put(redcap_env, projectid, recordid, attrname, attrval, snap=None,
+        sync=False):
   '''Put a new name-value pair into the store. It will create
-  a new version if an older one already exists. Note: returns empty tuple.'''
-  stmt = '''insert into datastore (env, projectid, recordid, attrname, attrval)
-            values (%s, %s, %s, %s, %s) '''
+  a new version if an older one already exists. Note: returns empty tuple.
+  If a snapshot map for this record is passed, it is kept in step.
+  When write batching is on, the row is queued; pass sync=True to
+  flush it (and anything queued before it) before returning.'''
   vals = redcap_env, projectid, recordid, attrname, attrval
-  rslt = db.go(db_spec, stmt, vals, commit=True)
+  rslt = ()
+  if writer is not None:
+    writer.add(vals)
+    if sync:
+      flush()
+  else:
+    _write_rows([vals])
+  if snap is not None:
+    snap[attrname] = attrval
+  if cache is not None:
+    _cache_put(vals)
   return rslt
 
+def _cache_put(vals):
+  '''Bring cached entries in line with a row just written.'''
+  k = _norm(vals[:4])
+  attrname, attrval = k[3], vals[4]
+  cache.put(k, attrval)
+  def with_new_val(snap):
+    updated = dict(snap)
+    updated[attrname] = attrval
+    return updated
+  cache.update_if_present(k[:3], with_new_val)
+
+def flush():
+  '''Write any batched puts now. No-op when batching is off.'''
+  if writer is not None:
+    writer.flush()
+
+def _norm(key_parts):
+  '''Callers pass pids etc. as either int or str; compare as strings.'''
+  return tuple(v if isinstance(v, basestring) else str(v) for v in key_parts)
+
+def _pending_latest(redcap_env, projectid, recordid, attrname):
+  '''Latest batched-but-unflushed value for the key, or None.'''
+  key = _norm((redcap_env, projectid, recordid, attrname))
+  for row in reversed(writer.pending_rows()):
+    if _norm(row[:4]) == key:
+      return row[4]
+  return None
+
 #------------------------------------------------------------------------------
 # flag functions
 # A flag is a key with a value of either 'yes' or 'no' indicating set/unset.
 # (Absence is equivalent to 'no' or unset.)
+# Each takes an optional snapshot map (see snapshot above) for the record;
+# when given, reads come from it and writes update it.
 
-def flag_is_set(redcap_env, project_id, record_id, key):
+def flag_is_set(redcap_env, project_id, record_id, key, snap=None):
   '''Convenience predicate function that checks whether
   the value corresponding to the passed-in args is 'yes'.
   '''
-  return (get_latest_value(redcap_env, project_id, record_id, key)
+  return (get_latest_or_none(redcap_env, project_id, record_id, key, snap)
           == 'yes')
 
-def set_flag_if_unset(redcap_env, project_id, record_id, key):
-  if not flag_is_set(redcap_env, project_id, record_id, key):
-    return put(redcap_env, project_id, record_id, key, 'yes')
-
-def unset_flag_if_set(redcap_env, project_id, record_id, key):
-  if flag_is_set(redcap_env, project_id, record_id, key):
-    return put(redcap_env, project_id, record_id, key, 'no')
+def set_flag_if_unset(redcap_env, project_id, record_id, key, snap=None):
+  if not flag_is_set(redcap_env, project_id, record_id, key, snap):
+    return put(redcap_env, project_id, record_id, key, 'yes', snap)
 
+def unset_flag_if_set(redcap_env, project_id, record_id, key, snap=None):
+  if flag_is_set(redcap_env, project_id, record_id, key, snap):
+    return put(redcap_env, project_id, record_id, key, 'no', snap)
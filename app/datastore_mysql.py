@@ -0,0 +1,116 @@
+import dbpool
+
+'''
+===============================================================================
+
+-----------------------
+    datastore_mysql
+-----------------------
+
+MySQL backend for datastore. Tables are created with the scripts in the sql
+folder: datastore (append-only history), datastore_current (latest value per
+key; what reads use) and datastore_archive (see compact_datastore).
+
+Queries run on connections borrowed from a bounded pool (see dbpool).
+
+===============================================================================
+'''
+
+INSERT_ROW = '(%s, %s, %s, %s, %s)'
+
+class MySQLBackend(object):
+
+  name = 'mysql'
+
+  def __init__(self, db_spec, pool_cfg=None):
+    pool_cfg = pool_cfg or {}
+    self.pool = dbpool.ConnectionPool(
+                  db_spec,
+                  size=pool_cfg.get('size', 8),
+                  recycle_seconds=pool_cfg.get('recycle-seconds', 3600),
+                  idle_check_seconds=pool_cfg.get('idle-check-seconds', 30),
+                  checkout_timeout=pool_cfg.get('checkout-timeout-seconds',
+                                                30))
+
+  #----------------------------------------------------------------------------
+  # raw access (also used by compact_datastore)
+
+  def query_rows(self, qy, vals):
+    '''Run a select and return all rows as dicts.'''
+    with self.pool.connection() as conn:
+      with conn.cursor() as cur:
+        cur.execute(qy, vals)
+        return cur.fetchall()
+
+  def query_val(self, qy, vals):
+    '''Run a select and return the first column of the first row
+    (None if there are no rows).'''
+    with self.pool.connection() as conn:
+      with conn.cursor() as cur:
+        cur.execute(qy, vals)
+        row = cur.fetchone()
+    return None if row is None else row.values()[0]
+
+  def execute_tx(self, stmts):
+    '''Run several (stmt, vals) pairs in one transaction and commit.'''
+    with self.pool.connection() as conn:
+      conn.begin()
+      with conn.cursor() as cur:
+        for stmt, vals in stmts:
+          cur.execute(stmt, vals)
+      conn.commit()
+
+  #----------------------------------------------------------------------------
+  # backend interface (see datastore)
+
+  def check_conn(self):
+    self.query_val('select 1', ())
+
+  def latest(self, redcap_env, projectid, recordid, attrname):
+    # Primary-key lookup; no row means the key was never stored.
+    qy = '''select attrval
+            from datastore_current
+            where env = %s and projectid = %s
+              and recordid = %s
+              and attrname = %s '''
+    return self.query_val(qy, (redcap_env, projectid, recordid, attrname))
+
+  def record(self, redcap_env, projectid, recordid):
+    # Range scan on the (env, projectid, recordid) primary-key prefix.
+    qy = '''select attrname, attrval
+            from datastore_current
+            where env = %s and projectid = %s
+              and recordid = %s '''
+    rows = self.query_rows(qy, (redcap_env, projectid, recordid))
+    return [(row['attrname'], row['attrval']) for row in rows]
+
+  def attr_values(self, redcap_env, projectid, attrname):
+    # Primary-key prefix scan over the project's keys.
+    qy = '''select recordid, attrval
+            from datastore_current
+            where env = %s and projectid = %s
+              and attrname = %s '''
+    rows = self.query_rows(qy, (redcap_env, projectid, attrname))
+    return [(row['recordid'], row['attrval']) for row in rows]
+
+  def write_rows(self, rows):
+    '''Append rows (env, projectid, recordid, attrname, attrval) to history
+    and bring datastore_current in line, atomically. Rows are applied in
+    order, so if a key appears more than once the last value wins.'''
+    tmpl = ', '.join([INSERT_ROW] * len(rows))
+    vals = [v for row in rows for v in row]
+    history = ('''insert into datastore
+                   (env, projectid, recordid, attrname, attrval)
+                 values ''' + tmpl)
+    current = ('''insert into datastore_current
+                   (env, projectid, recordid, attrname, attrval)
+                 values ''' + tmpl + '''
+                 on duplicate key update attrval = values(attrval),
+                                         ts = current_timestamp ''')
+    self.execute_tx([(history, vals), (current, vals)])
+
+  def delete_env(self, redcap_env):
+    '''Remove every row for an env tag (used by benchmarks).'''
+    self.execute_tx([('delete from datastore where env = %s', (redcap_env,))
+                    ,('delete from datastore_current where env = %s'
+                     ,(redcap_env,))])
@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+
+'''
+===============================================================================
+
+-----------------------
+   datastore_sqlite
+-----------------------
+
+Embedded SQLite backend for datastore, for single-node deployments and for
+running without a MySQL server. Same two-table layout as the MySQL backend:
+datastore (append-only history) and datastore_current (latest value per
+key; what reads use), created automatically in the database file.
+
+The database runs in WAL mode, so readers don't block the writer. WAL
+mode and the schema are set up once per backend, on first use; WAL mode is
+kept in the file itself, so later connections get it without asking. Each
+thread gets its own connection (sqlite3 connections can't be shared across
+threads), which only sets its per-connection options; writes take the
+database write lock up front (BEGIN IMMEDIATE) and wait up to
+busy_timeout_ms for it.
+
+===============================================================================
+'''
+
+SCHEMA = [
+  '''create table if not exists datastore (
+       rid       integer primary key autoincrement
+     , ts        timestamp default current_timestamp not null
+     , env       text not null
+     , projectid text not null
+     , recordid  text not null
+     , attrname  text not null
+     , attrval   text not null)'''
+ ,'''create index if not exists datastore_latest_idx
+       on datastore (env, projectid, recordid, attrname, ts)'''
+ ,'''create table if not exists datastore_current (
+       env       text not null
+     , projectid text not null
+     , recordid  text not null
+     , attrname  text not null
+     , attrval   text not null
+     , ts        timestamp default current_timestamp not null
+     , primary key (env, projectid, recordid, attrname))'''
+]
+
+class SQLiteBackend(object):
+
+  name = 'sqlite'
+
+  def __init__(self, path, busy_timeout_ms=5000):
+    self.path = path
+    self.busy_timeout_ms = busy_timeout_ms
+    self._local = threading.local()
+    self._set_up = False
+    self._setup_lock = threading.Lock()
+
+  def _connect(self):
+    # isolation_level=None: we issue BEGIN/COMMIT ourselves. timeout sets
+    # the connection's busy timeout.
+    conn = sqlite3.connect(self.path, isolation_level=None,
+                           timeout=self.busy_timeout_ms / 1000.0)
+    conn.execute('pragma synchronous=normal')
+    return conn
+
+  def _set_up_db(self, conn):
+    '''WAL mode and the schema, once per backend.'''
+    with self._setup_lock:
+      if self._set_up:
+        return
+      conn.execute('pragma journal_mode=wal')
+      for stmt in SCHEMA:
+        conn.execute(stmt)
+      self._set_up = True
+
+  def _conn(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = self._connect()
+      if not self._set_up:
+        self._set_up_db(conn)
+      self._local.conn = conn
+    return conn
+
+  #----------------------------------------------------------------------------
+  # backend interface (see datastore)
+
+  def check_conn(self):
+    self._conn().execute('select 1').fetchone()
+
+  def latest(self, redcap_env, projectid, recordid, attrname):
+    qy = '''select attrval
+            from datastore_current
+            where env = ? and projectid = ?
+              and recordid = ?
+              and attrname = ? '''
+    row = self._conn().execute(
+            qy, (redcap_env, projectid, recordid, attrname)).fetchone()
+    return None if row is None else row[0]
+
+  def record(self, redcap_env, projectid, recordid):
+    qy = '''select attrname, attrval
+            from datastore_current
+            where env = ? and projectid = ?
+              and recordid = ? '''
+    return self._conn().execute(
+             qy, (redcap_env, projectid, recordid)).fetchall()
+
+  def attr_values(self, redcap_env, projectid, attrname):
+    qy = '''select recordid, attrval
+            from datastore_current
+            where env = ? and projectid = ?
+              and attrname = ? '''
+    return self._conn().execute(
+             qy, (redcap_env, projectid, attrname)).fetchall()
+
+  def write_rows(self, rows):
+    '''Append rows (env, projectid, recordid, attrname, attrval) to history
+    and bring datastore_current in line, atomically. Rows are applied in
+    order, so if a key appears more than once the last value wins.'''
+    conn = self._conn()
+    conn.execute('begin immediate')
+    try:
+      conn.executemany('''insert into datastore
+                            (env, projectid, recordid, attrname, attrval)
+                          values (?, ?, ?, ?, ?)''', rows)
+      conn.executemany('''insert or replace into datastore_current
+                            (env, projectid, recordid, attrname, attrval)
+                          values (?, ?, ?, ?, ?)''', rows)
+      conn.execute('commit')
+    except Exception:
+      conn.execute('rollback')
+      raise
+
+  def delete_env(self, redcap_env):
+    '''Remove every row for an env tag (used by benchmarks).'''
+    conn = self._conn()
+    conn.execute('begin immediate')
+    conn.execute('delete from datastore where env = ?', (redcap_env,))
+    conn.execute('delete from datastore_current where env = ?', (redcap_env,))
+    conn.execute('commit')
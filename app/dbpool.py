@@ -0,0 +1,132 @@
+import time
+import Queue
+from contextlib import contextmanager
+from threading import Lock
+
+import pymysql
+import pymysql.cursors
+import kickshaws as ks
+
+'''
+===============================================================================
+
+-----------------------
+        dbpool
+-----------------------
+
+A small, thread-safe, bounded pool of MySQL connections. Metaphor handles
+each request on its own thread; rather than have every datastore query open
+and tear down a connection, threads borrow one from here and hand it back.
+
+  o At most `size` connections exist at once. A thread that asks for a
+    connection while all are in use waits (up to `checkout_timeout`
+    seconds, then raises PoolExhausted).
+  o Connections are opened lazily, on first use of each slot.
+  o A connection that has sat idle longer than `idle_check_seconds` is
+    pinged before being handed out; if the ping fails it's replaced.
+  o A connection older than `recycle_seconds` is closed and replaced, which
+    keeps us clear of MySQL's wait_timeout and spreads reconnects out.
+  o If the borrower raises, the connection is rolled back and discarded
+    rather than returned, since its state is unknown.
+  o Connections are in autocommit mode, so each read sees the latest
+    committed data. (Otherwise, under InnoDB's REPEATABLE READ, a reused
+    connection would keep reading the snapshot from its first query.)
+    Borrowers that need a transaction call conn.begin() and commit.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+class PoolExhausted(Exception):
+  pass
+
+class ConnectionPool(object):
+
+  def __init__(self, db_spec, size=8, recycle_seconds=3600,
+               idle_check_seconds=30, checkout_timeout=30):
+    self.db_spec = dict(db_spec)
+    self.size = size
+    self.recycle_seconds = recycle_seconds
+    self.idle_check_seconds = idle_check_seconds
+    self.checkout_timeout = checkout_timeout
+    # Each slot is None (not yet opened) or (conn, opened_at, last_used).
+    self._slots = Queue.LifoQueue(maxsize=size)
+    for _ in range(size):
+      self._slots.put(None)
+    self._closed_lock = Lock()
+
+  def _open(self):
+    conn = pymysql.connect(cursorclass=pymysql.cursors.DictCursor,
+                           **dict(self.db_spec, autocommit=True))
+    now = time.time()
+    return (conn, now, now)
+
+  @staticmethod
+  def _discard(conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+
+  def _checkout(self):
+    try:
+      slot = self._slots.get(timeout=self.checkout_timeout)
+    except Queue.Empty:
+      raise PoolExhausted('No database connection free after {}s'\
+                          ''.format(self.checkout_timeout))
+    try:
+      if slot is None:
+        return self._open()
+      conn, opened_at, last_used = slot
+      now = time.time()
+      if now - opened_at > self.recycle_seconds:
+        log.info('Recycling database connection.')
+        self._discard(conn)
+        return self._open()
+      if now - last_used > self.idle_check_seconds:
+        try:
+          conn.ping(reconnect=False)
+        except Exception:
+          log.info('Idle database connection failed health check; '
+                   'replacing.')
+          self._discard(conn)
+          return self._open()
+      return slot
+    except Exception:
+      # Couldn't produce a connection; give the slot back empty so the
+      # pool doesn't shrink.
+      self._slots.put(None)
+      raise
+
+  @contextmanager
+  def connection(self):
+    '''Borrow a connection for the duration of a with block.'''
+    conn, opened_at, _ = self._checkout()
+    try:
+      yield conn
+    except Exception:
+      try:
+        conn.rollback()
+      except Exception:
+        pass
+      self._discard(conn)
+      self._slots.put(None)
+      raise
+    else:
+      self._slots.put((conn, opened_at, time.time()))
+
+  def close_all(self):
+    '''Close idle connections. Connections currently borrowed are
+    unaffected.'''
+    with self._closed_lock:
+      slots = []
+      while True:
+        try:
+          slots.append(self._slots.get_nowait())
+        except Queue.Empty:
+          break
+      for slot in slots:
+        if slot is not None:
+          self._discard(slot[0])
+        self._slots.put(None)
@@ -0,0 +1,84 @@
+from collections import namedtuple
+from functools import partial
+
+import kickshaws as ks
+import redcaplib
+
+import common
+
+'''
+===============================================================================
+
+-----------------------
+          det
+-----------------------
+
+Parses a REDCap Data Entry Trigger (DET) payload once per request.
+
+from_request(request) decodes request['data'] the first time it's called and
+stores the result in the request under 'det' (a DetPayload, or None if the
+request carried no payload); later calls -- from the handler, then from each
+workflow -- just read it back. For compatibility, the raw map from
+redcaplib.parse_det_payload is also stored under 'det-payload'.
+
+preprocess(routes, allowed_ips) wraps every handler in a route table so the
+payload is decoded up front, and so a malformed payload gets a 400 before
+any handler runs. Only requests from allowed_ips are decoded there; others
+go to the handler untouched, so an unknown client never reaches the parser
+(redcap_handler_template checks the client IP before decoding, and turns
+them away with a 403). See main.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+DET_KEY = 'det'
+RAW_KEY = 'det-payload'
+
+# project_id and record are always strings; raw is the full parsed map
+# (form-status fields, redcap_url, etc.).
+DetPayload = namedtuple('DetPayload', ['project_id', 'record', 'instrument',
+                                       'raw'])
+
+class MalformedDet(ValueError):
+  pass
+
+def parse(data):
+  '''Decode a raw DET body. Returns None if it's empty.'''
+  if not data:
+    return None
+  raw = redcaplib.parse_det_payload(data)
+  if len(raw) == 0:
+    return None
+  if 'project_id' not in raw or 'record' not in raw:
+    raise MalformedDet('DET payload lacks project_id or record: '
+                       + str(raw))
+  return DetPayload(str(raw['project_id']), str(raw['record']),
+                    raw.get('instrument'), raw)
+
+def from_request(request):
+  '''The request's DetPayload (or None), parsing it only if no earlier
+  step has.'''
+  if DET_KEY not in request:
+    payload = parse(request.get('data', ''))
+    request[DET_KEY] = payload
+    request[RAW_KEY] = payload.raw if payload is not None else {}
+  return request[DET_KEY]
+
+def _preprocessed(handler, allowed_ips, request):
+  if not common.ip_is_allowed(request.get('client_ip'), allowed_ips):
+    return handler(request)
+  try:
+    from_request(request)
+  except MalformedDet, e:
+    log.info('Rejecting request; ' + str(e))
+    return {'status': 400}
+  return handler(request)
+
+def preprocess(routes, allowed_ips):
+  '''Return a copy of a route table (path -> handler) with each handler
+  wrapped so the DET payload of a request from allowed_ips is parsed once,
+  before the handler runs.'''
+  return dict((path, partial(_preprocessed, handler, allowed_ips))
+              for path, handler in routes.items())
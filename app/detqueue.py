@@ -0,0 +1,262 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+
+import kickshaws as ks
+
+'''
+===============================================================================
+
+-----------------------
+       detqueue
+-----------------------
+
+A durable local work queue for REDCap DETs, kept in a SQLite file so that
+accepted DETs survive a restart.
+
+In queued mode, a handler validates the incoming request, enqueues it, and
+returns 202 straight away; worker threads (see start_workers) drain the
+queue and run the workflow chain. Guarantees:
+
+  o Per-record ordering: an item is only handed out if no earlier item for
+    the same record key is still waiting or running. Different records are
+    worked on in parallel.
+  o Retries: a failed item goes back to waiting with exponential backoff,
+    up to max_attempts; after that it's marked 'failed' and kept for
+    inspection (and no longer holds up later items for its record).
+  o Deferral: process can raise Defer(seconds) to put an item back to
+    waiting for a while without using up an attempt -- e.g. when a
+    service it needs is down (see resilience).
+  o Crash recovery: items left 'running' by a previous process are put
+    back to waiting when the queue is opened.
+  o Coalescing (optional): when an item is claimed, any later items for the
+    same record key that are also waiting are folded into it -- deleted,
+    with the claimed item carrying the newest request -- since one run of
+    the chain covers them all. `coalesced` counts items folded this way.
+
+Completed items are deleted.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+READY = 'ready'
+RUNNING = 'running'
+FAILED = 'failed'
+
+class Defer(Exception):
+  '''Raised by a worker's process function to retry an item later
+  without counting the attempt.'''
+
+  def __init__(self, seconds, reason=''):
+    Exception.__init__(self, reason)
+    self.seconds = seconds
+
+SCHEMA = [
+  '''create table if not exists det_queue (
+       qid             integer primary key autoincrement
+     , handler_tag     text not null
+     , record_key      text not null
+     , request_json    text not null
+     , status          text not null
+     , attempts        integer not null default 0
+     , next_attempt_at real not null
+     , enqueued_at     real not null
+     , last_error      text)'''
+ ,'''create index if not exists det_queue_key_idx
+       on det_queue (record_key, status, qid)'''
+ ,'''create index if not exists det_queue_status_idx
+       on det_queue (status, next_attempt_at, qid)'''
+]
+
+class DetQueue(object):
+
+  def __init__(self, path, max_attempts=5, retry_base_seconds=30,
+               retry_max_seconds=3600, coalesce=False):
+    self.path = path
+    self.coalesce = coalesce
+    self.coalesced = 0
+    self._count_lock = threading.Lock()
+    self.max_attempts = max_attempts
+    self.retry_base_seconds = retry_base_seconds
+    self.retry_max_seconds = retry_max_seconds
+    self._local = threading.local()
+    conn = self._conn()
+    conn.execute('begin immediate')
+    conn.execute('update det_queue set status = ? where status = ?',
+                 (READY, RUNNING))
+    conn.execute('commit')
+
+  def _conn(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+      conn.row_factory = sqlite3.Row
+      conn.execute('pragma journal_mode=wal')
+      for stmt in SCHEMA:
+        conn.execute(stmt)
+      self._local.conn = conn
+    return conn
+
+  def enqueue(self, handler_tag, record_key, request):
+    '''Durably store a request (a JSON-serializable map). Returns its id.'''
+    now = time.time()
+    conn = self._conn()
+    cur = conn.execute('''insert into det_queue
+                            (handler_tag, record_key, request_json, status,
+                             next_attempt_at, enqueued_at)
+                          values (?, ?, ?, ?, ?, ?)''',
+                       (handler_tag, record_key, json.dumps(request),
+                        READY, now, now))
+    return cur.lastrowid
+
+  def claim(self):
+    '''Mark the next eligible item as running and return it as a map
+    (qid, handler-tag, record-key, request, attempts), or None if nothing
+    is eligible right now.'''
+    conn = self._conn()
+    conn.execute('begin immediate')
+    try:
+      row = conn.execute(
+        '''select q.qid, q.handler_tag, q.record_key, q.request_json,
+                  q.attempts
+           from det_queue q
+           where q.status = ? and q.next_attempt_at <= ?
+             and not exists
+               (select 1 from det_queue o
+                where o.record_key = q.record_key
+                  and ((o.status = ? and o.qid < q.qid)
+                       or o.status = ?))
+           order by q.qid
+           limit 1''', (READY, time.time(), READY, RUNNING)).fetchone()
+      folded = 0
+      request_json = None
+      if row is not None:
+        request_json = row['request_json']
+        if self.coalesce:
+          later = conn.execute('''select qid, request_json
+                                  from det_queue
+                                  where record_key = ? and status = ?
+                                    and qid > ?
+                                  order by qid''',
+                               (row['record_key'], READY, row['qid'])
+                              ).fetchall()
+          if later:
+            folded = len(later)
+            request_json = later[-1]['request_json']
+            conn.executemany('delete from det_queue where qid = ?',
+                             [(r['qid'],) for r in later])
+        conn.execute('''update det_queue
+                        set status = ?, attempts = attempts + 1,
+                            request_json = ?
+                        where qid = ?''',
+                     (RUNNING, request_json, row['qid']))
+      conn.execute('commit')
+    except Exception:
+      conn.execute('rollback')
+      raise
+    if row is None:
+      return None
+    if folded:
+      with self._count_lock:
+        self.coalesced += folded
+      log.info('Coalesced {} later DET(s) for record key [{}] into {}.'\
+               ''.format(folded, row['record_key'], row['qid']))
+    return {'qid': row['qid']
+           ,'handler-tag': row['handler_tag']
+           ,'record-key': row['record_key']
+           ,'request': json.loads(request_json)
+           ,'attempts': row['attempts'] + 1
+           ,'coalesced': folded}
+
+  def complete(self, qid):
+    self._conn().execute('delete from det_queue where qid = ?', (qid,))
+
+  def fail(self, qid, error):
+    '''Schedule a retry with backoff, or give up after max_attempts.
+    Returns True if the item will be retried.'''
+    conn = self._conn()
+    attempts = conn.execute('select attempts from det_queue where qid = ?',
+                            (qid,)).fetchone()['attempts']
+    if attempts >= self.max_attempts:
+      conn.execute('''update det_queue set status = ?, last_error = ?
+                      where qid = ?''', (FAILED, error, qid))
+      return False
+    delay = min(self.retry_base_seconds * 2 ** (attempts - 1),
+                self.retry_max_seconds)
+    conn.execute('''update det_queue
+                    set status = ?, next_attempt_at = ?, last_error = ?
+                    where qid = ?''', (READY, time.time() + delay, error, qid))
+    return True
+
+  def defer(self, qid, seconds, reason):
+    '''Put a running item back to waiting for seconds, and don't count
+    the attempt that was just made.'''
+    self._conn().execute('''update det_queue
+                            set status = ?, next_attempt_at = ?,
+                                attempts = attempts - 1, last_error = ?
+                            where qid = ?''',
+                         (READY, time.time() + seconds, reason, qid))
+
+  def waiting(self, handler_tag, limit=100):
+    '''Requests of up to limit items for handler_tag that are waiting
+    and due, oldest first (without claiming them) -- e.g. to fetch their
+    records in one batch.'''
+    rows = self._conn().execute(
+             '''select request_json
+                from det_queue
+                where handler_tag = ? and status = ? and next_attempt_at <= ?
+                order by qid
+                limit ?''', (handler_tag, READY, time.time(), limit)
+           ).fetchall()
+    return [json.loads(row['request_json']) for row in rows]
+
+  def depth(self):
+    '''Number of items waiting or running.'''
+    return self._conn().execute(
+             'select count(*) from det_queue where status in (?, ?)',
+             (READY, RUNNING)).fetchone()[0]
+
+#------------------------------------------------------------------------------
+
+def start_workers(queue, n, process, give_up=None, poll_seconds=0.5):
+  '''Start n daemon threads that claim items and pass each to process(item).
+  process should return normally on success and raise to request a retry.
+  give_up(item), if given, is called when an item has used up its retries.
+  '''
+  def work():
+    while True:
+      try:
+        item = queue.claim()
+      except Exception:
+        log.error('Could not claim from DET queue: ' + traceback.format_exc())
+        time.sleep(poll_seconds)
+        continue
+      if item is None:
+        time.sleep(poll_seconds)
+        continue
+      try:
+        process(item)
+        queue.complete(item['qid'])
+      except Defer, d:
+        log.info('Queued DET {} deferred for {}s: {}'.format(
+                 item['qid'], d.seconds, str(d)))
+        queue.defer(item['qid'], d.seconds, str(d))
+      except Exception, e:
+        log.error('Queued DET {} failed (attempt {}): {}'.format(
+                  item['qid'], item['attempts'], traceback.format_exc()))
+        if not queue.fail(item['qid'], str(e)):
+          log.error('Queued DET {} gave up after {} attempts.'.format(
+                    item['qid'], item['attempts']))
+          if give_up is not None:
+            give_up(item)
+  threads = []
+  for i in range(n):
+    t = threading.Thread(target=work, name='det-worker-' + str(i))
+    t.daemon = True
+    t.start()
+    threads.append(t)
+  return threads
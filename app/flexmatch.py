@@ -0,0 +1,92 @@
+'''
+===============================================================================
+
+-----------------------
+       flexmatch
+-----------------------
+
+Demographics comparison: how confident we are that two people (e.g. a
+REDCap record and an OnCore subject) are the same, from first name, last
+name and birthdate.
+
+  o confidence(d1, d2) compares one pair (see wf_tpl_oncore_enroll).
+  o bulk_confidence(left, right) compares every candidate pair of two
+    whole datasets, for reconciliation sweeps across a cohort.
+
+For bulk_confidence, each dataset is columnar -- see columns(rows) -- so
+names are lowercased once per record rather than once per comparison.
+Candidates are blocked on birthdate: only pairs with the same birthdate
+are compared, since any other pair's confidence is 0 without looking at
+names. Results are the same as calling confidence on each pair.
+
+===============================================================================
+'''
+
+KEYS = ('first-name', 'last-name', 'birthdate')
+
+def _names_confidence(f1, l1, f2, l2):
+  '''Confidence for two people with the same birthdate, from lowercased
+  first and last names.'''
+  if f1 == f2 and l1 == l2:
+    # All three demographic elements match.
+    return 3
+  if (f1 in f2 or f2 in f1) and (l1 in l2 or l2 in l1):
+    return 2
+  return 1
+
+def confidence(d1, d2):
+  '''Flexmatch algorithm for demographics comparison.
+  d1 and d2 should be maps with (at least) the following keys:
+    o first-name
+    o last-name
+    o birthdate as a string formatted yyyy-mm-dd
+      (REDCap data will be formmatted like this; the oncorelib
+      applies this formatting before returning subject data.)
+  Returns a confidence level as int from 0 to 3 (inclusive).
+    o 3: first, last, and dob match.
+    o 2: first and last mostly match (for each, one contains the
+         other), dob match.
+    o 1: first and/or last significant  mismatch, dob match.
+    o 0: dob mismatch (other values not checked).
+  '''
+  if d1['birthdate'] != d2['birthdate']:
+    return 0
+  # Otherwise, dobs match.
+  return _names_confidence(d1['first-name'].lower(),
+                           d1['last-name'].lower(),
+                           d2['first-name'].lower(),
+                           d2['last-name'].lower())
+
+def columns(rows):
+  '''Columnar form of rows (maps with the KEYS above): a map of key ->
+  list of values, in row order, with names lowercased.'''
+  rows = list(rows)
+  return {'first-name': [r['first-name'].lower() for r in rows]
+         ,'last-name': [r['last-name'].lower() for r in rows]
+         ,'birthdate': [r['birthdate'] for r in rows]}
+
+def blocks(cols):
+  '''Map of birthdate -> indexes of the rows with that birthdate.'''
+  rslt = {}
+  for i, birthdate in enumerate(cols['birthdate']):
+    rslt.setdefault(birthdate, []).append(i)
+  return rslt
+
+def bulk_confidence(left, right):
+  '''Compares every row of left with every row of right that has the same
+  birthdate (left and right as returned by columns). Returns a map of
+  (left index, right index) -> confidence (1 to 3); pairs not in it have
+  confidence 0.'''
+  rslt = {}
+  lfirst, llast = left['first-name'], left['last-name']
+  rfirst, rlast = right['first-name'], right['last-name']
+  right_blocks = blocks(right)
+  for birthdate, lidxs in blocks(left).items():
+    ridxs = right_blocks.get(birthdate)
+    if not ridxs:
+      continue
+    for i in lidxs:
+      f1, l1 = lfirst[i], llast[i]
+      for j in ridxs:
+        rslt[(i, j)] = _names_confidence(f1, l1, rfirst[j], rlast[j])
+  return rslt
@@ -0,0 +1,133 @@
+import time
+import socket
+import threading
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import kickshaws as ks
+
+import common
+
+'''
+===============================================================================
+
+-----------------------
+      httpclient
+-----------------------
+
+The shared client for outbound HTTP calls.
+
+Each host gets its own requests Session, reused by every caller, so
+connections are kept alive and pooled (up to "pool-size" per host) instead
+of being set up for every call. Every call has connect and read timeouts.
+
+Retries, with exponential backoff ("backoff-seconds", doubling), up to
+"retries" times:
+  o a connect timeout, for any call (nothing was sent);
+  o for idempotent calls, also connection errors, read timeouts and the
+    "retry-statuses" responses. GET, HEAD, OPTIONS, PUT and DELETE are
+    idempotent; pass idempotent=True for a POST that only reads (e.g. a
+    REDCap export). Pass retry_read_timeouts=False for a call that is
+    slow rather than flaky when it times out (e.g. a large export), so a
+    read timeout isn't waited out again RETRIES times.
+
+Settings come from the optional "http-client" map in
+transmitter-config.json.
+
+Libraries that build their own requests Session (e.g. aoulib) can share
+the pooling through mount_pool(sess).
+
+is_outage(ex) tells whether an exception means the remote service is
+down or failing (rather than that it answered with an error); it's what
+the dependency guards count as failures (see resilience).
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+http_cfg = common.get_app_config().get('http-client', {})
+POOL_SIZE = http_cfg.get('pool-size', 10)
+CONNECT_TIMEOUT = http_cfg.get('connect-timeout-seconds', 5)
+READ_TIMEOUT = http_cfg.get('read-timeout-seconds', 60)
+RETRIES = http_cfg.get('retries', 3)
+BACKOFF_SECONDS = http_cfg.get('backoff-seconds', 0.5)
+RETRY_STATUSES = set(http_cfg.get('retry-statuses', [502, 503, 504]))
+
+IDEMPOTENT_METHODS = set(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+_sessions = {} # (scheme, host) -> Session
+_sessions_lock = threading.Lock()
+
+def mount_pool(sess):
+  '''Give sess keep-alive connection pools for http and https.'''
+  for prefix in ('http://', 'https://'):
+    sess.mount(prefix, HTTPAdapter(pool_connections=POOL_SIZE,
+                                   pool_maxsize=POOL_SIZE))
+  return sess
+
+def session_for(url):
+  '''The shared Session for url's host.'''
+  parts = urlparse.urlsplit(url)
+  k = (parts.scheme, parts.netloc)
+  with _sessions_lock:
+    sess = _sessions.get(k)
+    if sess is None:
+      sess = mount_pool(requests.Session())
+      _sessions[k] = sess
+  return sess
+
+def _retryable(ex, idempotent, retry_read_timeouts):
+  if isinstance(ex, requests.exceptions.ConnectTimeout):
+    return True
+  if (not retry_read_timeouts
+      and isinstance(ex, requests.exceptions.ReadTimeout)):
+    return False
+  return idempotent and isinstance(ex, (requests.exceptions.ConnectionError,
+                                        requests.exceptions.Timeout))
+
+def request(method, url, idempotent=None, timeout=None,
+            retry_read_timeouts=True, **kw):
+  '''Like requests.request, on the host's pooled session, with default
+  timeouts and retries (see above). Returns the Response.'''
+  method = method.upper()
+  if idempotent is None:
+    idempotent = method in IDEMPOTENT_METHODS
+  if timeout is None:
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+  sess = session_for(url)
+  attempt = 0
+  while True:
+    try:
+      resp = sess.request(method, url, timeout=timeout, **kw)
+      if not (idempotent and resp.status_code in RETRY_STATUSES
+              and attempt < RETRIES):
+        return resp
+      reason = 'status {}'.format(resp.status_code)
+    except Exception, ex:
+      if not (_retryable(ex, idempotent, retry_read_timeouts)
+              and attempt < RETRIES):
+        raise
+      reason = repr(ex)
+    delay = BACKOFF_SECONDS * 2 ** attempt
+    attempt += 1
+    log.info('{} {} failed ({}); retry {} of {} in {}s.'.format(
+             method, url, reason, attempt, RETRIES, delay))
+    time.sleep(delay)
+
+def is_outage(ex):
+  '''True for transport errors (can't connect, timed out) and for errors
+  carrying a 5xx response.'''
+  status = getattr(getattr(ex, 'response', None), 'status_code', None)
+  if status is not None:
+    return status >= 500
+  return isinstance(ex, (requests.exceptions.ConnectionError,
+                         requests.exceptions.Timeout, socket.error))
+
+def get(url, **kw):
+  return request('GET', url, **kw)
+
+def post(url, **kw):
+  return request('POST', url, **kw)
@@ -0,0 +1,47 @@
+import fcntl
+
+'''
+===============================================================================
+
+-----------------------
+     instancelock
+-----------------------
+
+Keeps Transmitter processes that would step on each other from running at
+the same time: the server (main) and batch commands that register records
+outside it (oncore_backlog). Record locks (recordlocks) only work within
+one process, so e.g. a DET and the backlog runner could otherwise both
+find a record unregistered and both register it in OnCore.
+
+Each takes the instance lock -- an exclusive flock on one file, by default
+transmitter.lock in the working directory ("instance-lock-path" in
+transmitter-config.json) -- before starting, and holds it until it exits.
+Whoever comes second is refused. The OS drops the lock when the holder
+exits, even if it crashes, so there's no stale lock to clean up.
+
+===============================================================================
+'''
+
+DEFAULT_PATH = 'transmitter.lock'
+
+_held = {} # path -> open file holding the lock
+
+def acquire(path=DEFAULT_PATH):
+  '''Take the instance lock, without waiting. Returns True if this process
+  now holds it (until it exits or calls release), False if another
+  process does.'''
+  if path in _held:
+    return True
+  f = open(path, 'a')
+  try:
+    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError:
+    f.close()
+    return False
+  _held[path] = f
+  return True
+
+def release(path=DEFAULT_PATH):
+  f = _held.pop(path, None)
+  if f is not None:
+    f.close() # Closing the file drops the lock.
@@ -1,9 +1,9 @@
-import requests
 import traceback
 from functools import partial
 import kickshaws as ks
 from common import *
-import redcaplib as rc
+import det
+import httpclient
 
 '''
 RACIE Legacy Handler: route to legacy service.
@@ -27,8 +27,9 @@ def _handle(ip_whitelist, req):
     raw_data = (req.get('data', ''))
     log.info('DET payload from REDCap: {}'.format(raw_data))
     log.info('About to call RACIE Legacy...')
-    outgoing_data = rc.parse_det_payload(raw_data)
-    rslt = requests.post(racie_legacy_url, data=outgoing_data)
+    pyld = det.from_request(req)
+    outgoing_data = pyld.raw if pyld is not None else {}
+    rslt = httpclient.post(racie_legacy_url, data=outgoing_data)
     status = rslt.status_code
     msg = rslt.text
     log.info('Result of RACIE Legacy call: status is {}; message is {}.'\
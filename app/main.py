@@ -9,7 +9,14 @@ from common import *
 import stdout_handler
 import test_email_handler
 import hello_world_handler
+import metrics_handler
 import aou_handler
+import redcap_handler_template
+import datastore
+import det
+import aou_affiliation_sweep
+import resilience
+import instancelock
 
 cfg = get_app_config() 
 log = smart_logger()
@@ -37,10 +44,29 @@ def main():
     ,'/prod2525': aou_handler.compose_handler('prod', 2525)
 
   }
+  # Decode each request's DET payload once, up front, for every handler
+  # -- but only for requests from REDCap (the allowed IPs).
+  routes = det.preprocess(routes, get_study_config('aou')['allowed-ips'])
+  # Not a DET endpoint, so added after preprocessing.
+  routes['/metrics'] = metrics_handler.handle
   path_to_key = cfg['path-to-key']
   path_to_pem = cfg['path-to-pem']
   log.info('-----------------------------------------------------')
   log.info('---------------STARTING TRANSMITTER------------------')
+  # Refuse to start if another Transmitter process (e.g. a running
+  # oncore_backlog) holds the instance lock; see instancelock.
+  if not instancelock.acquire(cfg.get('instance-lock-path',
+                                      instancelock.DEFAULT_PATH)):
+    log.error('Another Transmitter process is running; not starting.')
+    sys.exit(1)
+  # Bulkhead and circuit breaker settings per outside service.
+  resilience.configure(cfg.get('dependency-guards', {}))
+  # Fail fast if the datastore is unreachable.
+  datastore.check_conn()
+  # No-op unless "det-queue" is enabled in transmitter-config.json.
+  redcap_handler_template.start_queue_workers()
+  # No-op unless "aou-affiliation-sweep" is enabled.
+  aou_affiliation_sweep.start_schedule()
   metaphor.listen(routes, cfg['port'], path_to_key, path_to_pem, None, logger=log)
   return 
 
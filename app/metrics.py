@@ -0,0 +1,229 @@
+import sys
+import threading
+
+'''
+===============================================================================
+
+-----------------------
+        metrics
+-----------------------
+
+In-process counters, gauges and histograms, rendered in the Prometheus text
+exposition format (version 0.0.4) by render(). See metrics_handler for the
+/metrics route.
+
+Metrics are created once, at module level, by the module they describe:
+
+    DETS = metrics.counter('transmitter_dets_received_total',
+                           'DETs received.', ['handler'])
+    ...
+    DETS.inc(('prod2525',))
+
+Labels are passed as a tuple of values, in the order of the metric's label
+names. Each metric has its own small lock, held only to bump a number, so
+recording is cheap; render() just walks what's there.
+
+gauge_func and counter_func register a function that's called at scrape
+time instead -- handy for values that already live elsewhere (queue depth,
+cache stats). It returns a number, or, for a labelled metric, a map of
+label-value tuple -> number.
+
+===============================================================================
+'''
+
+# Histogram bucket upper bounds, in seconds; +Inf is always added.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _register(metric):
+  with _registry_lock:
+    if any(m.name == metric.name for m in _registry):
+      raise ValueError('Metric already registered: ' + metric.name)
+    _registry.append(metric)
+  return metric
+
+def _fmt_value(v):
+  if v == float('inf'):
+    return '+Inf'
+  if isinstance(v, float) and v.is_integer():
+    return str(int(v))
+  return repr(v) if isinstance(v, float) else str(v)
+
+def _escape(v):
+  return (str(v).replace('\\', r'\\').replace('\n', r'\n')
+                .replace('"', r'\"'))
+
+def _fmt_labels(names, values):
+  if not names:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(n, _escape(v))
+                        for n, v in zip(names, values)) + '}'
+
+#------------------------------------------------------------------------------
+
+class _Metric(object):
+
+  kind = None
+
+  def __init__(self, name, help_text, labelnames=()):
+    self.name = name
+    self.help_text = help_text
+    self.labelnames = tuple(labelnames)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _check(self, labels):
+    labels = tuple(labels)
+    if len(labels) != len(self.labelnames):
+      raise ValueError('{} expects labels {}; got {}'.format(
+                       self.name, self.labelnames, labels))
+    return labels
+
+  def _header(self):
+    return ['# HELP {} {}'.format(self.name, self.help_text)
+           ,'# TYPE {} {}'.format(self.name, self.kind)]
+
+  def samples(self):
+    '''(label values, value) pairs.'''
+    with self._lock:
+      return sorted(self._values.items())
+
+  def value(self, labels=()):
+    with self._lock:
+      return self._values.get(tuple(labels), 0)
+
+  def render(self):
+    lines = self._header()
+    for labels, v in self.samples():
+      lines.append(self.name + _fmt_labels(self.labelnames, labels)
+                   + ' ' + _fmt_value(v))
+    return lines
+
+class Counter(_Metric):
+
+  kind = 'counter'
+
+  def inc(self, labels=(), amount=1):
+    labels = self._check(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+
+  kind = 'gauge'
+
+  def set(self, value, labels=()):
+    labels = self._check(labels)
+    with self._lock:
+      self._values[labels] = value
+
+  def inc(self, labels=(), amount=1):
+    labels = self._check(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def dec(self, labels=(), amount=1):
+    self.inc(labels, -amount)
+
+class FuncMetric(_Metric):
+  '''A gauge or counter whose value comes from a function at scrape time.'''
+
+  def __init__(self, name, help_text, fn, labelnames=(), kind='gauge'):
+    _Metric.__init__(self, name, help_text, labelnames)
+    self.fn = fn
+    self.kind = kind
+
+  def samples(self):
+    rslt = self.fn()
+    if rslt is None:
+      return []
+    if isinstance(rslt, dict):
+      return sorted((tuple(k), v) for k, v in rslt.items())
+    return [((), rslt)]
+
+class Histogram(_Metric):
+
+  kind = 'histogram'
+
+  def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    _Metric.__init__(self, name, help_text, labelnames)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def observe(self, value, labels=()):
+    labels = self._check(labels)
+    with self._lock:
+      entry = self._values.get(labels)
+      if entry is None:
+        # [per-bucket counts, count, sum]
+        entry = [[0] * len(self.buckets), 0, 0.0]
+        self._values[labels] = entry
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry[0][i] += 1
+          break
+      entry[1] += 1
+      entry[2] += value
+
+  def snapshot(self, labels=()):
+    '''count, sum, and cumulative bucket counts as [(le, count)].'''
+    with self._lock:
+      entry = self._values.get(tuple(labels))
+      counts, count, total = (entry if entry is not None
+                              else ([0] * len(self.buckets), 0, 0.0))
+      cumulative, running = [], 0
+      for bound, n in zip(self.buckets, counts):
+        running += n
+        cumulative.append((bound, running))
+      return {'count': count, 'sum': total, 'buckets': cumulative}
+
+  def label_sets(self):
+    with self._lock:
+      return sorted(self._values.keys())
+
+  def render(self):
+    lines = self._header()
+    names = self.labelnames + ('le',)
+    for labels in self.label_sets():
+      snap = self.snapshot(labels)
+      for bound, n in snap['buckets']:
+        lines.append(self.name + '_bucket'
+                     + _fmt_labels(names, labels + (_fmt_value(bound),))
+                     + ' ' + str(n))
+      suffix = _fmt_labels(self.labelnames, labels)
+      lines.append(self.name + '_sum' + suffix + ' ' + _fmt_value(snap['sum']))
+      lines.append(self.name + '_count' + suffix + ' ' + str(snap['count']))
+    return lines
+
+#------------------------------------------------------------------------------
+
+def counter(name, help_text, labelnames=()):
+  return _register(Counter(name, help_text, labelnames))
+
+def gauge(name, help_text, labelnames=()):
+  return _register(Gauge(name, help_text, labelnames))
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+  return _register(Histogram(name, help_text, labelnames, buckets))
+
+def gauge_func(name, help_text, fn, labelnames=()):
+  return _register(FuncMetric(name, help_text, fn, labelnames, 'gauge'))
+
+def counter_func(name, help_text, fn, labelnames=()):
+  return _register(FuncMetric(name, help_text, fn, labelnames, 'counter'))
+
+def render():
+  '''Every registered metric, in the Prometheus text format.'''
+  with _registry_lock:
+    registered = list(_registry)
+  lines = []
+  for metric in registered:
+    try:
+      lines.extend(metric.render())
+    except Exception:
+      # E.g. a gauge_func whose source is unavailable; skip just that one.
+      lines.append('# {} unavailable: {}'.format(metric.name,
+                                                 _escape(sys.exc_info()[1])))
+  return '\n'.join(lines) + '\n'
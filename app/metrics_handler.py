@@ -0,0 +1,21 @@
+from common import *
+from kickshaws import *
+import metrics
+
+__all__ = ['handle']
+
+log = smart_logger()
+
+# Read once; the route is meant to be scraped every few seconds.
+allowed_ips = get_app_config().get('metrics-allowed-ips', [])
+
+def handle(request):
+  '''Serves every metric in the Prometheus text format. Only clients
+  listed under "metrics-allowed-ips" in transmitter-config.json may
+  scrape; anyone else gets a 403.'''
+  if not ip_is_allowed(request['client_ip'], allowed_ips):
+    log.info('Client IP of ' + request['client_ip'] + ' is not allowed.')
+    return {'status': 403}
+  return {'status': 200
+         ,'content-type': 'text/plain; version=0.0.4'
+         ,'body': metrics.render()}
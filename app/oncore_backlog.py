@@ -0,0 +1,193 @@
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import kickshaws as ks
+
+import common
+import instancelock
+import resilience
+import redcap_export
+import datastore as store
+import wf_tpl_oncore_enroll as enroll
+
+'''
+===============================================================================
+
+-----------------------
+     oncore_backlog
+-----------------------
+
+Registers backlogged enrollments in OnCore in one run, rather than waiting
+for coordinators to touch each record again (e.g. after an OnCore outage).
+
+For each configured project, a run:
+
+  1. Finds the records that are enrolled ('has-enrolled' is yes) but have
+     neither 'enrollment-registered-in-oncore' nor
+     'jira-enrollment-ticket-created' set, in three datastore queries
+     (datastore.latest_for_attr).
+  2. Exports those records from REDCap, "export-batch-size" at a time.
+  3. Runs each record of a batch through wf_tpl_oncore_enroll's
+     flexmatch-and-register step (the same one DETs go through, so
+     reconciliation flags are set the same way), on "threads" worker
+     threads. OnCore calls also go through the 'oncore' dependency guard,
+     which bounds them further.
+  4. Reports how many records ended in each outcome (registered,
+     not-found, mismatch, no-action, missing -- not in REDCap --,
+     unavailable -- OnCore's guard turned the call away -- or error),
+     how long it took and records per second.
+
+Configured by the optional "oncore-backlog" map in transmitter-config.json.
+
+The server must be stopped first: it registers records too, and its record
+locks don't reach this process, so both could register the same record.
+The run takes the instance lock (see instancelock) and refuses to start
+while the server holds it (and the server won't start until the run is
+done). A dry run only reads, so it doesn't need the lock.
+
+Usage (from the application folder):
+
+    python oncore_backlog.py
+    python oncore_backlog.py --dry-run
+    python oncore_backlog.py --threads 2 --limit 50
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+backlog_cfg = common.get_app_config().get('oncore-backlog', {})
+
+MISSING = 'missing'
+UNAVAILABLE = 'unavailable'
+ERROR = 'error'
+
+def pending_record_ids(redcap_server_tag, pid):
+  '''Record IDs that are enrolled but neither registered in OnCore nor
+  ticketed in JIRA.'''
+  pid = str(pid)
+  enrolled = store.latest_for_attr(redcap_server_tag, pid,
+                                   enroll.ENROLLED_KEY)
+  registered = store.latest_for_attr(redcap_server_tag, pid,
+                                     enroll.ONCORE_REGISTERED_KEY)
+  ticketed = store.latest_for_attr(redcap_server_tag, pid,
+                                   enroll.JIRA_ENROLLMENT_TICKET_KEY)
+  return sorted(record_id for record_id, val in enrolled.items()
+                if val == enroll.YES
+                   and registered.get(record_id) != enroll.YES
+                   and ticketed.get(record_id) != enroll.YES)
+
+def _redcap_spec(study_tag, redcap_server_tag, pid):
+  study_config = common.get_study_config(study_tag)
+  handler_tag = redcap_server_tag + str(pid)
+  env_tag = study_config['handler-tag-to-env-tag'][handler_tag]
+  return study_config[env_tag]['redcap-spec']
+
+def _fetch(redcap_spec, record_ids):
+  '''Returns [(record ID, REDCap record or None)], in one export.'''
+  records = dict((str(r['record_id']), r)
+                 for r in redcap_export.export_records(redcap_spec,
+                                                       records=record_ids))
+  return [(record_id, records.get(record_id)) for record_id in record_ids]
+
+def _register_one(go, item):
+  record_id, record = item
+  if record is None:
+    return record_id, MISSING
+  request = {'record-id': record_id
+            ,'full-record': [record]
+            ,enroll.ENROLLED_KEY: enroll.YES}
+  try:
+    return record_id, go(request).get(enroll.OUTCOME_KEY, enroll.NO_ACTION)
+  except resilience.DependencyUnavailable, e:
+    log.info('Record ID {}: {}'.format(record_id, e))
+    return record_id, UNAVAILABLE
+  except Exception:
+    log.error('Record ID {} failed: {}'.format(record_id,
+                                               traceback.format_exc()))
+    return record_id, ERROR
+
+def run_project(redcap_server_tag, pid, study_tag='aou', threads=4,
+                batch_size=100, limit=None, dry_run=False):
+  '''Register one project's backlog. Returns a report: the count of
+  records per outcome, plus records, seconds and per-second.'''
+  started = time.time()
+  record_ids = pending_record_ids(redcap_server_tag, pid)[:limit]
+  report = {'records': len(record_ids)}
+  def tally(outcome, n=1):
+    report[outcome] = report.get(outcome, 0) + n
+  if record_ids and not dry_run:
+    go = enroll.compose(redcap_server_tag, str(pid), study_tag)
+    redcap_spec = _redcap_spec(study_tag, redcap_server_tag, pid)
+    pool = ThreadPool(threads)
+    try:
+      for i in range(0, len(record_ids), batch_size):
+        chunk = record_ids[i:i + batch_size]
+        try:
+          items = _fetch(redcap_spec, chunk)
+        except resilience.DependencyUnavailable, e:
+          log.info('REDCap export skipped: {}'.format(e))
+          tally(UNAVAILABLE, len(chunk))
+          continue
+        except Exception:
+          log.error('REDCap export failed: ' + traceback.format_exc())
+          tally(ERROR, len(chunk))
+          continue
+        for record_id, outcome in pool.imap_unordered(
+                                    lambda item: _register_one(go, item),
+                                    items):
+          tally(outcome)
+    finally:
+      pool.close()
+      pool.join()
+  report['seconds'] = round(time.time() - started, 2)
+  report['per-second'] = round(len(record_ids) / max(report['seconds'], 0.01),
+                               2)
+  log.info('OnCore backlog of {}{}{}: {}'.format(
+           redcap_server_tag, pid, ' (dry run)' if dry_run else '', report))
+  return report
+
+def run(threads=None, limit=None, dry_run=False):
+  '''Register the backlog of every configured project. Returns a map of
+  handler tag -> report.'''
+  rslt = {}
+  for redcap_server_tag, pid in backlog_cfg.get('projects', []):
+    rslt[redcap_server_tag + str(pid)] = run_project(
+      redcap_server_tag, pid,
+      study_tag=backlog_cfg.get('study-tag', 'aou'),
+      threads=threads or backlog_cfg.get('threads', 4),
+      batch_size=backlog_cfg.get('export-batch-size', 100),
+      limit=limit, dry_run=dry_run)
+  return rslt
+
+def main():
+  parser = argparse.ArgumentParser(
+             description='Register backlogged enrollments in OnCore.')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='Count the backlog; register nothing.')
+  parser.add_argument('--threads', type=int,
+                      help='Records to work on at once (default from config, '
+                           'else 4).')
+  parser.add_argument('--limit', type=int,
+                      help='At most this many records per project.')
+  args = parser.parse_args()
+  if not args.dry_run and not instancelock.acquire(
+                                common.get_app_config().get(
+                                  'instance-lock-path',
+                                  instancelock.DEFAULT_PATH)):
+    print('Transmitter is running (it holds the instance lock); stop it '
+          'first.')
+    sys.exit(1)
+  resilience.configure(common.get_app_config().get('dependency-guards', {}))
+  for handler_tag, report in sorted(run(args.threads, args.limit,
+                                        args.dry_run).items()):
+    print('{}: {}'.format(handler_tag, report))
+  store.flush()
+
+if __name__ == '__main__': main()
@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from threading import Lock
+
+'''
+===============================================================================
+
+-----------------------
+      recordlocks
+-----------------------
+
+A table of per-key locks that only holds entries for keys in use.
+
+Each key's lock is reference counted: a thread registers interest before
+waiting on the lock, and the entry is dropped as soon as the last interested
+thread releases it. So the table's size tracks the number of records being
+worked on (or waited on) right now, not every record ever seen.
+
+The bookkeeping is guarded by one of `stripes` small mutexes, picked by the
+key's hash, and each is held only long enough to bump a count. Threads
+working on different records rarely touch the same mutex, and no thread
+ever holds one while waiting for a record lock.
+
+Usage:
+
+    locks = RecordLockTable()
+    with locks.hold(key):
+      ... # only one thread at a time per key
+
+===============================================================================
+'''
+
+class RecordLockTable(object):
+
+  def __init__(self, stripes=64):
+    self._stripe_locks = [Lock() for _ in range(stripes)]
+    # One map per stripe: key -> [record Lock, number of holders/waiters]
+    self._stripes = [{} for _ in range(stripes)]
+
+  def _stripe(self, k):
+    i = hash(k) % len(self._stripes)
+    return self._stripe_locks[i], self._stripes[i]
+
+  @contextmanager
+  def hold(self, k):
+    stripe_lock, entries = self._stripe(k)
+    with stripe_lock:
+      entry = entries.get(k)
+      if entry is None:
+        entry = [Lock(), 0]
+        entries[k] = entry
+      entry[1] += 1
+    entry[0].acquire()
+    try:
+      yield
+    finally:
+      entry[0].release()
+      with stripe_lock:
+        entry[1] -= 1
+        if entry[1] == 0:
+          del entries[k]
+
+  def __len__(self):
+    '''Number of keys currently held or waited on.'''
+    ttl = 0
+    for stripe_lock, entries in zip(self._stripe_locks, self._stripes):
+      with stripe_lock:
+        ttl += len(entries)
+    return ttl
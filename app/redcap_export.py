@@ -0,0 +1,52 @@
+import kickshaws as ks
+
+import httpclient
+import resilience
+import tracing
+
+'''
+===============================================================================
+
+-----------------------
+     redcap_export
+-----------------------
+
+Record export calls against the REDCap API -- for one record (as
+redcaplib.get_full_record does) or many at once.
+
+redcap_spec is the "redcap-spec" map from a study config (api-url, token).
+Calls go through httpclient (pooled connections; exports are read-only, so
+they're retried like GETs). Exports get a longer read timeout than
+httpclient's default, since REDCap builds the whole export before it
+sends anything. A large export -- several records, or the whole project
+-- that still times out isn't retried: it would only time out again.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+EXPORT_READ_TIMEOUT = 120 # seconds
+
+def export_records(redcap_spec, fields=None, records=None):
+  '''Export records (flat, as a list of maps) from the project.
+  fields and records, if given, limit the export to those field names
+  and record IDs; by default every field of every record is exported.'''
+  data = {'token': redcap_spec['token']
+         ,'content': 'record'
+         ,'format': 'json'
+         ,'type': 'flat'
+         ,'returnFormat': 'json'}
+  for i, field in enumerate(fields or []):
+    data['fields[{}]'.format(i)] = field
+  for i, record in enumerate(records or []):
+    data['records[{}]'.format(i)] = record
+  with resilience.guard('redcap').call(httpclient.is_outage), \
+       tracing.span('redcap.export_records'):
+    resp = httpclient.post(redcap_spec['api-url'], data=data,
+                           idempotent=True,
+                           timeout=(httpclient.CONNECT_TIMEOUT,
+                                    EXPORT_READ_TIMEOUT),
+                           retry_read_timeouts=len(records or []) == 1)
+    resp.raise_for_status() # Inside the guard, so 5xx responses count.
+  return resp.json()
@@ -5,15 +5,23 @@ from functools import *
 from itertools import *
 from operator import *
 
+import time
 import traceback
 from threading import Lock
 
 import kickshaws as ks
-import redcaplib
 
 # local 
 import common 
 import aou_common
+import recordlocks
+import det
+import detqueue
+import coalesce
+import metrics
+import workflow_dag
+import resilience
+import redcap_intake_workflow
 
 #------------------------------------------------------------------------------
 
@@ -31,26 +39,51 @@ def build_key(req):
          + str(req['record-id'] ))
 
 # See Note One below.
-map_lock = Lock() # Used solely by make_record_lock_if_absent.
-record_locks = {} # Used in make_record_lock_if_absent and _handle.
+record_locks = recordlocks.RecordLockTable() # Used in _run_chain.
 
-# See Note One below.
-def make_record_lock_if_absent(k):
-  '''Instantiate a new Lock object and put it into the
-  map for key k, but only if there's nothing for that key already.'''
-  with map_lock:
-    if not str(k) in record_locks:
-      log.info('Creating new record lock for: {}'.format(k))
-      record_locks[k] = Lock()
+#------------------------------------------------------------------------------
+# Metrics; exported at /metrics (see metrics_handler).
+
+DETS_RECEIVED = metrics.counter('transmitter_dets_received_total',
+                                'DET requests received.', ['handler'])
+RESPONSES = metrics.counter('transmitter_responses_total',
+                            'Responses returned, by status code.',
+                            ['handler', 'status'])
+IN_FLIGHT = metrics.gauge('transmitter_requests_in_flight',
+                          'DET requests being handled right now.',
+                          ['handler'])
+REQUEST_SECONDS = metrics.histogram('transmitter_request_duration_seconds',
+                                    'Time to respond to a DET request.',
+                                    ['handler'])
+LOCK_WAIT_SECONDS = metrics.histogram('transmitter_record_lock_wait_seconds',
+                                      'Time spent waiting for a record lock.')
+metrics.gauge_func('transmitter_record_locks_active',
+                   'Record keys currently locked or waited on.',
+                   lambda: len(record_locks))
+
+def _measured(handler_tag, handler, request):
+  '''Wraps a handler (see compose_handler) to count the request, its
+  response status, and how long it took.'''
+  labels = (handler_tag,)
+  DETS_RECEIVED.inc(labels)
+  IN_FLIGHT.inc(labels)
+  start = time.time()
+  status = 500
+  try:
+    response = handler(request)
+    status = response.get('status', 200)
+    return response
+  finally:
+    IN_FLIGHT.dec(labels)
+    REQUEST_SECONDS.observe(time.time() - start, labels)
+    RESPONSES.inc((handler_tag, str(status)))
 
 #------------------------------------------------------------------------------
 
-def _handle(redcap_server_tag, pid, study_tag, workflow_chain, request):
-  '''
-  You won't normally invoke this function directly; it's 
-  used by compose_handler below.
-  '''
-  log.info('=== Entered. ===')
+def _prepare(redcap_server_tag, pid, study_tag, request):
+  '''Run the initial checks on an incoming request and, if they pass,
+  load it up with pertinent data elements for downstream use.
+  Returns a response-shaped map if we should stop here; else None.'''
 
   # Retrieve study config.
   study_config = common.get_study_config(study_tag)
@@ -68,29 +101,35 @@ def _handle(redcap_server_tag, pid, study_tag, workflow_chain, request):
     log.info('Method is {}; nothing to do.'.format(request['method']))
     return {'status': 405}  
 
+  # Decode the DET message (usually already done by det.preprocess in
+  # main; this is a no-op then).
+  try:
+    det_payload = det.from_request(request)
+  except det.MalformedDet, e:
+    log.info(str(e))
+    return {'status': 400}
+
   # Check: request contains data or bail. E.g., request won't contain
   # data if user 'tests' endpoint via the Data Entry Trigger 
   # URL Test button in the Project Setup screen.
-  if len(redcaplib.parse_det_payload(request['data'])) == 0:
+  if det_payload is None:
     log.info('DET payload empty; nothing to do.')
     return {'status': 200}
-
-  # We need the DET message now.
-  det_payload = redcaplib.parse_det_payload(request['data'])
-  log.info('DET payload: ' + str(det_payload))
+  log.info('DET payload: ' + str(det_payload.raw))
 
   # Check: PID in DET message is PID we expect, or bail.
   # A mismatch indicates a misconfiguration needing attention (in the
   # REDCap project's Project Setup) so an Error is raised in this case.
-  if str(det_payload['project_id']) != str(pid):
-    raise RuntimeError('project_id in DET payload (' + det_msg['project_id']
+  if det_payload.project_id != str(pid):
+    raise RuntimeError('project_id in DET payload ('
+                      + det_payload.project_id
                       +') does not match what handler expects (' + str(pid) + ')') 
 
   # At this point, initial checks were OK.
   log.info('Initial checks OK.')
   
   # Grab record ID. This is important for lock/serializing logic below.
-  record_id = str(det_payload['record'])
+  record_id = det_payload.record
 
   # Load up request with pertinent data elements for downstream use.
   request['redcap-server-tag'] = redcap_server_tag
@@ -98,22 +137,25 @@ def _handle(redcap_server_tag, pid, study_tag, workflow_chain, request):
   request['study-tag'] = study_tag
   request['handler-tag'] = redcap_server_tag + str(pid)
   request['record-id'] = record_id
-  request['det-payload'] = det_payload
-
-  # Ok, ready to run workflows now.
+  request['received-at'] = time.time()
+  return None
 
-  # Do some lock-related setup.
+def _run_chain(workflow_chain, request):
+  '''Run the workflow chain for a prepared request, holding its record
+  lock. Returns a response-shaped map; exceptions propagate.'''
   # See Note One below.
   record_lock_key = build_key(request)
-  make_record_lock_if_absent(record_lock_key)
 
   # Start of logic with lock.
   # See Note One below.
   log.info('About to start work with lock [{}].'.format(record_lock_key))
-  with record_locks[record_lock_key]:
-    log.info('Starting workflow chain for pid {}, record id {}'.format(pid, record_id))
+  wait_start = time.time()
+  with record_locks.hold(record_lock_key):
+    LOCK_WAIT_SECONDS.observe(time.time() - wait_start)
+    log.info('Starting workflow chain for pid {}, record id {}'\
+             ''.format(request['pid'], request['record-id']))
     try:
-      result = common.run_workflow_chain(request, workflow_chain)
+      result = workflow_dag.run(request, workflow_chain)
       if result.get('response'):
         log.info('Done. Chain result includes response of {}; will use that.'\
                  ''.format(str(result.get('response'))))
@@ -121,21 +163,203 @@ def _handle(redcap_server_tag, pid, study_tag, workflow_chain, request):
       else:
         log.info('Done. Will return 200 response.')
         return {'status': 200} 
-    except Exception, e:
-      log.error(traceback.format_exc())
-      handler_tag = redcap_server_tag + str(pid)
-      env_tag = aou_common.get_env_tag_for_handler(handler_tag)
-      ks.send_email(study_config[env_tag]['from-email']
-                   ,study_config[env_tag]['to-email']
-                   ,'Boost Transmitter Exception'
-                   ,'Please check the log.')
-      log.error('Returning 500; details: ' + str(e))
-      return {'status': 500}
     finally:
       log.info('Finished work with lock [{}].'.format(record_lock_key))
-      log.info('== Finished ==')
   # End of logic with lock.
 
+def _send_exception_email(request):
+  study_config = common.get_study_config(request['study-tag'])
+  env_tag = aou_common.get_env_tag_for_handler(request['handler-tag'])
+  ks.send_email(study_config[env_tag]['from-email']
+               ,study_config[env_tag]['to-email']
+               ,'Boost Transmitter Exception'
+               ,'Please check the log.')
+
+# Dependency -> start of the outage we last sent an email about; see
+# Note Four below.
+alerted_outages = {}
+alerted_outages_lock = Lock()
+
+def _send_outage_email_once(request, e):
+  if e.since is None:
+    return
+  with alerted_outages_lock:
+    if alerted_outages.get(e.dependency) == e.since:
+      return
+    alerted_outages[e.dependency] = e.since
+  study_config = common.get_study_config(request['study-tag'])
+  env_tag = aou_common.get_env_tag_for_handler(request['handler-tag'])
+  ks.send_email(study_config[env_tag]['from-email']
+               ,study_config[env_tag]['to-email']
+               ,'Boost Transmitter: {} unavailable'.format(e.dependency)
+               ,'Transmitter stopped calling {} after repeated failures '
+                'and is answering DETs that need it with 503 until it '
+                'recovers. REDCap does not resend them: see the log for '
+                'the records to re-trigger.'.format(e.dependency))
+
+def _run_chain_or_500(workflow_chain, request):
+  try:
+    return _run_chain(workflow_chain, request)
+  except resilience.DependencyUnavailable, e:
+    # See Note Four below.
+    log.error('Returning 503 for [{}]; re-trigger it once {} is back. '
+              'Details: {}'.format(build_key(request), e.dependency, e))
+    try:
+      _send_outage_email_once(request, e)
+    except Exception:
+      log.error('Outage email failed: ' + traceback.format_exc())
+    return {'status': 503}
+  except Exception, e:
+    log.error(traceback.format_exc())
+    _send_exception_email(request)
+    log.error('Returning 500; details: ' + str(e))
+    return {'status': 500}
+
+def _handle(redcap_server_tag, pid, study_tag, workflow_chain, request):
+  '''
+  You won't normally invoke this function directly; it's 
+  used by compose_handler below.
+  '''
+  log.info('=== Entered. ===')
+  response = _prepare(redcap_server_tag, pid, study_tag, request)
+  if response is not None:
+    return response
+  # Ok, ready to run workflows now.
+  try:
+    if coalescer is None:
+      return _run_chain_or_500(workflow_chain, request)
+    # See Note Three below.
+    response = coalescer.submit(build_key(request), request,
+                                partial(_run_chain_or_500, workflow_chain))
+    if response is None:
+      log.info('Run already in progress for [{}]; folded into it. {}'\
+               ''.format(build_key(request), coalescing_stats()))
+      return {'status': 202}
+    return response
+  finally:
+    log.info('== Finished ==')
+
+#------------------------------------------------------------------------------
+# Coalescing. See Note Three below.
+
+coalesce_cfg = common.get_app_config().get('det-coalescing', {})
+
+coalescer = None
+if coalesce_cfg.get('enabled', False):
+  coalescer = coalesce.Coalescer()
+
+def coalescing_stats():
+  '''DETs received, chain runs done, and runs saved by coalescing,
+  across both direct and queued mode.'''
+  stats = {'received': 0, 'runs': 0, 'saved': 0}
+  if coalescer is not None:
+    stats = coalescer.stats()
+  if queue is not None:
+    stats['saved'] += queue.coalesced
+  return stats
+
+metrics.counter_func('transmitter_det_coalescing_total',
+                     'DETs received, chain runs done, and runs saved by '
+                     'coalescing.',
+                     lambda: dict(((k,), v)
+                                  for k, v in coalescing_stats().items()),
+                     ['count'])
+
+#------------------------------------------------------------------------------
+# Queued mode. See Note Two below.
+
+# Request keys worth keeping when a request is queued; the rest of what
+# Metaphor hands us isn't needed downstream (or serializable).
+QUEUED_KEYS = ['client_ip', 'method', 'data', 'redcap-server-tag', 'pid',
+               'study-tag', 'handler-tag', 'record-id', 'det-payload',
+               'received-at']
+
+queue_cfg = common.get_app_config().get('det-queue', {})
+
+queue = None # Opened by queued_mode_enabled on first use.
+queue_lock = Lock()
+
+workflow_chains = {} # handler-tag -> chain, filled in by compose_handler.
+
+def queued_mode_enabled():
+  '''True if "det-queue" is enabled in transmitter-config.json. Opens
+  the queue the first time it's asked.'''
+  global queue
+  if not queue_cfg.get('enabled', False):
+    return False
+  with queue_lock:
+    if queue is None:
+      queue = detqueue.DetQueue(
+                queue_cfg.get('path', 'det-queue.sqlite3'),
+                max_attempts=queue_cfg.get('max-attempts', 5),
+                retry_base_seconds=queue_cfg.get('retry-base-seconds', 30),
+                retry_max_seconds=queue_cfg.get('retry-max-seconds', 3600),
+                coalesce=coalesce_cfg.get('enabled', False))
+  return True
+
+def _handle_queued(redcap_server_tag, pid, study_tag, request):
+  '''Validate, enqueue, and return 202; a worker runs the chain later.'''
+  log.info('=== Entered (queued mode). ===')
+  response = _prepare(redcap_server_tag, pid, study_tag, request)
+  if response is not None:
+    return response
+  to_queue = dict((k, request[k]) for k in QUEUED_KEYS if k in request)
+  qid = queue.enqueue(request['handler-tag'], build_key(request), to_queue)
+  log.info('Queued as {} for record key [{}]; returning 202.'\
+           ''.format(qid, build_key(request)))
+  return {'status': 202}
+
+def _prefetch_records(request):
+  '''Fetch this request's record along with those of other DETs waiting
+  for the same project, in one REDCap export (see redcap_intake_workflow).
+  A failure here isn't fatal; intake then fetches records one by one.'''
+  limit = redcap_intake_workflow.batch_cfg.get('max-records', 100)
+  waiting = queue.waiting(request['handler-tag'], limit - 1)
+  record_ids = [request['record-id']] + [
+                 w['record-id'] for w in waiting
+                 if not redcap_intake_workflow.has_prefetched(w)]
+  try:
+    redcap_intake_workflow.prefetch(request['study-tag'],
+                                    request['handler-tag'], record_ids)
+  except Exception:
+    log.error('Batch prefetch failed; continuing without it: '
+              + traceback.format_exc())
+
+def _process_queued(item):
+  '''Worker side: run the chain for a claimed queue item. A 5xx
+  response from the chain counts as a failure, so it gets retried.'''
+  request = item['request']
+  log.info('Processing queued DET {} (attempt {}) for record key [{}].'\
+           ''.format(item['qid'], item['attempts'], item['record-key']))
+  if (redcap_intake_workflow.batching_enabled()
+      and not redcap_intake_workflow.has_prefetched(request)):
+    _prefetch_records(request)
+  try:
+    response = _run_chain(workflow_chains[item['handler-tag']], request)
+  except resilience.DependencyUnavailable, e:
+    # See Note Four below.
+    raise detqueue.Defer(e.retry_after, str(e))
+  if response.get('status', 200) >= 500:
+    raise RuntimeError('Workflow chain returned status {}'\
+                       ''.format(response.get('status')))
+
+def _give_up_queued(item):
+  _send_exception_email(item['request'])
+
+def start_queue_workers():
+  '''Start draining the DET queue, if queued mode is enabled. Call once,
+  after all handlers have been composed (see main).'''
+  if not queued_mode_enabled():
+    return []
+  n = queue_cfg.get('workers', 4)
+  log.info('Starting {} DET queue worker(s); {} item(s) waiting.'\
+           ''.format(n, queue.depth()))
+  return detqueue.start_workers(queue, n, _process_queued, _give_up_queued)
+
+metrics.gauge_func('transmitter_det_queue_depth',
+                   'Queued DETs waiting or running (queued mode only).',
+                   lambda: queue.depth() if queue is not None else None)
+
 #------------------------------------------------------------------------------
 
 def compose_handler(redcap_server_tag, pid, study_tag, workflow_chain):
@@ -145,11 +369,22 @@ def compose_handler(redcap_server_tag, pid, study_tag, workflow_chain):
     - pid -- the REDCap project ID
     - study_tag -- a tag used for retrieving study-specific configuration
     - workflow_chain -- a list of functions that will be passed to
-      common.run_workflow_chain. See README for more about workflows.
+      common.run_workflow_chain, or a workflow_dag.Dag. See README for
+      more about workflows.
   Returns: a function that takes one argument: a request-shaped
   map -- e.g., a handler function that the Metaphor framework expects.
+  If "det-queue" is enabled in transmitter-config.json, the handler
+  queues the request and returns 202 instead of running the chain itself
+  (see Note Two below).
   '''
-  return partial(_handle, redcap_server_tag, pid, study_tag, workflow_chain)
+  handler_tag = redcap_server_tag + str(pid)
+  workflow_chains[handler_tag] = workflow_chain
+  if queued_mode_enabled():
+    handler = partial(_handle_queued, redcap_server_tag, pid, study_tag)
+  else:
+    handler = partial(_handle, redcap_server_tag, pid, study_tag,
+                      workflow_chain)
+  return partial(_measured, handler_tag, handler)
 
 #------------------------------------------------------------------------------
 '''  
@@ -168,11 +403,12 @@ To achieve the above, behavior of this handler is as follows:
 * We assume we're running in a multithreaded environment (i.e., each
   invocation happens on a separate thread, which is typical 
   Web server behavior.)
-* Maintain a map of Lock objects called record_locks.
-* Fill up record_locks on an ad hoc basis -- which means we modify the
-  map as we go. Because of this, we also use a lock around record_locks,
-  called map_lock.
-* We construct a key like so for querying the record_locks map:
+* Maintain a table of per-record locks called record_locks (see the
+  recordlocks module). An entry exists only while some thread is working
+  on, or waiting for, that record; the last thread out removes it, so the
+  table doesn't grow with every record ever seen. Its bookkeeping is split
+  across several small mutexes by key hash rather than one global lock.
+* We construct a key like so for querying record_locks:
 
       redcap-server-tag (usually 'prod' or 'sand') + pid + '.' + record-id
 
@@ -181,5 +417,74 @@ To achieve the above, behavior of this handler is as follows:
       handler-tag + '.' + record-id
 '''
 #------------------------------------------------------------------------------
+'''
+-------------------------------------------------------------------------
+Note Two:
+Queued mode.
+-------------------------------------------------------------------------
+
+Running the whole chain inside the HTTP request (REDCap API fetch, AoU
+API, OnCore, email) can take seconds, long enough for REDCap's DET call
+to time out. With "det-queue" enabled in transmitter-config.json:
+
+* The handler does only the initial checks in _prepare, writes the request
+  to a durable SQLite-backed queue (see the detqueue module) and returns
+  202 Accepted.
+* start_queue_workers (called from main) starts a pool of worker threads
+  that drain the queue and run the same workflow chain via _run_chain, so
+  record locks still apply.
+* The queue hands out items for a given record key strictly in arrival
+  order, one at a time. Failures (an exception, or a 5xx response from the
+  chain) are retried with exponential backoff; the exception email is
+  only sent once an item runs out of attempts.
+* With "redcap-batch-export" enabled, a worker whose item has no
+  prefetched record fetches it together with those of the other DETs
+  waiting for the same project, in one REDCap export (see
+  redcap_intake_workflow). Those DETs then skip the API when their turn
+  comes.
+'''
+#------------------------------------------------------------------------------
+'''
+-------------------------------------------------------------------------
+Note Three:
+Coalescing bursts of DETs for one record.
+-------------------------------------------------------------------------
+
+REDCap sends a DET on every form save, so a coordinator editing a record
+produces a burst of DETs for it. Every chain run re-fetches the full record
+from REDCap, so a run that starts after the last DET covers all of them.
+With "det-coalescing" enabled in transmitter-config.json:
 
+* Direct mode: a DET arriving while a run for its record key is in progress
+  becomes that key's single pending run (replacing any earlier pending DET)
+  and gets 202 straight away. When the current run finishes, its caller
+  gets its response and the pending run starts on a background thread.
+  See the coalesce module.
+* Queued mode: when a worker claims a record's next item, later waiting
+  items for the same record are folded into it.
 
+coalescing_stats() reports how many runs were saved.
+'''
+#------------------------------------------------------------------------------
+#------------------------------------------------------------------------------
+'''
+-------------------------------------------------------------------------
+Note Four:
+Unavailable dependencies.
+-------------------------------------------------------------------------
+
+Calls to OnCore, the AoU API and REDCap go through per-dependency guards
+(see the resilience module): a bulkhead caps how many request threads can
+be inside one dependency at once, and a circuit breaker stops calling it
+for a while after repeated failures. Either way the workflow gets
+DependencyUnavailable straight away instead of blocking while holding a
+record lock, so threads aren't tied up and other routes stay responsive.
+
+* Direct mode: the DET gets a 503. REDCap doesn't retry DETs, so each
+  503 is logged as an error with the record's key, for re-triggering
+  later. Rather than an exception email per DET, one email goes out per
+  outage (from the first 503 after a dependency's circuit opens until it
+  closes again).
+* Queued mode: the item goes back to the queue until the dependency is
+  expected to be usable again, without using up one of its attempts.
+'''
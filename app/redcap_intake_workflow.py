@@ -8,13 +8,93 @@ from operator import *
 
 import sys
 import json
+import time
 
 import kickshaws as ks
-import redcaplib
 import common
+import tracing
+import workflow_dag
+import redcap_export
+import ttlcache
+
+'''
+Fetches the record named in the DET from the REDCap API and puts it into the
+request as 'full-record'.
+
+Batched export (optional; "redcap-batch-export" in transmitter-config.json):
+when DETs pile up in the queue, the worker that claims one calls prefetch
+with the record IDs of the others waiting for the same project, and they're
+all fetched in one export call, limited to the fields the downstream
+workflows read ("fields"; default INTAKE_FIELDS). go then uses a prefetched
+record instead of calling the API -- but only if it was fetched after the
+DET arrived ('received-at'), so it's never older than the change that
+triggered the DET. Each prefetched record is used once.
+'''
 
 log = ks.smart_logger()
 
+# Fields the AoU workflows read from the record.
+INTAKE_FIELDS = ['record_id', 'mrn', 'pmi_id_test', 'dob', 'pmi_dob',
+                 'enroll_date', 'withdrawal_date', 'other_enrollment',
+                 'name_first', 'name_last']
+
+batch_cfg = common.get_app_config().get('redcap-batch-export', {})
+
+# (handler-tag, record-id) -> (fetched-at, record rows)
+prefetched = ttlcache.TTLCache(
+               max_entries=batch_cfg.get('max-prefetched', 5000),
+               ttl_seconds=batch_cfg.get('prefetch-ttl-seconds', 300))
+
+def batching_enabled():
+  return batch_cfg.get('enabled', False)
+
+def _redcap_spec(study_tag, handler_tag):
+  study_config = common.get_study_config(study_tag)
+  env_tag = study_config['handler-tag-to-env-tag'][handler_tag]
+  return env_tag, study_config[env_tag]['redcap-spec']
+
+def prefetch(study_tag, handler_tag, record_ids):
+  '''Fetch several records in one export call and hold them for go.
+  Returns the number of records fetched.'''
+  record_ids = sorted(set(str(r) for r in record_ids))
+  if not record_ids:
+    return 0
+  _, redcap_spec = _redcap_spec(study_tag, handler_tag)
+  fetched_at = time.time()
+  rows = redcap_export.export_records(
+           redcap_spec, fields=batch_cfg.get('fields', INTAKE_FIELDS),
+           records=record_ids)
+  by_record = defaultdict(list)
+  for row in rows:
+    by_record[str(row.get('record_id'))].append(row)
+  for record_id in record_ids:
+    # A record with no rows was deleted; leave it to go to find out.
+    if by_record.get(record_id):
+      prefetched.put((handler_tag, record_id),
+                     (fetched_at, by_record[record_id]))
+  log.info('Prefetched {} of {} record(s) for {} in one export.'.format(
+           len(by_record), len(record_ids), handler_tag))
+  return len(by_record)
+
+def _fresh(request, entry):
+  return (entry is not ttlcache.MISSING
+          and entry[0] >= request.get('received-at', float('inf')))
+
+def has_prefetched(request):
+  '''Is there a usable prefetched record for the request?'''
+  k = (request['handler-tag'], str(request['record-id']))
+  return _fresh(request, prefetched.get(k))
+
+def _take_prefetched(request):
+  '''A prefetched record for the request that's at least as new as the
+  DET, or None.'''
+  k = (request['handler-tag'], str(request['record-id']))
+  entry = prefetched.get(k)
+  if entry is ttlcache.MISSING:
+    return None
+  prefetched.invalidate(k)
+  return entry[1] if _fresh(request, entry) else None
+
 #------------------------------------------------------------------------------
 
 def go(request):
@@ -25,16 +105,22 @@ def go(request):
     # Do a bit of setup. (redcap_handler_template should have loaded several
     # bits of pertinent data into the request map.)
     study_tag = request['study-tag']
-    study_config = common.get_study_config(study_tag)
-    env_tag = study_config['handler-tag-to-env-tag'][request['handler-tag']]
-
-    redcap_spec = study_config[env_tag]['redcap-spec']
+    env_tag, redcap_spec = _redcap_spec(study_tag, request['handler-tag'])
     record_id = request['record-id']
 
-    # Call REDCap API and retrieve full record.
-    record = redcaplib.get_full_record(redcap_spec, record_id)
-    log.info('Retrieved full record from REDCap API for record id of: ['
-             + str(record_id) + ']')
+    # Use a record fetched in a batch (see prefetch above), or call REDCap
+    # API and retrieve full record.
+    record = _take_prefetched(request)
+    if record is not None:
+      log.info('Using prefetched record for record id of: ['
+               + str(record_id) + ']')
+    else:
+      # Same export redcaplib.get_full_record does, but on httpclient's
+      # pooled connections.
+      record = redcap_export.export_records(redcap_spec,
+                                            records=[record_id])
+      log.info('Retrieved full record from REDCap API for record id of: ['
+               + str(record_id) + ']')
 
     # Load new information into request for downstream use.
     request['env-tag'] = env_tag
@@ -47,3 +133,9 @@ def go(request):
     log.error('Exception caught: ' + str(e))
     raise e
 
+# For use in a workflow_dag.Dag. Only reads from REDCap.
+STAGE = workflow_dag.stage(go,
+                           reads=['study-tag', 'handler-tag', 'record-id'],
+                           writes=['env-tag', 'full-record'],
+                           pure=True)
+
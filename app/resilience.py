@@ -0,0 +1,227 @@
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+'''
+===============================================================================
+
+-----------------------
+      resilience
+-----------------------
+
+Circuit breakers and bulkheads for calls to outside services (OnCore, the
+AoU API, REDCap), so that one slow or failing dependency can't tie up
+every request thread.
+
+Wrap each call in the dependency's guard:
+
+    with resilience.guard('oncore').call():
+      demographics = oncore.get_subject_data(oncore_spec, mrn)
+
+  o Bulkhead: at most max_concurrent calls to the dependency at once.
+    A caller waits up to wait_seconds for a slot, then gives up.
+  o Circuit breaker: after failure_threshold consecutive failures (the
+    call raised an exception that counts -- see below), the circuit opens
+    and calls fail immediately for reset_seconds. Then one trial call is
+    let through: if it succeeds the circuit closes, otherwise it opens
+    again.
+
+Not every exception means the dependency is down: a 4xx for a bad
+participant ID is an answer. Pass call() a predicate, counts(exception),
+saying which exceptions count as failures (e.g. httpclient.is_outage:
+transport errors and 5xx responses); other exceptions still propagate but
+count as successful calls. Without one, every exception counts.
+
+When the bulkhead or breaker turns a call away, the caller gets
+DependencyUnavailable -- without the call being
+made -- and its retry_after says when trying again makes sense. For an
+open circuit, its since says when the outage began: the time the circuit
+first opened, the same for every rejection until it closes again (e.g. to
+alert once per outage).
+redcap_handler_template turns that into a 503 (direct mode) or puts the DET
+back in the queue (queued mode), rather than treating it as an error.
+
+guard(name) makes each dependency's guard on first use, with settings from
+configure (main passes the "dependency-guards" map from
+transmitter-config.json) or the defaults below.
+
+===============================================================================
+'''
+
+DEFAULTS = {'max-concurrent': 8
+           ,'wait-seconds': 5
+           ,'failure-threshold': 5
+           ,'reset-seconds': 60}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class DependencyUnavailable(RuntimeError):
+
+  def __init__(self, dependency, reason, retry_after, since=None):
+    RuntimeError.__init__(self, '{} unavailable: {}'.format(dependency,
+                                                            reason))
+    self.dependency = dependency
+    self.reason = reason
+    self.retry_after = retry_after
+    self.since = since
+
+class CircuitBreaker(object):
+
+  def __init__(self, failure_threshold=5, reset_seconds=60):
+    self.failure_threshold = failure_threshold
+    self.reset_seconds = reset_seconds
+    self.state = CLOSED
+    self.failures = 0
+    self.opened_at = 0
+    self.outage_started = None # When it last opened from closed.
+    self._trial_running = False
+    self._lock = threading.Lock()
+
+  def allow(self):
+    '''Returns (wait, trial): wait is 0 if a call may go ahead, else the
+    seconds until it may; trial is True if this caller was given the
+    half-open trial slot, which it must hand back (by reporting success
+    or failure, or with release_trial) when done.'''
+    with self._lock:
+      if self.state == CLOSED:
+        return 0, False
+      remaining = self.opened_at + self.reset_seconds - time.time()
+      if remaining > 0:
+        return remaining, False
+      if self._trial_running:
+        return self.reset_seconds, False
+      self.state = HALF_OPEN
+      self._trial_running = True
+      return 0, True
+
+  def release_trial(self):
+    '''Hand back a trial slot without having made the call; the next
+    caller gets to make the trial instead.'''
+    with self._lock:
+      self._trial_running = False
+
+  def success(self):
+    with self._lock:
+      self.state = CLOSED
+      self.failures = 0
+      self.outage_started = None
+      self._trial_running = False
+
+  def failure(self):
+    with self._lock:
+      self.failures += 1
+      self._trial_running = False
+      if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+        if self.outage_started is None:
+          self.outage_started = time.time()
+        self.state = OPEN
+        self.opened_at = time.time()
+
+class Bulkhead(object):
+
+  def __init__(self, max_concurrent=8):
+    self.max_concurrent = max_concurrent
+    self.in_use = 0
+    self._cond = threading.Condition()
+
+  def acquire(self, wait_seconds):
+    '''Take a slot, waiting up to wait_seconds. Returns False if none
+    came free in time.'''
+    deadline = time.time() + wait_seconds
+    with self._cond:
+      while self.in_use >= self.max_concurrent:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+      self.in_use += 1
+      return True
+
+  def release(self):
+    with self._cond:
+      self.in_use -= 1
+      self._cond.notify()
+
+#------------------------------------------------------------------------------
+
+REJECTIONS = metrics.counter('transmitter_dependency_rejections_total',
+                             'Calls not made because a dependency was '
+                             'unavailable, by reason (circuit-open, '
+                             'bulkhead-full).', ['dependency', 'reason'])
+
+class Guard(object):
+
+  def __init__(self, name, cfg=None):
+    cfg = dict(DEFAULTS, **(cfg or {}))
+    self.name = name
+    self.wait_seconds = cfg['wait-seconds']
+    self.breaker = CircuitBreaker(cfg['failure-threshold'],
+                                  cfg['reset-seconds'])
+    self.bulkhead = Bulkhead(cfg['max-concurrent'])
+
+  def _reject(self, reason, retry_after, since=None):
+    REJECTIONS.inc((self.name, reason))
+    raise DependencyUnavailable(self.name, reason, retry_after, since)
+
+  @contextmanager
+  def call(self, counts=None):
+    '''Guard the with block. counts(exception), if given, says whether an
+    exception raised in the block counts as a failure of the dependency.'''
+    wait, trial = self.breaker.allow()
+    if wait:
+      self._reject('circuit-open', wait, self.breaker.outage_started)
+    if not self.bulkhead.acquire(self.wait_seconds):
+      # Hand back the trial slot, if it's ours; we won't be using it.
+      if trial:
+        self.breaker.release_trial()
+      self._reject('bulkhead-full', self.wait_seconds)
+    try:
+      yield
+    except Exception:
+      if counts is None or counts(sys.exc_info()[1]):
+        self.breaker.failure()
+      else:
+        self.breaker.success()
+      raise
+    else:
+      self.breaker.success()
+    finally:
+      self.bulkhead.release()
+
+_cfg = {}
+_guards = {}
+_guards_lock = threading.Lock()
+
+def configure(cfg):
+  '''Per-dependency settings: name -> map of DEFAULTS keys. Applies to
+  guards made after this call.'''
+  _cfg.clear()
+  _cfg.update(cfg or {})
+
+def guard(name):
+  with _guards_lock:
+    g = _guards.get(name)
+    if g is None:
+      g = Guard(name, _cfg.get(name))
+      _guards[name] = g
+    return g
+
+def _guards_snapshot():
+  with _guards_lock:
+    return list(_guards.values())
+
+metrics.gauge_func('transmitter_dependency_circuit_open',
+                   '1 if the dependency\'s circuit is open (or half-open).',
+                   lambda: dict(((g.name,), int(g.breaker.state != CLOSED))
+                                for g in _guards_snapshot()),
+                   ['dependency'])
+metrics.gauge_func('transmitter_dependency_in_flight',
+                   'Calls to the dependency in progress.',
+                   lambda: dict(((g.name,), g.bulkhead.in_use)
+                                for g in _guards_snapshot()),
+                   ['dependency'])
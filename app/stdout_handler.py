@@ -1,11 +1,11 @@
 import sys
-import redcaplib as rc
+import det
 
 __all__ = ['handle']
 
 def handle(req):
   try:
-    pyld = rc.parse_det_payload(req.get('data','')) 
+    pyld = det.from_request(req)
     print 'Request:'
     print str(req)
     print 'DET payload:'
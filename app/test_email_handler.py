@@ -1,6 +1,6 @@
 import sys
 import kickshaws as ks
-import redcaplib as rc
+import det
 from common import *
 
 __all__ = ['handle']
@@ -12,13 +12,13 @@ log = ks.smart_logger()
 
 def handle(req):
   try:
-    pyld = rc.parse_det_payload(req['data']) 
-    log.info('Parsed contents of DET payload: ' + str(pyld))
+    pyld = det.from_request(req)
+    log.info('Parsed contents of DET payload: ' + str(pyld.raw))
     msg = 'Received trigger payload from REDCap. Details: \n' \
           'REDCap Server IP: {} \n' \
           'Project ID: {} \n' \
           'Record ID: {} \n' \
-          ''.format(req['client_ip'], pyld['project_id'], pyld['record'])
+          ''.format(req['client_ip'], pyld.project_id, pyld.record)
     log.info('Sending email, body is: \n' + msg)
     ks.send_email(FROM_EMAIL, TO_EMAIL, 'Transmitter Test Email', msg)
     return {'status': 200}
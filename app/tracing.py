@@ -0,0 +1,104 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import kickshaws as ks
+import metrics
+
+'''
+===============================================================================
+
+-----------------------
+        tracing
+-----------------------
+
+Span timing for workflow chains and the external calls made inside them.
+
+  o trace(request) -- used by common.run_workflow_chain -- starts collecting
+    spans for the current thread. When it ends, the spans are put into the
+    request under 'timings' (a list of {'span': name, 'ms': elapsed}, in
+    the order they finished) and a single structured (JSON) log line
+    summarizes the chain.
+  o span(name) times a block. The result is added to the current thread's
+    trace, if there is one, and always to that name's latency histogram.
+    Span names in use:
+      workflow.<module>.<function>   each workflow in a chain
+      redcap.<call>, aou.<call>, oncore.<call>   external API calls
+      db.<operation>                  datastore backend calls
+  o histograms() returns the aggregated latency histograms, by span name.
+    They're also exported at /metrics as transmitter_span_duration_seconds.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+TIMINGS_KEY = 'timings'
+
+# Latency of every span, in seconds, labelled by span name.
+SPAN_SECONDS = metrics.histogram('transmitter_span_duration_seconds',
+                                 'Time spent in a workflow or external call.',
+                                 ['span'])
+
+def histograms():
+  '''span name -> histogram snapshot (count, sum in seconds, cumulative
+  buckets) for every span name seen so far.'''
+  return dict((labels[0], SPAN_SECONDS.snapshot(labels))
+              for labels in SPAN_SECONDS.label_sets())
+
+#------------------------------------------------------------------------------
+
+_local = threading.local()
+
+def current_spans():
+  '''The span list being collected on this thread, or None.'''
+  return getattr(_local, 'spans', None)
+
+@contextmanager
+def span(name):
+  start = time.time()
+  try:
+    yield
+  finally:
+    secs = time.time() - start
+    SPAN_SECONDS.observe(secs, (name,))
+    spans = current_spans()
+    if spans is not None:
+      spans.append({'span': name, 'ms': round(secs * 1000, 2)})
+
+@contextmanager
+def attached(spans):
+  '''Add spans to another thread's trace (as returned by current_spans)
+  -- for work done on its behalf, e.g. on a pool thread.'''
+  outer = current_spans()
+  _local.spans = spans
+  try:
+    yield
+  finally:
+    _local.spans = outer
+
+@contextmanager
+def trace(request):
+  '''Collect spans on this thread for the duration of a workflow chain.'''
+  outer = current_spans()
+  spans = []
+  _local.spans = spans
+  start = time.time()
+  try:
+    yield spans
+  finally:
+    _local.spans = outer
+    total_ms = round((time.time() - start) * 1000, 2)
+    request[TIMINGS_KEY] = spans
+    log.info(json.dumps({'event': 'workflow-chain-timing'
+                        ,'handler-tag': request.get('handler-tag')
+                        ,'record-id': request.get('record-id')
+                        ,'total-ms': total_ms
+                        ,'spans': spans}))
+
+def workflow_name(f):
+  '''A readable name for a workflow function (or a partial of one).'''
+  f = getattr(f, 'func', f)
+  return '{}.{}'.format(getattr(f, '__module__', '?'),
+                        getattr(f, '__name__', repr(f)))
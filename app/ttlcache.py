@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+'''
+===============================================================================
+
+-----------------------
+        ttlcache
+-----------------------
+
+A thread-safe in-memory cache with LRU eviction and per-entry expiry.
+
+  o At most `max_entries` entries are kept; adding one more evicts the
+    least recently used.
+  o An entry older than `ttl_seconds` is treated as absent (and dropped).
+  o `hits` and `misses` count lookups, for monitoring.
+
+get() returns the MISSING sentinel (not None) when there is no usable entry,
+so that None itself can be cached -- e.g., to remember that a key is absent.
+
+Filling from a slow source can race a write: a reader fetches the old
+value, a writer puts the new one, then the reader caches the old one. To
+avoid that, take version() before fetching and fill with
+put_if_unchanged(); the fill is skipped if the key was written (put,
+update_if_present or invalidate) since. The last write of the most recent
+`max_entries` keys is remembered for this; a fill older than what's
+remembered is skipped too.
+
+===============================================================================
+'''
+
+MISSING = object()
+
+class TTLCache(object):
+
+  def __init__(self, max_entries=10000, ttl_seconds=300):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict() # key -> (stored_at, value)
+    self._version = 0 # Bumped by every write.
+    self._written = OrderedDict() # key -> version of its last write
+    self._forgotten = 0 # Latest version dropped from _written.
+    self._lock = Lock()
+
+  def get(self, k):
+    with self._lock:
+      entry = self._data.pop(k, None)
+      if entry is None or time.time() - entry[0] > self.ttl_seconds:
+        self.misses += 1
+        return MISSING
+      # Re-insert to mark as most recently used.
+      self._data[k] = entry
+      self.hits += 1
+      return entry[1]
+
+  def put(self, k, v):
+    with self._lock:
+      self._note_write(k)
+      self._store(k, v)
+
+  def version(self):
+    '''Take before fetching a value to fill with; see put_if_unchanged.'''
+    with self._lock:
+      return self._version
+
+  def put_if_unchanged(self, k, v, since):
+    '''Put, unless k was written after version() returned since.
+    Returns whether v was stored.'''
+    with self._lock:
+      written = self._written.get(k, self._forgotten)
+      if written > since:
+        return False
+      self._store(k, v)
+      return True
+
+  def update_if_present(self, k, f):
+    '''Replace a live entry's value with f(value), keeping its age.
+    Does nothing if there's no live entry.'''
+    with self._lock:
+      self._note_write(k)
+      entry = self._data.get(k)
+      if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+        self._data[k] = (entry[0], f(entry[1]))
+
+  def invalidate(self, k):
+    with self._lock:
+      self._note_write(k)
+      self._data.pop(k, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self._written.clear()
+      self._version += 1
+      self._forgotten = self._version
+
+  def _store(self, k, v):
+    self._data.pop(k, None)
+    self._data[k] = (time.time(), v)
+    while len(self._data) > self.max_entries:
+      self._data.popitem(last=False)
+
+  def _note_write(self, k):
+    self._version += 1
+    self._written.pop(k, None)
+    self._written[k] = self._version
+    while len(self._written) > self.max_entries:
+      self._forgotten = self._written.popitem(last=False)[1]
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits
+             ,'misses': self.misses
+             ,'entries': len(self._data)}
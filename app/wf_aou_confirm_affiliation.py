@@ -1,10 +1,17 @@
 from __future__ import division
 from __future__ import print_function
+import json
+import time
 import traceback
 import aoulib
 import kickshaws as ks
 import datastore as store
 import common
+import tracing
+import aou_session
+import httpclient
+import resilience
+import workflow_dag
 
 '''
 ================================
@@ -18,6 +25,16 @@ we return the request unmodified, allowing the workflow chain to continue;
 if not (or if we can't confirm), we short-circuit the workflow chain, ending
 it immediately (via the common.finalize function), b/c Transmitter should not
 process non-WCM participants.
+
+When the AoU API answers but can't settle it either (organization unset,
+or no such participant), we note that under 'aou-wcm-paired-recheck' --
+the PMI ID checked, the time of the next allowed API check and the number
+of misses so far -- and until then DETs for the record bail without
+calling the API, unless the record's PMI ID has changed (e.g. a typo was
+fixed). The wait starts at "base-minutes" and doubles with each miss, up
+to "max-minutes" (see "aou-unknown-recheck" in transmitter-config.json).
+If the API didn't answer (an outage, or an error we can't put down to the
+PMI ID), the DET bails but nothing is noted, so the next DET tries again.
 '''
 
 log = ks.smart_logger()
@@ -26,6 +43,17 @@ AOU_WCM_PAIRED = 'aou-wcm-paired'
 YES = 'yes'
 NO = 'no'
 UNKNOWN = 'unknown'
+UNANSWERED = 'unanswered' # The AoU API call failed; see _aou_api_is_wcm_paired.
+
+PMI_ID_FIELD = 'pmi_id_test' # REDCap field holding the participant's PMI ID.
+
+# Negative cache for UNKNOWN results; value is JSON: {"pmi-id": PMI ID,
+# "next": epoch seconds, "misses": n}.
+AOU_WCM_PAIRED_RECHECK = 'aou-wcm-paired-recheck'
+
+recheck_cfg = common.get_app_config().get('aou-unknown-recheck', {})
+RECHECK_BASE_SECONDS = recheck_cfg.get('base-minutes', 60) * 60
+RECHECK_MAX_SECONDS = recheck_cfg.get('max-minutes', 1440) * 60
 
 #------------------------------------------------------------------------------
 
@@ -41,59 +69,117 @@ def _rc_is_wcm_paired(rcd):
     log.info('out')
     return UNKNOWN
 
-def _db_is_wcm_paired(redcap_server_tag, pid, record_id):
+def _db_is_wcm_paired(redcap_server_tag, pid, record_id, snap=None):
   '''Does database/cache indicate participant is WCM paired?
   (Or confirm participant is *not* paired?) 
+  Reads from snap (the request's datastore snapshot) if given.
   Returns YES / NO / UNKNOWN.'''
   log.info('in')
-  rslt = None
-  if store.key_exists(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED):
-    rslt = store.get_latest_value(redcap_server_tag, pid,
-                                  record_id, AOU_WCM_PAIRED)
-    # If exists, should always be 'yes' or 'no', but let's be safe.
-    rslt = rslt if rslt in (YES, NO) else UNKNOWN
-  else:
-    rslt = UNKNOWN
+  rslt = store.get_latest_or_none(redcap_server_tag, pid,
+                                 record_id, AOU_WCM_PAIRED, snap)
+  # If exists, should always be 'yes' or 'no', but let's be safe.
+  # (Absent comes back as None, which also maps to UNKNOWN.)
+  rslt = rslt if rslt in (YES, NO) else UNKNOWN
   log.info('out')
   return rslt
 
+def pairing_for_org(org):
+  '''Map an AoU API 'organization' value to YES / NO / UNKNOWN.'''
+  if org == 'COLUMBIA_WEILL':
+    return YES
+  if org != 'UNSET' and org != '':
+    return NO
+  return UNKNOWN
+
+def _api_answered(ex):
+  '''Did the AoU API answer (about this participant) despite raising?
+  True for a 4xx response other than auth errors and throttling -- e.g.
+  for an invalid PMI ID.'''
+  status = getattr(getattr(ex, 'response', None), 'status_code', None)
+  return (status is not None and 400 <= status < 500
+          and status not in (401, 403, 408, 429))
+
 def _aou_api_is_wcm_paired(pmi_id):
   '''Does AoU Data Ops API indicate participant is WCM paired?
   (Or confirm participant is *not* paired?) 
-  Returns YES / NO / UNKNOWN.'''
+  Returns YES / NO / UNKNOWN, or UNANSWERED if the API call failed
+  (see _api_answered).'''
   log.info('in')
   if type(pmi_id) not in (str, unicode):
     raise TypeError('pmi_id must be str or unicode')
-  aou_api_spec = ks.slurp_json('enclave/aou-api-spec.json')
-  sess = aoulib.make_authed_session(aou_api_spec['path-to-key-file'])
-  rslt = UNKNOWN
+  aou_api_spec = aou_session.spec()
+  # The guard (see resilience) raises DependencyUnavailable, which we let
+  # through, if the AoU API is failing or saturated. Only outages (see
+  # httpclient.is_outage) count toward that; an error for a bad PMI ID
+  # doesn't.
+  with resilience.guard('aou').call(httpclient.is_outage):
+    sess = aou_session.session() # Shared and kept fresh; see aou_session.
   try: 
     param = {'participantId': pmi_id[1:]} # Chop 'P' from front of ID.
-    api_data = aoulib.get_records(aou_api_spec, sess, param) # can throw
-    if len(api_data) == 1:
-      api_rcd = api_data[0]
-      org = api_rcd.get('organization', '')
-      if org == 'COLUMBIA_WEILL':
-        rslt = YES
-      elif org != 'UNSET' and org != '':
-        rslt = NO
-      # else stays as UNKNOWN
-    else:
-      raise Exception('Expected one row from API but didn\'t get that.')
+    with resilience.guard('aou').call(httpclient.is_outage), \
+         tracing.span('aou.get_records'):
+      try:
+        api_data = aoulib.get_records(aou_api_spec, sess, param) # can throw
+      except Exception, ex:
+        aou_session.invalidate_if_auth_error(ex)
+        raise
+  except resilience.DependencyUnavailable:
+    log.info('out')
+    raise
   except Exception, ex:
     log.error('aoulib error. Could PMI ID be invalid? Details: {}'\
               ''.format(traceback.format_exc()))
-  finally:
     log.info('out')
-    return rslt
+    return UNKNOWN if _api_answered(ex) else UNANSWERED
+  # The API answered. No row (or several) for the PMI ID is an answer too:
+  # UNKNOWN, not UNANSWERED.
+  if len(api_data) == 1:
+    rslt = pairing_for_org(api_data[0].get('organization', ''))
+  else:
+    log.info('Expected one row from API; got {}.'.format(len(api_data)))
+    rslt = UNKNOWN
+  log.info('out')
+  return rslt
 
 #------------------------------------------------------------------------------
 
-def _cache_as_paired(redcap_server_tag, pid, record_id):
-  return store.put(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED, YES)
+def _cache_as_paired(redcap_server_tag, pid, record_id, snap=None):
+  return store.put(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED, YES,
+                   snap)
+
+def _cache_as_not_paired(redcap_server_tag, pid, record_id, snap=None):
+  return store.put(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED, NO,
+                   snap)
+
+def _recheck_state(redcap_server_tag, pid, record_id, snap=None):
+  '''The stored negative-cache entry as a map (next, misses), or None.'''
+  raw = store.get_latest_or_none(redcap_server_tag, pid, record_id,
+                                 AOU_WCM_PAIRED_RECHECK, snap)
+  try:
+    return json.loads(raw) if raw else None
+  except ValueError:
+    return None
+
+def _api_check_due(redcap_server_tag, pid, record_id, pmi_id, snap=None):
+  '''True unless the last check of this same PMI ID came back UNKNOWN and
+  its wait isn't over.'''
+  state = _recheck_state(redcap_server_tag, pid, record_id, snap)
+  return (state is None or state.get('pmi-id') != pmi_id
+          or time.time() >= state.get('next', 0))
 
-def _cache_as_not_paired(redcap_server_tag, pid, record_id):
-  return store.put(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED, NO)
+def _cache_as_unknown(redcap_server_tag, pid, record_id, pmi_id, snap=None):
+  '''Record another miss for pmi_id and push back the next API check.
+  (Misses for a different, earlier PMI ID don't count.)'''
+  state = _recheck_state(redcap_server_tag, pid, record_id, snap) or {}
+  if state.get('pmi-id') != pmi_id:
+    state = {}
+  misses = state.get('misses', 0) + 1
+  wait = min(RECHECK_BASE_SECONDS * 2 ** (misses - 1), RECHECK_MAX_SECONDS)
+  return store.put(redcap_server_tag, pid, record_id, AOU_WCM_PAIRED_RECHECK,
+                   json.dumps({'pmi-id': pmi_id,
+                               'next': int(time.time() + wait),
+                               'misses': misses}),
+                   snap)
 
 #------------------------------------------------------------------------------
 
@@ -102,6 +188,7 @@ def go(request):
   log.info('in')
   redcap_server_tag = request['redcap-server-tag']
   pid = request['pid']
+  snap = request.get('datastore-snapshot')
   # In newer REDCap versions, sometimes the record is a list;
   # in that case, we only want first element of the list.
   record = {}
@@ -111,7 +198,7 @@ def go(request):
     record = request['full-record']
   record_id = record['record_id']
   # Has PMI ID? Bail if not.
-  pmi_id = record.get('pmi_id_test', '')
+  pmi_id = record.get(PMI_ID_FIELD, '')
   if pmi_id == '':
     log.info('record_id=[{}]; No PMI ID. Bail.'.format(record_id))
     log.info('out')
@@ -125,7 +212,7 @@ def go(request):
     log.info('out')
     return common.finalize(request)
   # 2/3: Check DB.
-  rslt = _db_is_wcm_paired(redcap_server_tag, pid, record_id)
+  rslt = _db_is_wcm_paired(redcap_server_tag, pid, record_id, snap)
   if rslt == YES:
     log.info('record_id=[{}]: db indicates WCM pairing. Continue.'\
              ''.format(record_id))
@@ -136,18 +223,24 @@ def go(request):
              ''.format(record_id))
     log.info('out')
     return common.finalize(request)
-  # 3/3: Check AoU API and potentially cache result in DB.
+  # 3/3: Check AoU API (unless a recent check came back UNKNOWN) and
+  # potentially cache result in DB.
+  if not _api_check_due(redcap_server_tag, pid, record_id, pmi_id, snap):
+    log.info('#reconciliation Affiliation still unknown for record ID: {}'\
+             '; not due for another API check. Bail.'.format(record_id))
+    log.info('out')
+    return common.finalize(request)
   rslt = _aou_api_is_wcm_paired(pmi_id)
   if rslt == YES:
     log.info('record_id=[{}]: AoU API indicates WCM pairing. Continue.'\
              ''.format(record_id))
-    _cache_as_paired(redcap_server_tag, pid, record_id)
+    _cache_as_paired(redcap_server_tag, pid, record_id, snap)
     log.info('out')
     return request
   if rslt == NO:
     log.info('record_id=[{}]: AoU API indicates non-WCM pairing. Bail.'\
              ''.format(record_id))
-    _cache_as_not_paired(redcap_server_tag, pid, record_id)
+    _cache_as_not_paired(redcap_server_tag, pid, record_id, snap)
     log.info('out')
     return common.finalize(request)
   if rslt == UNKNOWN:
@@ -155,7 +248,19 @@ def go(request):
     # but we can't find a pairing. Do not proceed w/ wf chain.
     log.info('#reconciliation Could not determine affiliation for record ID: {}'\
              '. Bail.'.format(record_id))
+    _cache_as_unknown(redcap_server_tag, pid, record_id, pmi_id, snap)
+    log.info('out')
+    return common.finalize(request)
+  if rslt == UNANSWERED:
+    # No answer to go on; bail, and let the next DET try the API again.
+    log.info('#reconciliation AoU API call failed for record ID: {}'\
+             '. Bail.'.format(record_id))
     log.info('out')
     return common.finalize(request)
   raise Exception # Should never get here.
 
+# For use in a workflow_dag.Dag. Updates the snapshot when it caches a
+# result, and may end the chain.
+STAGE = workflow_dag.stage(go, reads=['full-record', 'datastore-snapshot'],
+                           writes=['datastore-snapshot'], may_finish=True)
+
@@ -0,0 +1,44 @@
+from __future__ import division
+from __future__ import print_function
+
+import kickshaws as ks
+import datastore as store
+import workflow_dag
+
+'''
+===========================
+Datastore Snapshot Workflow
+===========================
+
+Loads the latest value of every datastore key for the current record in a
+single query, and puts it into the request under 'datastore-snapshot'.
+Downstream workflows pass that map to the datastore flag functions (and
+their own predicates) so that flag checks are read from memory instead of
+costing a query each. Writes made through those functions keep the map
+current for the rest of the chain.
+
+Place this workflow after redcap_intake_workflow (it needs
+'redcap-server-tag', 'pid' and 'record-id', which redcap_handler_template
+loads into the request).
+'''
+
+__all__ = ['go', 'STAGE']
+
+log = ks.smart_logger()
+
+SNAPSHOT_KEY = 'datastore-snapshot'
+
+def go(request):
+  log.info('in')
+  request[SNAPSHOT_KEY] = store.snapshot(request['redcap-server-tag'],
+                                         request['pid'],
+                                         request['record-id'])
+  log.info('record_id=[{}]; loaded {} datastore key(s).'\
+           ''.format(request['record-id'], len(request[SNAPSHOT_KEY])))
+  log.info('out')
+  return request
+
+# For use in a workflow_dag.Dag. Only reads from the datastore, so it can
+# run alongside redcap_intake_workflow.
+STAGE = workflow_dag.stage(go, reads=['redcap-server-tag', 'pid', 'record-id'],
+                           writes=[SNAPSHOT_KEY], pure=True)
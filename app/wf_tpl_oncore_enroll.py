@@ -1,11 +1,17 @@
 from __future__ import division
 from __future__ import print_function
 
+from functools import partial
+
 import kickshaws as ks
 import oncorelib as oncore
 
 import common
 import datastore as store
+import flexmatch
+import tracing
+import resilience
+import ttlcache
 
 __all__ = ['compose']
 
@@ -36,33 +42,9 @@ def simple_compare(d1, d2):
   return True
 
 def flexmatch_algo(d1, d2):
-  '''Flexmatch algorithm for demographics comparison.
-  d1 and d2 should be maps with (at least) the following keys:
-    o first-name
-    o last-name
-    o birthdate as a string formatted yyyy-mm-dd
-      (REDCap data will be formmatted like this; the oncorelib
-      applies this formatting before returning subject data.)
-  Returns a confidence level as int from 0 to 3 (inclusive).
-    o 3: first, last, and dob match.
-    o 2: first and last mostly match, dob match.
-    o 1: first and/or last significant  mismatch, dob match.
-    o 0: dob mismatch (other values not checked).
-  '''
-  if d1['dob'] != d2['dob']:
-    return 0
-  # Otherwise, dobs match.
-  if (d1['first-name'].lower() == d2['first-name'].lower()
-      and d1['last-name'].lower() == d2['last-name'].lower()):
-    # All three demographic elements match.
-    return 3
-  if ( (d1['first-name'].lower() in d2['first-name'].lower()
-        or d2['first-name'].lower() in d1['first-name'].lower())
-       and
-       (d1['last-name'].lower() in d2['last-name'].lower()
-        or d2['last-name'].lower() in d1['last-name'].lower()) ):
-    return 2
-  return 1
+  '''Confidence level (0 to 3) that d1 and d2 (maps with first-name,
+  last-name and birthdate) are the same person; see flexmatch.confidence.'''
+  return flexmatch.confidence(d1, d2)
 
 def sufficient_confidence(request, retrieved_demographics):
   '''Predicate'''
@@ -80,7 +62,7 @@ def sufficient_confidence(request, retrieved_demographics):
          zip(['first-name', 'last-name', 'birthdate'],
              [record['name_first'], record['name_last'], record['dob']]))
   return (flexmatch_algo(d1, retrieved_demographics)
-          == FLEXMATCH_MIN_CONFIDENCE)
+          >= FLEXMATCH_MIN_CONFIDENCE)
 
 #------------------------------------------------------------------------------
 # datastore
@@ -90,16 +72,103 @@ JIRA_ENROLLMENT_TICKET_KEY = 'jira-enrollment-ticket-created'
 ONCORE_REGISTERED_KEY = 'enrollment-registered-in-oncore'
 YES = 'yes'
 
+# What _go did, left in the request under OUTCOME_KEY (e.g. for
+# oncore_backlog's report).
+OUTCOME_KEY = 'oncore-registration'
+REGISTERED = 'registered'
+NOT_FOUND = 'not-found'
+MISMATCH = 'mismatch'
+NO_ACTION = 'no-action'
+
 # reconciliation flags
 ONCORE_DEMOGRAPHICS_NOT_FOUND = 'oncore-demographics-not-found'
 DEMOGRAPHICS_MISMATCH = 'demographics-mismatch'
 
-def clear_all_recon_flags(redcap_server_tag, project_id, record_id):
+def clear_all_recon_flags(redcap_server_tag, project_id, record_id,
+                          snap=None):
   '''Clear all reconciliation flags in one fell swoop.'''
   store.unset_flag_if_set(redcap_server_tag, project_id, record_id,
-                          ONCORE_DEMOGRAPHICS_NOT_FOUND)
+                          ONCORE_DEMOGRAPHICS_NOT_FOUND, snap)
   store.unset_flag_if_set(redcap_server_tag, project_id, record_id,
-                          DEMOGRAPHICS_MISMATCH) 
+                          DEMOGRAPHICS_MISMATCH, snap) 
+
+#------------------------------------------------------------------------------
+# OnCore availability.
+
+# SOAP fault classes (suds, zeep): OnCore processed the call and refused it.
+SOAP_FAULTS = ('WebFault', 'Fault')
+
+def oncore_is_outage(ex):
+  '''Does an exception from oncorelib mean OnCore is down, rather than
+  that it answered with an error? Predicate for the 'oncore' guard (see
+  resilience). oncorelib talks SOAP over its own transport, so its
+  failures (urllib2.URLError, socket errors and timeouts, httplib errors,
+  the SOAP client's transport errors...) aren't the requests exceptions
+  httpclient.is_outage knows. Anything counts except a SOAP fault or an
+  error carrying a response below 500.'''
+  status = getattr(getattr(ex, 'response', None), 'status_code', None)
+  if status is not None:
+    return status >= 500
+  return not any(cls.__name__ in SOAP_FAULTS for cls in type(ex).__mro__)
+
+#------------------------------------------------------------------------------
+# OnCore demographics cache.
+# Optional ("oncore-demographics-cache" in transmitter-config.json). The
+# result of an OnCore lookup -- (exists, subject number, prepared
+# demographics) -- is kept in memory, keyed by (env tag, MRN), so records
+# stuck on a reconciliation flag don't cost an OnCore round trip on every
+# edit. Found subjects are kept for ttl-seconds; "not found" results only
+# for not-found-ttl-seconds, so that adding the subject in OnCore is
+# picked up soon. The entry is dropped once registration succeeds. It's
+# memory only: demographics are PHI, and the datastore keeps history.
+
+demographics_cache_cfg = common.get_app_config().get(
+                           'oncore-demographics-cache', {})
+
+demographics_cache = None
+not_found_cache = None
+if demographics_cache_cfg.get('enabled', False):
+  demographics_cache = ttlcache.TTLCache(
+                         max_entries=demographics_cache_cfg.get('max-entries',
+                                                                5000),
+                         ttl_seconds=demographics_cache_cfg.get('ttl-seconds',
+                                                                3600))
+  not_found_cache = ttlcache.TTLCache(
+                      max_entries=demographics_cache_cfg.get('max-entries',
+                                                             5000),
+                      ttl_seconds=demographics_cache_cfg.get(
+                                    'not-found-ttl-seconds', 300))
+
+def _fetch_demographics(oncore_spec, mrn):
+  with resilience.guard('oncore').call(oncore_is_outage), \
+       tracing.span('oncore.get_subject_data'):
+    demographics = oncore.get_subject_data(oncore_spec, mrn)
+  if not oncore.subject_record_exists(demographics):
+    return (False, None, None)
+  return (True, oncore.extract_subject_num(demographics),
+          oncore.prep_subject_data(demographics))
+
+def lookup_demographics(env_tag, oncore_spec, mrn):
+  '''(exists, subject number, prepared demographics) for the MRN, from
+  the cache if enabled, else from OnCore.'''
+  if demographics_cache is None:
+    return _fetch_demographics(oncore_spec, mrn)
+  k = (env_tag, str(mrn))
+  for cache in (demographics_cache, not_found_cache):
+    rslt = cache.get(k)
+    if rslt is not ttlcache.MISSING:
+      log.info('OnCore demographics lookup from cache.')
+      return rslt
+  rslt = _fetch_demographics(oncore_spec, mrn)
+  (demographics_cache if rslt[0] else not_found_cache).put(k, rslt)
+  return rslt
+
+def forget_demographics(env_tag, mrn):
+  '''Drop the cached lookup for the MRN (e.g. once registered).'''
+  if demographics_cache is None:
+    return
+  demographics_cache.invalidate((env_tag, str(mrn)))
+  not_found_cache.invalidate((env_tag, str(mrn)))
 
 #------------------------------------------------------------------------------
 
@@ -108,35 +177,33 @@ def _go(redcap_server_tag, project_id, study_tag, request):
   the 'compose' function further below.''' 
   log.info('in')
   record_id = request['record-id']
+  snap = request.get('datastore-snapshot')
   # Note that below we also need to check for a JIRA ticket, which 
   # was the old pathway to CTMS registration.
   if (request[ENROLLED_KEY] == YES
       and not store.flag_is_set(redcap_server_tag, project_id, record_id,
-                                JIRA_ENROLLMENT_TICKET_KEY)
+                                JIRA_ENROLLMENT_TICKET_KEY, snap)
       and not store.flag_is_set(redcap_server_tag, project_id, record_id,
-                                ONCORE_REGISTERED_KEY)):
+                                ONCORE_REGISTERED_KEY, snap)):
     mrn = extract_mrn(request)
     study_config = common.get_study_config(study_tag)
     handler_tag = redcap_server_tag + str(project_id)
-    oncore_spec = study_config[
-                    study_config['handler-tag-to-env-tag'][handler_tag]
-                      ]['oncore-spec']
-    subject_num = None
-    demographics = oncore.get_subject_data(oncore_spec, mrn)
-    # Grab demographics from OnCore; then compare with REDCap before
-    # deciding to register in OnCore or not.
-    if not oncore.subject_record_exists(demographics):
+    env_tag = study_config['handler-tag-to-env-tag'][handler_tag]
+    oncore_spec = study_config[env_tag]['oncore-spec']
+    # Grab demographics from OnCore (or the cache); then compare with
+    # REDCap before deciding to register in OnCore or not.
+    exists, subject_num, demographics = lookup_demographics(env_tag,
+                                                            oncore_spec, mrn)
+    if not exists:
       # Flag, log, an bail.
       msg = ('No demographics found in OnCore for '
              'record ID of {}'.format(record_id))
       store.set_flag_if_unset(redcap_server_tag, project_id, record_id,
-                              ONCORE_DEMOGRAPHICS_NOT_FOUND)
+                              ONCORE_DEMOGRAPHICS_NOT_FOUND, snap)
       log.info(msg)
+      request[OUTCOME_KEY] = NOT_FOUND
       return request
-    else:
-      # OnCore gave us demographics; prep and keep going.
-      subject_num = oncore.extract_subject_num(demographics)
-      demographics = oncore.prep_subject_data(demographics)
+    # Otherwise OnCore gave us (prepared) demographics; keep going.
     # Here, we should have demographics, or already bailed.
     # Also note that, by this point, demographics should have
     # keys/structure in format expected by oncorelib's register function.
@@ -144,23 +211,33 @@ def _go(redcap_server_tag, project_id, study_tag, request):
       # If we get here, we're ready to register.
       # Unset previously set recon flags since they're no longer
       # necessary -- nor correct anymore, for that matter.
-      clear_all_recon_flags(redcap_server_tag, project_id, record_id)
+      clear_all_recon_flags(redcap_server_tag, project_id, record_id, snap)
       protocol = study_config['study-details']['protocol-number']
       log.info('About to register; record ID: {}'.format(record_id))
-      oncore.register_subject_to_protocol(oncore_spec,
-                                          protocol,
-                                          demographics,
-                                          subject_num)
+      with resilience.guard('oncore').call(oncore_is_outage), \
+           tracing.span('oncore.register_subject_to_protocol'):
+        oncore.register_subject_to_protocol(oncore_spec,
+                                            protocol,
+                                            demographics,
+                                            subject_num)
       log.info('Registered; record ID: {}'.format(record_id))
+      # Written through now, not left in the write-behind queue: if the
+      # process died with it queued, the record would be registered again.
+      store.put(redcap_server_tag, project_id, record_id,
+                ONCORE_REGISTERED_KEY, YES, snap, sync=True)
+      forget_demographics(env_tag, mrn)
+      request[OUTCOME_KEY] = REGISTERED
     else:
       # Flag, log, and bail.
       msg = ('Demographics comparison confidence below threshold for '
              'record ID of {}'.format(record_id))
       store.set_flag_if_unset(redcap_server_tag, project_id, record_id,
-                              DEMOGRAPHICS_MISMATCH)
+                              DEMOGRAPHICS_MISMATCH, snap)
       log.info(msg)
+      request[OUTCOME_KEY] = MISMATCH
   else:
     log.info('No action.')
+    request[OUTCOME_KEY] = NO_ACTION
   log.info('out')
   return request
 
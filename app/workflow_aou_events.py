@@ -8,6 +8,7 @@ from operator import *
 import kickshaws as ks
 
 import datastore as store
+import workflow_dag
 
 '''
 ==============================================================================
@@ -31,7 +32,7 @@ returning:
 ==============================================================================
 '''
 
-__all__ = ['go']
+__all__ = ['go', 'STAGE']
 
 #-----------------------------------------------------------------------------
 
@@ -48,22 +49,22 @@ NO = 'no'
 #-----------------------------------------------------------------------------
 # datastore
 
-def is_event_noted(redcap_server_tag, pid, record_id, key):
-  '''Predicate'''
+def is_event_noted(redcap_server_tag, pid, record_id, key, snap=None):
+  '''Predicate. Reads from snap (the request's datastore snapshot)
+  if given.'''
   log.info('Entered; REDCap env: [{}], pid: [{}], record_id: [{}], key: [{}]'\
            ''.format(redcap_server_tag, pid, record_id, key))
-  if store.key_exists(redcap_server_tag, pid, record_id, key):
-    rslt = store.get_latest_value(redcap_server_tag, pid, record_id, key)
-    if rslt == YES:
-      log.info('{} event already stored.'.format(key))
-      return True
+  if (store.get_latest_or_none(redcap_server_tag, pid, record_id, key, snap)
+      == YES):
+    log.info('{} event already stored.'.format(key))
+    return True
   log.info('{} event *not* stored.'.format(key))
   return False
 
-def note_event(redcap_server_tag, pid, record_id, key):
+def note_event(redcap_server_tag, pid, record_id, key, snap=None):
   '''Store event in datastore. Use a key defined at the top of
   this module.'''
-  rslt = store.put(redcap_server_tag, pid, record_id, key, YES)
+  rslt = store.put(redcap_server_tag, pid, record_id, key, YES, snap)
   log.info(key + ' event stored just now for record_id: ' + record_id)
   return rslt
 
@@ -94,7 +95,7 @@ def redcap_indicates_enrollment(redcap_server_tag, pid, record):
     log.info('One or more needed fields blank.')
     return False
 
-def assess_enrollment(redcap_server_tag, pid, record):
+def assess_enrollment(redcap_server_tag, pid, record, snap=None):
   '''Return a map w/ containing key-value pair with key of 'has-enrolled' 
   and value of 'yes' or 'no'.'''
   log.info('in')
@@ -103,11 +104,13 @@ def assess_enrollment(redcap_server_tag, pid, record):
   # Note: it's possible event happened, we recorded it, but later record
   # was amended such that record no longer indicates enrollment.
   if (redcap_indicates_enrollment(redcap_server_tag, pid, record)
-      or is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED)):
+      or is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED,
+                        snap)):
     rslt = {HAS_ENROLLED: YES}
-    if not is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED):
+    if not is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED,
+                          snap):
       # If here, record indicates enrollment; since not noted before, note now.
-      note_event(redcap_server_tag, pid, record_id, HAS_ENROLLED)
+      note_event(redcap_server_tag, pid, record_id, HAS_ENROLLED, snap)
   else:
     rslt = {HAS_ENROLLED: NO}
   log.info('record_id: {}; assessment: {}'.format(record_id, str(rslt)))
@@ -122,7 +125,7 @@ def redcap_indicates_withdrawal(redcap_server_tag, pid, record):
      THEN record indicates a withdrawal.'''
   return record.get('withdrawal_date', '') != ''
 
-def assess_withdrawal(redcap_server_tag, pid, record):
+def assess_withdrawal(redcap_server_tag, pid, record, snap=None):
   '''
   Return a map w/ containing key-value pair with key of 'has-withdrawn'
   and value of 'yes' or 'no'.
@@ -138,13 +141,15 @@ def assess_withdrawal(redcap_server_tag, pid, record):
   # prereq for a withdrawal.
   # Note: It's possible event happened, we recorded it, but later record
   # was amended such that record no longer indicates withdrawal.
-  if (is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED)
+  if (is_event_noted(redcap_server_tag, pid, record_id, HAS_ENROLLED, snap)
       and (redcap_indicates_withdrawal(redcap_server_tag, pid, record)
-           or is_event_noted(redcap_server_tag, pid, record_id, HAS_WITHDRAWN))):
+           or is_event_noted(redcap_server_tag, pid, record_id, HAS_WITHDRAWN,
+                             snap))):
     rslt = {HAS_WITHDRAWN: YES}
-    if not is_event_noted(redcap_server_tag, pid, record_id, HAS_WITHDRAWN):
+    if not is_event_noted(redcap_server_tag, pid, record_id, HAS_WITHDRAWN,
+                          snap):
       # If here, record indicates withdrawal; since not noted before, note now.
-      note_event(redcap_server_tag, pid, record_id, HAS_WITHDRAWN)
+      note_event(redcap_server_tag, pid, record_id, HAS_WITHDRAWN, snap)
   else:
     rslt = {HAS_WITHDRAWN: NO}
   log.info('record_id: {}; assessment: {}'.format(record_id, str(rslt)))
@@ -158,6 +163,7 @@ def go(request):
   log.info('in')
   redcap_server_tag = request['redcap-server-tag']
   pid = request['pid']
+  snap = request.get('datastore-snapshot')
   # In newer REDCap versions, sometimes the record is a list;
   # in that case, we only want first element of the list.
   record = {}
@@ -165,8 +171,12 @@ def go(request):
     record = request['full-record'][0]
   else:
     record = request['full-record']
-  request.update(assess_enrollment(redcap_server_tag, pid, record))
-  request.update(assess_withdrawal(redcap_server_tag, pid, record))
+  request.update(assess_enrollment(redcap_server_tag, pid, record, snap))
+  request.update(assess_withdrawal(redcap_server_tag, pid, record, snap))
   log.info('out')
   return request
 
+# For use in a workflow_dag.Dag.
+STAGE = workflow_dag.stage(go, reads=['full-record', 'datastore-snapshot'],
+                           writes=['datastore-snapshot', HAS_ENROLLED,
+                                   HAS_WITHDRAWN])
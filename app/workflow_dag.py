@@ -0,0 +1,165 @@
+import sys
+import threading
+import Queue
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import kickshaws as ks
+
+import common
+import tracing
+
+'''
+===============================================================================
+
+-----------------------
+     workflow_dag
+-----------------------
+
+Runs a workflow chain as a graph, so that workflows that don't depend on each
+other run at the same time on a shared thread pool.
+
+Each workflow is wrapped in a Stage that declares the baton (request map)
+keys it reads and writes:
+
+    STAGE = workflow_dag.stage(go, reads=['record-id'],
+                               writes=['full-record'])
+
+A Dag is built from stages in the same order as the equivalent sequential
+chain, and a stage waits for every earlier stage that
+
+  o writes a key it reads, reads a key it writes, or writes a key it
+    writes; or
+  o may short-circuit the chain (may_finish=True) -- unless this stage is
+    pure, i.e. has no effect outside the baton (a read-only DB query or
+    API call), in which case it may run ahead. If the chain then finishes
+    early, the pure stage has still run: its writes are left in the
+    shared request map (and so in the map returned), though in sequence
+    it wouldn't have run at all. Only mark a stage pure if that's
+    harmless.
+
+Keys put in the request before the chain starts (by redcap_handler_template)
+aren't written by any stage, so reading them creates no dependency.
+
+Results match common.run_workflow_chain's:
+
+  o If a stage returns a map with 'done' == 'yes', no later stage (in chain
+    order) is started; stages already running are waited for; and that map
+    is returned. Earlier stages that hadn't started yet still run, as they
+    would have in sequence.
+  o If a stage raises, the same applies and the exception is re-raised.
+  o Otherwise the shared request, with every stage's writes, is returned.
+
+All stages share one request map, so stages that run together must write
+different keys (which the dependency rules above guarantee for the keys
+they declare). If a workflow returns a different map than it was given,
+its declared writes (plus 'done' and 'response') are copied back.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+Stage = namedtuple('Stage', ['fn', 'reads', 'writes', 'may_finish', 'pure'])
+
+def stage(fn, reads=(), writes=(), may_finish=False, pure=False):
+  return Stage(fn, frozenset(reads), frozenset(writes), may_finish, pure)
+
+#------------------------------------------------------------------------------
+# The thread pool is shared by every Dag and started on first use.
+
+dag_cfg = common.get_app_config().get('workflow-dag', {})
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = ThreadPool(dag_cfg.get('threads', 8))
+  return _pool
+
+def enabled():
+  '''True if "workflow-dag" is enabled in transmitter-config.json.'''
+  return dag_cfg.get('enabled', False)
+
+#------------------------------------------------------------------------------
+
+def _depends_on(later, earlier):
+  return bool((later.reads & earlier.writes)
+              or (later.writes & earlier.reads)
+              or (later.writes & earlier.writes)
+              or (earlier.may_finish and not later.pure))
+
+def _run_stage(i, st, request, spans, results):
+  '''Pool side: run one stage and report (index, result, exc_info).'''
+  try:
+    with tracing.attached(spans):
+      with tracing.span('workflow.' + tracing.workflow_name(st.fn)):
+        x = st.fn(request)
+    results.put((i, x, None))
+  except Exception:
+    results.put((i, None, sys.exc_info()))
+
+class Dag(object):
+
+  def __init__(self, stages):
+    self.stages = list(stages)
+    # deps[i] is the set of earlier stage indexes stage i waits for.
+    self.deps = [set(j for j in range(i)
+                     if _depends_on(self.stages[i], self.stages[j]))
+                 for i in range(len(self.stages))]
+
+  def run(self, request):
+    '''Like common.run_workflow_chain(request, chain); see module notes.'''
+    log.info('Entered.')
+    pool = _get_pool()
+    results = Queue.Queue()
+    pending = range(len(self.stages))
+    running, done = set(), set()
+    limit = len(self.stages) # Don't start stages at or past this index.
+    stopped_by = None        # (index, result map or exc_info)
+    outcome = 'error'
+    try:
+      with tracing.trace(request) as spans:
+        while True:
+          for i in [i for i in pending if i < limit and self.deps[i] <= done]:
+            pending.remove(i)
+            running.add(i)
+            pool.apply_async(_run_stage,
+                             (i, self.stages[i], request, spans, results))
+          if not running:
+            break
+          i, x, exc_info = results.get()
+          running.discard(i)
+          done.add(i)
+          if exc_info is None and x is not request:
+            for k in self.stages[i].writes | set(['done', 'response']):
+              if k in x:
+                request[k] = x[k]
+          if exc_info is not None or x.get('done', '') == 'yes':
+            if i < limit:
+              limit = i
+              stopped_by = (i, exc_info if exc_info is not None else x)
+        if stopped_by is None:
+          log.info('Workflow DAG done. Exiting.')
+          outcome = 'completed'
+          x = request
+        elif isinstance(stopped_by[1], tuple):
+          exc_type, exc, tb = stopped_by[1]
+          raise exc_type, exc, tb
+        else:
+          log.info('Finished early; exiting workflow DAG.')
+          outcome = 'short-circuited'
+          x = stopped_by[1]
+    finally:
+      common.CHAINS.inc((outcome,))
+    x[tracing.TIMINGS_KEY] = spans
+    return x
+
+def run(request, chain):
+  '''Run chain -- a Dag, or a list of workflow functions -- on request.'''
+  if isinstance(chain, Dag):
+    return chain.run(request)
+  return common.run_workflow_chain(request, chain)
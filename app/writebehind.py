@@ -0,0 +1,134 @@
+import time
+import traceback
+from threading import Condition, Lock, Thread
+
+import kickshaws as ks
+
+'''
+===============================================================================
+
+-----------------------
+      writebehind
+-----------------------
+
+Coalesces single-row writes into batches. Rows handed to add() are buffered
+in memory and passed, in arrival order, to a flush function (which writes
+them all in one statement) once either:
+
+  o `max_rows` rows are waiting, or
+  o the oldest waiting row has waited `max_seconds`.
+
+A background daemon thread does the flushing. Callers that need their rows
+durable before moving on call flush(), which writes synchronously on the
+calling thread.
+
+Rows that are waiting can be inspected via pending_rows() so that readers in
+this process still see their own writes before they reach the database.
+
+If a batch fails, its rows are retried one at a time, in order, so one
+bad row can't hold back the rest. If none of them goes through either,
+the database itself is likely unavailable: the rows stay queued and are
+retried on the next cycle, and a synchronous flush() re-raises the error.
+Otherwise the rows that failed on their own are logged (at error level,
+with their values) and dropped.
+
+At most `max_pending` rows are queued. Once that many are waiting, add()
+flushes on the calling thread first, so a database outage surfaces to
+callers as an error (as it would without batching) rather than as
+unbounded memory growth.
+
+===============================================================================
+'''
+
+log = ks.smart_logger()
+
+class BatchedWriter(object):
+
+  def __init__(self, flush_fn, max_rows=100, max_seconds=0.5,
+               max_pending=10000):
+    self.flush_fn = flush_fn
+    self.max_rows = max_rows
+    self.max_seconds = max_seconds
+    self.max_pending = max_pending
+    self._pending = []
+    self._oldest = None
+    self._cond = Condition(Lock())
+    # Serializes flushes so batches reach the database in order.
+    self._flush_lock = Lock()
+    self._thread = Thread(target=self._run, name='writebehind')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def add(self, row):
+    if len(self._pending) >= self.max_pending:
+      self.flush() # Raises if the rows can't be written.
+    with self._cond:
+      if not self._pending:
+        self._oldest = time.time()
+      self._pending.append(row)
+      # First row starts the clock; max_rows means flush now.
+      if len(self._pending) == 1 or len(self._pending) >= self.max_rows:
+        self._cond.notify()
+
+  def pending_rows(self):
+    '''Copy of rows not yet flushed, oldest first.'''
+    with self._cond:
+      return list(self._pending)
+
+  def flush(self):
+    '''Write everything pending now, on the calling thread.'''
+    with self._flush_lock:
+      with self._cond:
+        rows = list(self._pending)
+      if not rows:
+        return 0
+      try:
+        self.flush_fn(rows)
+      except Exception:
+        if len(rows) == 1:
+          raise
+        self._flush_singly(rows)
+      # Rows stay visible via pending_rows() until they're committed, so
+      # readers never see a gap. Only add() appends, so the first
+      # len(rows) entries are exactly what we just wrote.
+      with self._cond:
+        del self._pending[:len(rows)]
+        self._oldest = time.time() if self._pending else None
+      return len(rows)
+
+  def _flush_singly(self, rows):
+    '''Write rows one at a time, after their batch failed. Re-raises if
+    every one fails; otherwise logs and drops the ones that did.'''
+    failed = []
+    for row in rows:
+      try:
+        self.flush_fn([row])
+      except Exception, e:
+        failed.append((row, e, traceback.format_exc()))
+    if len(failed) == len(rows):
+      raise failed[-1][1]
+    for row, e, details in failed:
+      log.error('Batched write: dropped a row that failed on its own: {}. '
+                'Details: {}'.format(row, details))
+
+  def _due(self):
+    if not self._pending:
+      return False
+    return (len(self._pending) >= self.max_rows
+            or time.time() - self._oldest >= self.max_seconds)
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._due():
+          if self._pending:
+            wait = self.max_seconds - (time.time() - self._oldest)
+            self._cond.wait(max(wait, 0.01))
+          else:
+            self._cond.wait(self.max_seconds)
+      try:
+        self.flush()
+      except Exception:
+        log.error('Batched write failed; will retry. Details: {}'\
+                  ''.format(traceback.format_exc()))
+        time.sleep(self.max_seconds)
@@ -0,0 +1,82 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import os
+import random
+import tempfile
+import time
+from threading import Thread
+
+import common
+import datastore_mysql
+import datastore_sqlite
+
+'''
+Datastore backend comparison: MySQL vs embedded SQLite.
+
+Runs the same workload against each backend -- per simulated DET, one
+record snapshot, two latest-value reads and one write, across N threads --
+and reports DETs/sec plus p50/p99 per-DET latency. MySQL rows are written
+under the env tag 'bench' and deleted afterward; the SQLite database is a
+temporary file.
+
+Usage: from the bench folder, run:
+python bench_datastore_backends.py [threads] [dets-per-thread]
+
+Requires a MySQL database configured in enclave/transmitter-config.json.
+'''
+
+BENCH_ENV = 'bench'
+ATTRS = ['aou-wcm-paired', 'has-enrolled', 'has-withdrawn']
+
+def one_det(backend, record_id):
+  backend.record(BENCH_ENV, '0', record_id)
+  backend.latest(BENCH_ENV, '0', record_id, 'aou-wcm-paired')
+  backend.latest(BENCH_ENV, '0', record_id, 'has-enrolled')
+  backend.write_rows([(BENCH_ENV, '0', record_id, random.choice(ATTRS),
+                       random.choice(['yes', 'no']))])
+
+def run(backend, threads, n):
+  timings = []
+  def worker(tid):
+    for i in range(n):
+      start = time.time()
+      one_det(backend, str(random.randrange(500)))
+      timings.append((time.time() - start) * 1000)
+  ts = [Thread(target=worker, args=(t,)) for t in range(threads)]
+  start = time.time()
+  for t in ts: t.start()
+  for t in ts: t.join()
+  rate = (threads * n) / (time.time() - start)
+  timings.sort()
+  p50 = timings[len(timings) // 2]
+  p99 = timings[int(len(timings) * 0.99)]
+  return rate, p50, p99
+
+def report(name, rslt):
+  print('{:7} {:8.0f} DETs/sec  p50={:.2f}ms p99={:.2f}ms'\
+        ''.format(name, *rslt))
+
+def main():
+  threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+  n = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+  cfg = common.get_app_config()
+  mysql = datastore_mysql.MySQLBackend(cfg.get('db-spec'),
+                                       cfg.get('db-pool', {}))
+  try:
+    report('mysql', run(mysql, threads, n))
+  finally:
+    mysql.delete_env(BENCH_ENV)
+  tmpdir = tempfile.mkdtemp()
+  path = os.path.join(tmpdir, 'bench.sqlite3')
+  try:
+    report('sqlite', run(datastore_sqlite.SQLiteBackend(path), threads, n))
+  finally:
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+    os.rmdir(tmpdir)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,109 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import random
+import time
+import pymysql
+
+import common
+
+'''
+Latest-value lookup benchmark for the datastore table.
+
+Seeds a scratch copy of the datastore table (datastore_bench) with versioned
+rows, then times the get_latest_value query with and without
+datastore_latest_idx, reporting p50/p99 latency.
+
+Usage: from the bench folder, run:
+python bench_datastore_latest.py [total-rows] [lookups]
+
+Requires a MySQL database configured in enclave/transmitter-config.json.
+The scratch table is dropped at the end.
+'''
+
+ENVS = ['prod', 'sand']
+PIDS = ['2525', '2897', '2911']
+ATTRS = ['aou-wcm-paired', 'has-enrolled', 'has-withdrawn',
+         'enrollment-registered-in-oncore', 'demographics-mismatch']
+VERSIONS_PER_KEY = 4
+
+LATEST_QY = '''select ifnull(attrval, 'nil') as attrval
+               from datastore_bench
+               where env = %s and projectid = %s
+                 and recordid = %s
+                 and attrname = %s
+               order by ts DESC, rid DESC
+               limit 1 '''
+
+def seed(conn, total_rows):
+  stmt = '''insert into datastore_bench
+              (ts, env, projectid, recordid, attrname, attrval)
+            values (from_unixtime(%s), %s, %s, %s, %s, %s) '''
+  per_record = len(ATTRS) * VERSIONS_PER_KEY
+  n_records = max(1, total_rows // (len(ENVS) * len(PIDS) * per_record))
+  base = int(time.time()) - 86400 * 365 * 3
+  batch = []
+  with conn.cursor() as cur:
+    for env in ENVS:
+      for pid in PIDS:
+        for rec in range(n_records):
+          for attr in ATTRS:
+            for v in range(VERSIONS_PER_KEY):
+              batch.append((base + rec + v * 86400, env, pid, str(rec), attr,
+                            random.choice(['yes', 'no'])))
+              if len(batch) == 10000:
+                cur.executemany(stmt, batch)
+                conn.commit()
+                batch = []
+    if batch:
+      cur.executemany(stmt, batch)
+      conn.commit()
+  return n_records
+
+def percentile(sorted_vals, pct):
+  idx = int(round(pct / 100 * (len(sorted_vals) - 1)))
+  return sorted_vals[idx]
+
+def time_lookups(conn, n_records, lookups):
+  timings = []
+  with conn.cursor() as cur:
+    for _ in range(lookups):
+      vals = (random.choice(ENVS), random.choice(PIDS),
+              str(random.randrange(n_records)), random.choice(ATTRS))
+      start = time.time()
+      cur.execute(LATEST_QY, vals)
+      cur.fetchone()
+      timings.append((time.time() - start) * 1000)
+  timings.sort()
+  return percentile(timings, 50), percentile(timings, 99)
+
+def main():
+  total_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+  lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  conn = pymysql.connect(**common.get_app_config().get('db-spec'))
+  try:
+    with conn.cursor() as cur:
+      cur.execute('drop table if exists datastore_bench')
+      cur.execute('create table datastore_bench like datastore')
+      # Start from the pre-migration shape regardless of the live table.
+      cur.execute('show index from datastore_bench '
+                  'where Key_name = \'datastore_latest_idx\'')
+      if cur.fetchall():
+        cur.execute('drop index datastore_latest_idx on datastore_bench')
+    print('Seeding ~{} rows...'.format(total_rows))
+    n_records = seed(conn, total_rows)
+    p50, p99 = time_lookups(conn, n_records, lookups)
+    print('no index:   p50={:.2f}ms p99={:.2f}ms'.format(p50, p99))
+    with conn.cursor() as cur:
+      cur.execute('create index datastore_latest_idx on datastore_bench '
+                  '(env, projectid, recordid, attrname(191), ts)')
+    p50, p99 = time_lookups(conn, n_records, lookups)
+    print('with index: p50={:.2f}ms p99={:.2f}ms'.format(p50, p99))
+  finally:
+    with conn.cursor() as cur:
+      cur.execute('drop table if exists datastore_bench')
+    conn.close()
+
+if __name__ == '__main__': main()
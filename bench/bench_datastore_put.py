@@ -0,0 +1,52 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+from threading import Thread
+
+import datastore as store
+import writebehind
+
+'''
+datastore.put throughput benchmark, with write batching off and on.
+
+Runs N threads (standing in for concurrent request threads), each doing a
+series of puts, and reports puts/sec. Rows are written under the env tag
+'bench' and deleted afterward.
+
+Usage: from the bench folder, run:
+python bench_datastore_put.py [threads] [puts-per-thread]
+
+Uses whichever db-backend enclave/transmitter-config.json selects.
+'''
+
+BENCH_ENV = 'bench'
+
+def worker(tid, n):
+  for i in range(n):
+    store.put(BENCH_ENV, '0', str(tid), 'bench-attr-' + str(i % 5), 'yes')
+
+def run(threads, n):
+  ts = [Thread(target=worker, args=(t, n)) for t in range(threads)]
+  start = time.time()
+  for t in ts: t.start()
+  for t in ts: t.join()
+  store.flush()
+  return (threads * n) / (time.time() - start)
+
+def main():
+  threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+  n = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+  try:
+    store.writer = None
+    print('batching off: {:.0f} puts/sec'.format(run(threads, n)))
+    store.writer = writebehind.BatchedWriter(store._write_rows,
+                                             max_rows=100, max_seconds=0.5)
+    print('batching on:  {:.0f} puts/sec'.format(run(threads, n)))
+  finally:
+    store.flush()
+    store.backend.delete_env(BENCH_ENV)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,71 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import gc
+import timeit
+
+import redcaplib
+import det
+
+'''
+DET payload parsing micro-benchmark.
+
+Compares the old per-request cost -- redcap_handler_template parsed the
+payload twice and each test handler parsed it again -- with det.from_request,
+which parses once and then reads the stored result. Reports microseconds per
+request and objects allocated per request (counted as the growth in
+gc-tracked objects while the parsed results are kept alive).
+
+Usage: from the bench folder, run:
+python bench_det_parse.py [iterations]
+'''
+
+PAYLOADS = {
+  'typical':
+    'redcap_url=https%3A%2F%2Fredcap.example.org%2Fredcap_protocols%2F'
+    '&project_url=https%3A%2F%2Fredcap.example.org%2Fredcap_protocols%2F'
+    'redcap_v8.1.0%2Findex.php%3Fpid%3D2525'
+    '&project_id=2525&username=abc1234&record=1041'
+    '&instrument=enrollment&enrollment_complete=2'
+ ,'longitudinal':
+    'redcap_url=https%3A%2F%2Fredcap.example.org%2Fredcap_protocols%2F'
+    '&project_url=https%3A%2F%2Fredcap.example.org%2Fredcap_protocols%2F'
+    'redcap_v8.1.0%2Findex.php%3Fpid%3D2525'
+    '&project_id=2525&username=abc1234&record=1041'
+    '&redcap_event_name=baseline_arm_1&redcap_data_access_group=wcm'
+    '&instrument=withdrawal&withdrawal_complete=0'
+ ,'empty': ''
+}
+
+def old_way(data):
+  # Emptiness check, then the real parse, then the downstream handler.
+  redcaplib.parse_det_payload(data)
+  redcaplib.parse_det_payload(data)
+  return redcaplib.parse_det_payload(data)
+
+def new_way(data):
+  request = {'data': data}
+  det.from_request(request) # preprocess
+  det.from_request(request) # handler
+  return det.from_request(request) # downstream
+
+def allocations(f, data, n=1000):
+  gc.collect()
+  before = len(gc.get_objects())
+  kept = [f(data) for _ in range(n)]
+  after = len(gc.get_objects())
+  del kept
+  return (after - before) / n
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  for name, data in sorted(PAYLOADS.items()):
+    for label, f in (('3x parse', old_way), ('parse once', new_way)):
+      secs = timeit.timeit(lambda: f(data), number=iterations)
+      print('{:13} {:11} {:8.2f} us/request {:6.1f} objects/request'\
+            ''.format(name, label, secs / iterations * 1e6,
+                      allocations(f, data)))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,87 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+import random
+
+import flexmatch
+
+'''
+Demographics reconciliation across a cohort: flexmatch.bulk_confidence vs.
+calling flexmatch.confidence pair by pair.
+
+Makes N synthetic REDCap-side records and N OnCore-side records (the same
+people, some with a name changed, shortened or recased, plus some
+unmatched), with birthdates spread over 80 years. Both approaches compare
+the same candidate pairs (same birthdate); the scalar one is given those
+pairs up front, so it isn't charged for finding them. Checks that the
+results agree and reports time and pairs/sec for each.
+
+Usage: from the bench folder, run:
+python bench_flexmatch.py [records]
+'''
+
+FIRST = ['James', 'Nora', 'Lucia', 'Giorgio', 'Stanislaus', 'Harriet',
+         'Sylvia', 'Samuel', 'Maria', 'Wei', 'Aisha', 'Carlos']
+LAST = ['Joyce', 'Barnacle', 'Beckett', 'Weaver', 'Nguyen', 'Garcia',
+        'Okafor', 'Kim', 'Rossi', 'Schmidt', 'Cohen', 'Patel']
+
+def person(rnd):
+  return {'first-name': rnd.choice(FIRST) + rnd.choice(['', ' A.', 'a'])
+         ,'last-name': rnd.choice(LAST) + rnd.choice(['', '-Smith', 'e'])
+         ,'birthdate': '{}-{:02d}-{:02d}'.format(rnd.randint(1940, 2019),
+                                                 rnd.randint(1, 12),
+                                                 rnd.randint(1, 28))}
+
+def variant(rnd, d):
+  d = dict(d)
+  roll = rnd.random()
+  if roll < 0.1:
+    d['first-name'] = d['first-name'].upper()
+  elif roll < 0.2:
+    d['first-name'] = d['first-name'].split(' ')[0]
+  elif roll < 0.25:
+    d['last-name'] = rnd.choice(LAST)
+  elif roll < 0.3:
+    return person(rnd)
+  return d
+
+def datasets(n):
+  rnd = random.Random(100)
+  left = [person(rnd) for _ in range(n)]
+  right = [variant(rnd, d) for d in left]
+  rnd.shuffle(right)
+  return left, right
+
+def scalar(left, right):
+  right_blocks = {}
+  for j, d in enumerate(right):
+    right_blocks.setdefault(d['birthdate'], []).append(j)
+  pairs = [(i, j) for i, d in enumerate(left)
+           for j in right_blocks.get(d['birthdate'], [])]
+  start = time.time()
+  rslt = dict(((i, j), flexmatch.confidence(left[i], right[j]))
+              for i, j in pairs)
+  return rslt, time.time() - start
+
+def bulk(left, right):
+  start = time.time()
+  rslt = flexmatch.bulk_confidence(flexmatch.columns(left),
+                                   flexmatch.columns(right))
+  return rslt, time.time() - start
+
+def main():
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  left, right = datasets(n)
+  s_rslt, s_secs = scalar(left, right)
+  b_rslt, b_secs = bulk(left, right)
+  assert(s_rslt == b_rslt)
+  print('records: {}  candidate pairs: {}'.format(n, len(b_rslt)))
+  for label, secs in (('scalar', s_secs), ('bulk', b_secs)):
+    print('{:>6}: {:7.3f}s  {:10.0f} pairs/s'.format(
+          label, secs, len(b_rslt) / max(secs, 1e-9)))
+  print('speedup: {:.1f}x'.format(s_secs / max(b_secs, 1e-9)))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,82 @@
+from __future__ import division
+from __future__ import print_function
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+
+import common
+import workflow_dag
+
+'''
+End-to-end latency of the AoU workflow chain, sequential vs. workflow_dag.
+
+The workflows are stand-ins that sleep for a typical latency of the I/O each
+real one does (REDCap record export, datastore snapshot query, datastore /
+AoU API affiliation check, event writes) and declare the same baton keys as
+the real STAGEs, so the DAG schedules them the same way. Reports p50/p99
+per scenario.
+
+Usage: from the bench folder, run:
+python bench_workflow_dag.py [runs] [redcap-ms] [snapshot-ms] [aou-api-ms]
+'''
+
+def sleeper(name, ms, writes=(), finish=False):
+  def f(request):
+    time.sleep(ms / 1000)
+    for k in writes:
+      request[k] = 'x'
+    if finish:
+      return common.finalize(request)
+    return request
+  f.__name__ = name
+  return f
+
+def chains(redcap_ms, snapshot_ms, affiliation_ms, finish):
+  intake = sleeper('intake', redcap_ms, ['env-tag', 'full-record'])
+  snap = sleeper('snapshot', snapshot_ms, ['datastore-snapshot'])
+  affil = sleeper('affiliation', affiliation_ms, finish=finish)
+  events = sleeper('events', 0 if finish else 10,
+                   ['has-enrolled', 'has-withdrawn'])
+  seq = [intake, snap, affil, events]
+  dag = workflow_dag.Dag([
+    workflow_dag.stage(intake, reads=['record-id'],
+                       writes=['env-tag', 'full-record'], pure=True)
+   ,workflow_dag.stage(snap, reads=['record-id'],
+                       writes=['datastore-snapshot'], pure=True)
+   ,workflow_dag.stage(affil, reads=['full-record', 'datastore-snapshot'],
+                       writes=['datastore-snapshot'], may_finish=True)
+   ,workflow_dag.stage(events, reads=['full-record', 'datastore-snapshot'],
+                       writes=['datastore-snapshot', 'has-enrolled',
+                               'has-withdrawn'])])
+  return seq, dag
+
+def percentiles(samples):
+  samples = sorted(samples)
+  return (samples[len(samples) // 2],
+          samples[min(len(samples) - 1, int(len(samples) * 0.99))])
+
+def timed(f, runs):
+  out = []
+  for _ in range(runs):
+    start = time.time()
+    f()
+    out.append((time.time() - start) * 1000)
+  return percentiles(out)
+
+def main():
+  args = [int(a) for a in sys.argv[1:]]
+  runs, redcap_ms, snapshot_ms, aou_ms = args + [50, 250, 40, 400][len(args):]
+  scenarios = [('affiliation cached', 5, False)
+              ,('affiliation via AoU API', aou_ms, False)
+              ,('not affiliated (short-circuit)', 5, True)]
+  for label, affiliation_ms, finish in scenarios:
+    seq, dag = chains(redcap_ms, snapshot_ms, affiliation_ms, finish)
+    s50, s99 = timed(lambda: common.run_workflow_chain({'record-id': '1'},
+                                                       seq), runs)
+    d50, d99 = timed(lambda: dag.run({'record-id': '1'}), runs)
+    print('{:32} sequential p50 {:7.1f} ms p99 {:7.1f} ms | '
+          'dag p50 {:7.1f} ms p99 {:7.1f} ms'.format(label, s50, s99,
+                                                     d50, d99))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,15 @@
+-- Migration for installations created before datastore_latest_idx existed.
+--
+-- datastore.get_latest_value and datastore.key_exists always filter on
+-- (env, projectid, recordid, attrname) and want the newest row by ts.
+-- Without an index, each lookup scans the whole table.
+--
+-- attrname is indexed on a 191-char prefix to keep the key under InnoDB's
+-- 3072-byte limit for utf8 columns; attribute names in use are far shorter,
+-- so the seek lands on only the few versions of a single key.
+--
+-- Run once:
+--   mysql -u X -p nihpmi < sql/add-datastore-latest-index.sql
+
+create index datastore_latest_idx
+  on datastore (env, projectid, recordid, attrname(191), ts);
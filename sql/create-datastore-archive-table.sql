@@ -0,0 +1,19 @@
+-- Archive of superseded history rows. app/compact_datastore.py moves
+-- versions that have since been overwritten (and are older than a cutoff)
+-- here from datastore, so the longitudinal record is kept in full while the
+-- live history table stays small. Rows keep their original rid and ts.
+--
+-- Run once, after create-datastore-table.sql.
+
+create table datastore_archive (
+  rid       bigint not null primary key
+, ts        timestamp not null
+, env      varchar(256) character set utf8 not null
+, projectid varchar(256) character set utf8 not null
+, recordid  varchar(256) character set utf8 not null
+, attrname  varchar(512) character set utf8 not null
+, attrval   varchar(8192) character set utf8 not null
+);
+
+create index datastore_archive_key_idx
+  on datastore_archive (env, projectid, recordid, attrname(191), ts);
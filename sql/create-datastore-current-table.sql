@@ -0,0 +1,34 @@
+-- Current-value table: one row per key holding its latest value.
+-- datastore.put writes the history row (datastore) and upserts this row in
+-- the same transaction, so reads never need to touch history.
+--
+-- Key columns are narrower than in the history table so that the primary
+-- key fits InnoDB's 3072-byte limit; env tags, pids, record IDs and
+-- attribute names in use are all far shorter.
+--
+-- Run once, after create-datastore-table.sql. For an existing installation
+-- (or after loading a CSV export, see README), the backfill statement below
+-- populates the table from history; it's safe to rerun.
+
+create table datastore_current (
+  env       varchar(32) character set utf8 not null
+, projectid varchar(32) character set utf8 not null
+, recordid  varchar(128) character set utf8 not null
+, attrname  varchar(256) character set utf8 not null
+, attrval   varchar(8192) character set utf8 not null
+, ts        timestamp default current_timestamp not null
+, primary key (env, projectid, recordid, attrname)
+);
+
+-- Backfill: the newest version of each key (rid breaks ts ties).
+insert into datastore_current (env, projectid, recordid, attrname, attrval, ts)
+select d.env, d.projectid, d.recordid, d.attrname, d.attrval, d.ts
+from datastore d
+where not exists
+  (select 1
+   from datastore n
+   where n.env = d.env and n.projectid = d.projectid
+     and n.recordid = d.recordid
+     and n.attrname = d.attrname
+     and (n.ts > d.ts or (n.ts = d.ts and n.rid > d.rid)))
+on duplicate key update attrval = values(attrval), ts = values(ts);
@@ -1,10 +1,42 @@
+-- History table: every put adds a row here, so it keeps the full
+-- longitudinal record for each key. Reads go to datastore_current instead
+-- (see create-datastore-current-table.sql).
+--
+-- Range-partitioned by ts so that old history can be archived (see
+-- app/compact_datastore.py) and pruned without scanning recent rows.
+-- Partitioning requires ts to be part of the primary key. Add a partition
+-- for each new year ahead of time by splitting pmax, e.g.:
+--
+--   alter table datastore reorganize partition pmax into
+--     ( partition p2031 values less than (unix_timestamp('2032-01-01'))
+--     , partition pmax values less than maxvalue );
+
 create table datastore (
-  rid       bigint not null auto_increment primary key
+  rid       bigint not null auto_increment
 , ts        timestamp default current_timestamp not null
 , env      varchar(256) character set utf8 not null
 , projectid varchar(256) character set utf8 not null
 , recordid  varchar(256) character set utf8 not null
 , attrname  varchar(512) character set utf8 not null
 , attrval   varchar(8192) character set utf8 not null 
+, primary key (rid, ts)
+)
+partition by range (unix_timestamp(ts))
+( partition p2017 values less than (unix_timestamp('2018-01-01'))
+, partition p2018 values less than (unix_timestamp('2019-01-01'))
+, partition p2019 values less than (unix_timestamp('2020-01-01'))
+, partition p2020 values less than (unix_timestamp('2021-01-01'))
+, partition p2021 values less than (unix_timestamp('2022-01-01'))
+, partition p2022 values less than (unix_timestamp('2023-01-01'))
+, partition p2023 values less than (unix_timestamp('2024-01-01'))
+, partition p2024 values less than (unix_timestamp('2025-01-01'))
+, partition p2025 values less than (unix_timestamp('2026-01-01'))
+, partition p2026 values less than (unix_timestamp('2027-01-01'))
+, partition p2027 values less than (unix_timestamp('2028-01-01'))
+, partition pmax values less than maxvalue
 );
 
+-- Supports per-key history lookups (e.g., compaction; see also
+-- add-datastore-latest-index.sql for existing installations).
+create index datastore_latest_idx
+  on datastore (env, projectid, recordid, attrname(191), ts);
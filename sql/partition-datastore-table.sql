@@ -0,0 +1,29 @@
+-- Migration for installations whose datastore table predates partitioning.
+-- (New installations get this from create-datastore-table.sql.)
+--
+-- MySQL requires the partitioning column to be part of every unique key,
+-- so the primary key becomes (rid, ts) first. Rebuilding a large table
+-- takes a while and blocks writes; stop the service before running.
+--
+-- Run once:
+--   mysql -u X -p nihpmi < sql/partition-datastore-table.sql
+
+alter table datastore
+  drop primary key
+, add primary key (rid, ts);
+
+alter table datastore
+partition by range (unix_timestamp(ts))
+( partition p2017 values less than (unix_timestamp('2018-01-01'))
+, partition p2018 values less than (unix_timestamp('2019-01-01'))
+, partition p2019 values less than (unix_timestamp('2020-01-01'))
+, partition p2020 values less than (unix_timestamp('2021-01-01'))
+, partition p2021 values less than (unix_timestamp('2022-01-01'))
+, partition p2022 values less than (unix_timestamp('2023-01-01'))
+, partition p2023 values less than (unix_timestamp('2024-01-01'))
+, partition p2024 values less than (unix_timestamp('2025-01-01'))
+, partition p2025 values less than (unix_timestamp('2026-01-01'))
+, partition p2026 values less than (unix_timestamp('2027-01-01'))
+, partition p2027 values less than (unix_timestamp('2028-01-01'))
+, partition pmax values less than maxvalue
+);
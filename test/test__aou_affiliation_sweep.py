@@ -0,0 +1,50 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import aou_affiliation_sweep as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class FakeLog(object):
+
+  def __init__(self):
+    self.errors = []
+
+  def info(self, msg):
+    pass
+
+  def error(self, msg):
+    self.errors.append(msg)
+
+def _fake_api(monkeypatch, rows, page_size):
+  '''Returns the FakeLog standing in for the module's logger.'''
+  fake_log = FakeLog()
+  monkeypatch.setattr(m, 'log', fake_log)
+  monkeypatch.setattr(m, 'sweep_cfg', {'page-size': page_size})
+  monkeypatch.setattr(m.aou_session, 'spec', lambda: {})
+  monkeypatch.setattr(m.aou_session, 'session', lambda: None)
+  monkeypatch.setattr(m.aoulib, 'get_records',
+                      lambda spec, sess, params: rows[:params['_count']])
+  return fake_log
+
+ROWS = [{'participantId': 'P1', 'organization': 'COLUMBIA_WEILL'}
+       ,{'participantId': 'P2', 'organization': 'OTHER_ORG'}
+       ,{'participantId': 'P3', 'organization': 'UNSET'}]
+
+def test_pairings_by_pmi_id_for_known_organizations(monkeypatch):
+  fake_log = _fake_api(monkeypatch, ROWS, page_size=1000)
+  assert(m.fetch_pairings() == {'1': m.pairing_for_org('COLUMBIA_WEILL'),
+                                '2': m.pairing_for_org('OTHER_ORG')})
+  assert(fake_log.errors == [])
+
+def test_full_page_logged_as_error(monkeypatch):
+  fake_log = _fake_api(monkeypatch, ROWS, page_size=2)
+  assert(m.fetch_pairings() == {'1': m.pairing_for_org('COLUMBIA_WEILL'),
+                                '2': m.pairing_for_org('OTHER_ORG')})
+  assert(len(fake_log.errors) == 1)
@@ -0,0 +1,97 @@
+import sys
+sys.path.insert(0, '../app/')
+
+from threading import Event, Thread
+
+import coalesce as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def test_single_request_runs_once():
+  c = m.Coalescer()
+  assert(c.submit('k', 1, lambda r: r * 10) == 10)
+  assert(c.stats() == {'received': 1, 'runs': 1, 'saved': 0})
+
+def test_burst_folds_into_one_follow_up_run():
+  c = m.Coalescer()
+  started, release, follow_up_done = Event(), Event(), Event()
+  seen = []
+  def run(r):
+    seen.append(r)
+    if r == 'first':
+      started.set()
+      release.wait(5)
+    else:
+      follow_up_done.set()
+    return r
+  rslt = []
+  t = Thread(target=lambda: rslt.append(c.submit('k', 'first', run)))
+  t.start()
+  started.wait(5)
+  # Three more DETs arrive while the first run is in progress.
+  assert(c.submit('k', 'second', run) is None)
+  assert(c.submit('k', 'third', run) is None)
+  assert(c.submit('k', 'fourth', run) is None)
+  release.set()
+  t.join(5)
+  # The first caller gets its own run's result; only the newest pending
+  # request runs after it, in the background.
+  assert(rslt == ['first'])
+  follow_up_done.wait(5)
+  assert(seen == ['first', 'fourth'])
+  assert(c.stats() == {'received': 4, 'runs': 2, 'saved': 2})
+
+def test_caller_not_held_for_follow_up_run():
+  c = m.Coalescer()
+  started, release = Event(), Event()
+  follow_up_started, follow_up_release = Event(), Event()
+  def run(r):
+    if r == 'first':
+      started.set()
+      release.wait(5)
+    else:
+      follow_up_started.set()
+      follow_up_release.wait(5)
+    return r
+  rslt = []
+  t = Thread(target=lambda: rslt.append(c.submit('k', 'first', run)))
+  t.start()
+  started.wait(5)
+  assert(c.submit('k', 'second', run) is None)
+  release.set()
+  follow_up_started.wait(5)
+  # The follow-up run is still going, but the first caller has returned.
+  t.join(5)
+  assert(not t.is_alive())
+  assert(rslt == ['first'])
+  follow_up_release.set()
+
+def test_other_keys_are_not_folded():
+  c = m.Coalescer()
+  started, release = Event(), Event()
+  def slow(r):
+    started.set()
+    release.wait(5)
+    return r
+  t = Thread(target=lambda: c.submit('a', 'x', slow))
+  t.start()
+  started.wait(5)
+  assert(c.submit('b', 'y', lambda r: r) == 'y')
+  release.set()
+  t.join(5)
+
+def test_exception_clears_key():
+  c = m.Coalescer()
+  def boom(r):
+    raise ValueError()
+  try:
+    c.submit('k', 1, boom)
+  except ValueError:
+    pass
+  assert(c.submit('k', 2, lambda r: r) == 2)
@@ -0,0 +1,63 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+
+import common as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+# imux_handlers
+
+def _returns(status, after_seconds=0):
+  def handler(req):
+    time.sleep(after_seconds)
+    return {'status': status}
+  return handler
+
+def _raises(req):
+  raise ValueError('handler failed')
+
+def test_imux_all_200():
+  imuxed = m.imux_handlers(_returns(200), _returns(200), _returns(200))
+  assert(imuxed({}) == {'status': 200})
+
+def test_imux_first_non_200_in_argument_order():
+  # The first handler finishes last, but its status still wins.
+  imuxed = m.imux_handlers(_returns(200), _returns(503, after_seconds=0.1),
+                           _returns(404))
+  assert(imuxed({}) == {'status': 503})
+
+def test_imux_timeout_is_504():
+  imuxed = m.imux_handlers(_returns(200), _returns(200, after_seconds=1),
+                           timeout_seconds=0.1)
+  started = time.time()
+  assert(imuxed({}) == {'status': 504})
+  assert(time.time() - started < 0.5)
+
+def test_imux_raise_is_500():
+  imuxed = m.imux_handlers(_returns(200), _raises, _returns(404))
+  assert(imuxed({}) == {'status': 500})
+
+def test_imux_per_handler_timeouts():
+  fast, slow = _returns(200), _returns(200, after_seconds=0.3)
+  assert(m.imux_handlers(fast, slow, timeout_seconds=[0.1, 1])({})
+         == {'status': 200})
+  assert(m.imux_handlers(fast, slow, timeout_seconds=[1, 0.1])({})
+         == {'status': 504})
+
+def test_imux_each_handler_gets_its_own_request():
+  seen = []
+  def mutates(req):
+    req['full-record'].append('mine')
+    seen.append(req['full-record'])
+    return {'status': 200}
+  req = {'full-record': []}
+  assert(m.imux_handlers(mutates, mutates)(req) == {'status': 200})
+  assert(req == {'full-record': []})
+  assert(seen == [['mine'], ['mine']])
@@ -0,0 +1,70 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import ttlcache
+import datastore as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class RacingBackend(object):
+  '''Answers reads with the stored values as they were when the read
+  started, after letting `during_read` run -- as if a put landed while
+  the query was in flight.'''
+
+  def __init__(self):
+    self.rows = {}
+    self.during_read = None
+
+  def _before(self):
+    before = dict(self.rows)
+    if self.during_read is not None:
+      f, self.during_read = self.during_read, None
+      f()
+    return before
+
+  def latest(self, env, pid, rid, attrname):
+    return self._before().get((env, pid, rid, attrname))
+
+  def record(self, env, pid, rid):
+    return [(k[3], v) for k, v in self._before().items()
+            if k[:3] == (env, pid, rid)]
+
+  def write_rows(self, rows):
+    for row in rows:
+      self.rows[row[:4]] = row[4]
+
+def _fake_store(monkeypatch):
+  backend = RacingBackend()
+  monkeypatch.setattr(m, 'backend', backend)
+  monkeypatch.setattr(m, 'writer', None)
+  monkeypatch.setattr(m, 'cache', ttlcache.TTLCache())
+  return backend
+
+def test_read_overtaken_by_put_not_cached(monkeypatch):
+  backend = _fake_store(monkeypatch)
+  m.put('dev', '1', '7', 'attr', 'old')
+  m.cache.clear()
+  backend.during_read = lambda: m.put('dev', '1', '7', 'attr', 'new')
+  assert(m.get_latest_or_none('dev', '1', '7', 'attr') == 'old')
+  assert(m.get_latest_or_none('dev', '1', '7', 'attr') == 'new')
+
+def test_snapshot_overtaken_by_put_not_cached(monkeypatch):
+  backend = _fake_store(monkeypatch)
+  m.put('dev', '1', '7', 'attr', 'old')
+  backend.during_read = lambda: m.put('dev', '1', '7', 'attr', 'new')
+  assert(m.snapshot('dev', '1', '7') == {'attr': 'old'})
+  assert(m.snapshot('dev', '1', '7') == {'attr': 'new'})
+
+def test_reads_still_cached(monkeypatch):
+  backend = _fake_store(monkeypatch)
+  m.put('dev', '1', '7', 'attr', 'yes')
+  m.cache.clear()
+  assert(m.get_latest_or_none('dev', '1', '7', 'attr') == 'yes')
+  backend.rows.clear()
+  assert(m.get_latest_or_none('dev', '1', '7', 'attr') == 'yes')
@@ -0,0 +1,71 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import os
+import tempfile
+from threading import Lock, Thread
+
+import datastore_sqlite as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class RecordingConnection(object):
+  '''A sqlite3 connection that notes every statement passed to execute.'''
+
+  def __init__(self, conn, stmts, lock):
+    self._conn = conn
+    self._stmts = stmts
+    self._lock = lock
+
+  def execute(self, stmt, *args):
+    with self._lock:
+      self._stmts.append(' '.join(stmt.split()))
+    return self._conn.execute(stmt, *args)
+
+  def __getattr__(self, name):
+    return getattr(self._conn, name)
+
+def _recording_backend():
+  backend = m.SQLiteBackend(os.path.join(tempfile.mkdtemp(), 'ds.sqlite3'))
+  stmts, lock = [], Lock()
+  connect = backend._connect
+  def recording_connect():
+    stmts.append('connect')
+    return RecordingConnection(connect(), stmts, lock)
+  backend._connect = recording_connect
+  return backend, stmts
+
+def _count(stmts, prefix):
+  return len([s for s in stmts if s.startswith(prefix)])
+
+def test_schema_and_wal_set_up_once_not_per_thread():
+  backend, stmts = _recording_backend()
+  def work(i):
+    backend.write_rows([('dev', '1', str(i), 'attr', 'yes')])
+    assert(backend.latest('dev', '1', str(i), 'attr') == 'yes')
+  threads = [Thread(target=work, args=(i,)) for i in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert(_count(stmts, 'pragma journal_mode') == 1)
+  assert(_count(stmts, 'create table if not exists datastore (') == 1)
+  assert(_count(stmts, 'connect') == 8)
+  assert(len(backend.attr_values('dev', '1', 'attr')) == 8)
+
+def test_connections_after_setup_still_in_wal_mode():
+  backend, stmts = _recording_backend()
+  backend.check_conn()
+  rslt = []
+  def mode():
+    rslt.append(backend._conn().execute('pragma journal_mode').fetchone()[0])
+  t = Thread(target=mode)
+  t.start()
+  t.join()
+  assert(rslt == ['wal'])
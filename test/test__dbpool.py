@@ -0,0 +1,103 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import types
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+
+No MySQL needed: pymysql is replaced by a stand-in whose connections behave
+like InnoDB's REPEATABLE READ -- outside autocommit, a connection reads from
+a snapshot taken at its first statement until it commits or rolls back.
+'''
+
+#------------------------------------------------------------------------------
+
+committed = {}
+
+class FakeCursor(object):
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.row = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def execute(self, qy, vals):
+    view = self.conn.view()
+    if qy.startswith('select'):
+      val = view.get(vals[0])
+      self.row = None if val is None else {'attrval': val}
+    else: # 'set'
+      view[vals[0]] = vals[1]
+      if self.conn.snapshot is None:
+        committed[vals[0]] = vals[1]
+
+  def fetchone(self):
+    return self.row
+
+class FakeConnection(object):
+
+  def __init__(self, autocommit=False, **kw):
+    self.autocommit = autocommit
+    self.snapshot = None
+
+  def view(self):
+    if self.snapshot is None and not self.autocommit:
+      self.snapshot = dict(committed)
+    return self.snapshot if self.snapshot is not None else committed
+
+  def begin(self):
+    self.snapshot = dict(committed)
+
+  def commit(self):
+    committed.update(self.snapshot or {})
+    self.snapshot = None
+
+  def rollback(self):
+    self.snapshot = None
+
+  def cursor(self):
+    return FakeCursor(self)
+
+  def ping(self, reconnect=False):
+    pass
+
+  def close(self):
+    pass
+
+pymysql = types.ModuleType('pymysql')
+pymysql.cursors = types.ModuleType('pymysql.cursors')
+pymysql.cursors.DictCursor = object
+pymysql.connect = lambda **kw: FakeConnection(**kw)
+sys.modules['pymysql'] = pymysql
+sys.modules['pymysql.cursors'] = pymysql.cursors
+
+import datastore_mysql as m
+
+#------------------------------------------------------------------------------
+
+def test_write_on_one_connection_visible_to_read_on_another():
+  backend = m.MySQLBackend({}, {'size': 2})
+  pool = backend.pool
+  # Open both connections; the reader is handed back last, so it's the
+  # one query_val borrows next (the pool is LIFO).
+  with pool.connection() as reader:
+    with pool.connection() as writer:
+      pass
+  assert(backend.query_val('select', ('k',)) is None)
+  with pool.connection() as c1:
+    assert(c1 is reader)
+    with pool.connection() as c2:
+      assert(c2 is writer)
+      c2.begin()
+      with c2.cursor() as cur:
+        cur.execute('set', ('k', 'yes'))
+      c2.commit()
+  assert(backend.query_val('select', ('k',)) == 'yes')
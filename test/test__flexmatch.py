@@ -0,0 +1,64 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import random
+
+import flexmatch as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def _bulk_matches_scalar(left, right):
+  rslt = m.bulk_confidence(m.columns(left), m.columns(right))
+  for i, d1 in enumerate(left):
+    for j, d2 in enumerate(right):
+      assert(rslt.get((i, j), 0) == m.confidence(d1, d2))
+  assert(0 not in rslt.values())
+
+# The flexmatch_algo cases in test__wf_tpl_oncore_enroll, with their
+# expected confidence.
+ENROLLMENT_CASES = [
+  (('james', 'joyce', '1882-02-02'), ('james', 'joyce', '1882-02-02'), 3),
+  (('james', 'joyce', '1882-02-02'), ('james', 'joyce', '1882-02-03'), 0),
+  (('james a.', 'joyce', '1882-02-02'), ('james', 'joyce', '1882-02-02'), 2),
+  (('james a.', 'joyce', '1882-02-02'), ('james', 'jones', '1882-02-02'), 1),
+  (('james', 'joyce', '1882-02-02'), ('james', 'joycee', '1882-02-02'), 2)]
+
+def _demographics(first, last, birthdate):
+  return {'first-name': first, 'last-name': last, 'birthdate': birthdate}
+
+def test_bulk_gives_expected_confidence_on_enrollment_cases():
+  left = [_demographics(*d1) for d1, d2, expected in ENROLLMENT_CASES]
+  right = [_demographics(*d2) for d1, d2, expected in ENROLLMENT_CASES]
+  rslt = m.bulk_confidence(m.columns(left), m.columns(right))
+  for i, (d1, d2, expected) in enumerate(ENROLLMENT_CASES):
+    assert(rslt.get((i, i), 0) == expected)
+    assert(m.confidence(left[i], right[i]) == expected)
+
+def test_bulk_matches_scalar_on_enrollment_cases():
+  # All against all.
+  _bulk_matches_scalar(
+    [_demographics(*d1) for d1, d2, expected in ENROLLMENT_CASES],
+    [_demographics(*d2) for d1, d2, expected in ENROLLMENT_CASES])
+
+def _person(rnd):
+  # Few distinct values, so blocks, substrings and case differences are
+  # common.
+  return {'first-name': rnd.choice(['Ann', 'ann', 'Anne', 'An', 'Bo', 'bob',
+                                    '', 'ANNA MARIE']),
+          'last-name': rnd.choice(['Lee', 'lee', 'Leech', 'Li', 'Ng', '',
+                                   'van Lee']),
+          'birthdate': rnd.choice(['1970-01-01', '1970-01-02', '1980-12-31',
+                                   '1999-07-04'])}
+
+def test_bulk_matches_scalar_on_random_datasets():
+  rnd = random.Random(25)
+  for _ in range(50):
+    left = [_person(rnd) for _ in range(rnd.randint(0, 12))]
+    right = [_person(rnd) for _ in range(rnd.randint(0, 12))]
+    _bulk_matches_scalar(left, right)
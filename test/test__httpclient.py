@@ -0,0 +1,59 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import requests
+
+import httpclient as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class _Response(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+class FakeSession(object):
+  '''Raises (or returns) the scripted outcomes in order; counts calls.'''
+
+  def __init__(self, outcomes):
+    self.outcomes = list(outcomes)
+    self.calls = 0
+
+  def request(self, method, url, timeout=None, **kw):
+    self.calls += 1
+    outcome = self.outcomes.pop(0)
+    if isinstance(outcome, Exception):
+      raise outcome
+    return _Response(outcome)
+
+def _fake_session(monkeypatch, outcomes):
+  sess = FakeSession(outcomes)
+  monkeypatch.setattr(m, 'session_for', lambda url: sess)
+  monkeypatch.setattr(m.time, 'sleep', lambda seconds: None)
+  return sess
+
+def test_read_timeout_retried_for_idempotent_call(monkeypatch):
+  sess = _fake_session(monkeypatch, [requests.exceptions.ReadTimeout(), 200])
+  assert(m.post('http://x/api', idempotent=True).status_code == 200)
+  assert(sess.calls == 2)
+
+def test_read_timeout_not_retried_when_told_not_to(monkeypatch):
+  sess = _fake_session(monkeypatch, [requests.exceptions.ReadTimeout(), 200])
+  try:
+    m.post('http://x/api', idempotent=True, retry_read_timeouts=False)
+    assert(False)
+  except requests.exceptions.ReadTimeout:
+    pass
+  assert(sess.calls == 1)
+
+def test_connect_timeout_still_retried(monkeypatch):
+  sess = _fake_session(monkeypatch,
+                       [requests.exceptions.ConnectTimeout(), 200])
+  assert(m.post('http://x/api', idempotent=True,
+                retry_read_timeouts=False).status_code == 200)
+  assert(sess.calls == 2)
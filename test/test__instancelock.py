@@ -0,0 +1,30 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import os
+import subprocess
+import tempfile
+
+import instancelock as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def _acquire_in_other_process(path):
+  '''True if a separate process could take the lock at path.'''
+  code = ('import sys; sys.path.insert(0, "../app/"); import instancelock; '
+          'sys.exit(0 if instancelock.acquire({!r}) else 1)'.format(path))
+  return subprocess.call([sys.executable, '-c', code]) == 0
+
+def test_second_process_refused_until_released():
+  path = os.path.join(tempfile.mkdtemp(), 'transmitter.lock')
+  assert(m.acquire(path))
+  assert(m.acquire(path)) # Already ours.
+  assert(not _acquire_in_other_process(path))
+  m.release(path)
+  assert(_acquire_in_other_process(path))
@@ -0,0 +1,50 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import metrics as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def test_counter_renders_per_label_set():
+  c = m.Counter('t_requests_total', 'Requests.', ['handler', 'status'])
+  c.inc(('prod2525', '200'))
+  c.inc(('prod2525', '200'))
+  c.inc(('prod2525', '500'))
+  lines = c.render()
+  assert(lines[1] == '# TYPE t_requests_total counter')
+  assert('t_requests_total{handler="prod2525",status="200"} 2' in lines)
+  assert('t_requests_total{handler="prod2525",status="500"} 1' in lines)
+
+def test_wrong_number_of_labels_is_rejected():
+  c = m.Counter('t_bad_total', 'Bad.', ['handler'])
+  try:
+    c.inc(('a', 'b'))
+    assert(False)
+  except ValueError:
+    pass
+
+def test_histogram_buckets_are_cumulative():
+  h = m.Histogram('t_seconds', 'Latency.', buckets=(0.1, 1.0))
+  for v in (0.05, 0.5, 0.5, 5.0):
+    h.observe(v)
+  lines = h.render()
+  assert('t_seconds_bucket{le="0.1"} 1' in lines)
+  assert('t_seconds_bucket{le="1"} 3' in lines)
+  assert('t_seconds_bucket{le="+Inf"} 4' in lines)
+  assert('t_seconds_count 4' in lines)
+  assert('t_seconds_sum 6.05' in lines)
+
+def test_func_metric_and_failed_source():
+  m.gauge_func('t_depth', 'Depth.', lambda: 7)
+  m.gauge_func('t_broken', 'Broken.', lambda: 1 // 0)
+  m.gauge_func('t_off', 'Off.', lambda: None)
+  text = m.render()
+  assert('\nt_depth 7\n' in text)
+  assert('# t_broken unavailable:' in text)
+  assert('# TYPE t_off gauge\n' in text)
@@ -0,0 +1,21 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import oncore_backlog as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def test_pending_is_enrolled_minus_registered_minus_ticketed(monkeypatch):
+  stored = {m.enroll.ENROLLED_KEY: {'1': 'yes', '2': 'yes', '3': 'yes',
+                                    '4': 'yes', '5': 'no'}
+           ,m.enroll.ONCORE_REGISTERED_KEY: {'2': 'yes', '4': 'no'}
+           ,m.enroll.JIRA_ENROLLMENT_TICKET_KEY: {'3': 'yes'}}
+  monkeypatch.setattr(m.store, 'latest_for_attr',
+                      lambda env, pid, attrname: stored.get(attrname, {}))
+  assert(m.pending_record_ids('dev', 1) == ['1', '4'])
@@ -0,0 +1,73 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+import random
+from threading import Thread, Lock
+
+import recordlocks as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def test_entry_evicted_after_release():
+  locks = m.RecordLockTable()
+  with locks.hold('prod2525.1'):
+    assert(len(locks) == 1)
+  assert(len(locks) == 0)
+
+def test_entry_evicted_after_exception():
+  locks = m.RecordLockTable()
+  try:
+    with locks.hold('prod2525.1'):
+      raise ValueError()
+  except ValueError:
+    pass
+  assert(len(locks) == 0)
+  # The key can be taken again.
+  with locks.hold('prod2525.1'):
+    pass
+
+def test_stress_serializes_per_key_and_leaves_table_empty():
+  '''Many threads do non-atomic read-modify-write on per-key counters.
+  Any lost update means two threads held the same key at once.'''
+  locks = m.RecordLockTable(stripes=4) # few stripes -> lots of sharing
+  keys = ['prod2525.' + str(i) for i in range(20)]
+  counts = dict((k, 0) for k in keys)
+  active = dict((k, 0) for k in keys)
+  overlaps = []
+  n_threads, n_iters = 32, 200
+  def worker():
+    for _ in range(n_iters):
+      k = random.choice(keys)
+      with locks.hold(k):
+        active[k] += 1
+        if active[k] != 1:
+          overlaps.append(k)
+        v = counts[k]
+        time.sleep(0)
+        counts[k] = v + 1
+        active[k] -= 1
+  ts = [Thread(target=worker) for _ in range(n_threads)]
+  for t in ts: t.start()
+  for t in ts: t.join()
+  assert(overlaps == [])
+  assert(sum(counts.values()) == n_threads * n_iters)
+  assert(len(locks) == 0)
+
+def test_different_keys_do_not_block_each_other():
+  locks = m.RecordLockTable()
+  got_other = []
+  def take_other():
+    with locks.hold('prod2525.2'):
+      got_other.append(True)
+  with locks.hold('prod2525.1'):
+    t = Thread(target=take_other)
+    t.start()
+    t.join(5)
+    assert(got_other == [True])
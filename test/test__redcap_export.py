@@ -0,0 +1,42 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import redcap_export as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class _Response(object):
+  def raise_for_status(self):
+    pass
+  def json(self):
+    return []
+
+def _fake_post(monkeypatch):
+  '''Returns the list of keyword args each post was made with.'''
+  calls = []
+  def post(url, **kw):
+    calls.append(kw)
+    return _Response()
+  monkeypatch.setattr(m.httpclient, 'post', post)
+  return calls
+
+SPEC = {'api-url': 'http://x/api/', 'token': 'T'}
+
+def test_exports_get_the_longer_read_timeout(monkeypatch):
+  calls = _fake_post(monkeypatch)
+  m.export_records(SPEC, records=['1'])
+  assert(calls[0]['timeout'] == (m.httpclient.CONNECT_TIMEOUT,
+                                 m.EXPORT_READ_TIMEOUT))
+
+def test_read_timeouts_retried_only_for_single_record_exports(monkeypatch):
+  calls = _fake_post(monkeypatch)
+  m.export_records(SPEC, records=['1'])
+  m.export_records(SPEC, records=['1', '2'])
+  m.export_records(SPEC, fields=['record_id'])
+  assert([kw['retry_read_timeouts'] for kw in calls] == [True, False, False])
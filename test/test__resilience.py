@@ -0,0 +1,132 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+from threading import Event, Thread
+
+import resilience as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def _fail(g):
+  try:
+    with g.call():
+      raise IOError('down')
+  except IOError:
+    pass
+
+def test_circuit_opens_after_threshold_then_half_opens():
+  g = m.Guard('t-breaker', {'failure-threshold': 2, 'reset-seconds': 0.1})
+  _fail(g)
+  _fail(g)
+  try:
+    with g.call():
+      assert(False) # Shouldn't be called while open.
+  except m.DependencyUnavailable as e:
+    assert(e.reason == 'circuit-open')
+    assert(0 < e.retry_after <= 0.1)
+  time.sleep(0.15)
+  with g.call(): # Trial call goes through and closes the circuit.
+    pass
+  assert(g.breaker.state == m.CLOSED)
+
+def test_failed_trial_reopens():
+  g = m.Guard('t-trial', {'failure-threshold': 1, 'reset-seconds': 0.05})
+  _fail(g)
+  time.sleep(0.1)
+  _fail(g)
+  assert(g.breaker.state == m.OPEN)
+
+def test_bulkhead_rejects_when_full():
+  g = m.Guard('t-bulkhead', {'max-concurrent': 1, 'wait-seconds': 0.05})
+  inside, release = Event(), Event()
+  def hold():
+    with g.call():
+      inside.set()
+      release.wait(5)
+  t = Thread(target=hold)
+  t.start()
+  inside.wait(5)
+  try:
+    with g.call():
+      assert(False)
+  except m.DependencyUnavailable as e:
+    assert(e.reason == 'bulkhead-full')
+  release.set()
+  t.join()
+  with g.call(): # Slot is free again.
+    pass
+  assert(g.bulkhead.in_use == 0)
+
+def test_exceptions_not_counted_by_predicate_leave_circuit_closed():
+  g = m.Guard('t-counts', {'failure-threshold': 2})
+  for _ in range(3):
+    try:
+      with g.call(lambda ex: isinstance(ex, IOError)):
+        raise ValueError('bad participant ID')
+    except ValueError:
+      pass
+  assert(g.breaker.state == m.CLOSED)
+  _fail(g)
+  _fail(g)
+  assert(g.breaker.state == m.OPEN)
+
+def test_bulkhead_timeout_leaves_another_callers_trial_alone():
+  g = m.Guard('t-trial-race', {'max-concurrent': 1, 'wait-seconds': 0.3,
+                               'reset-seconds': 60})
+  inside, release = Event(), Event()
+  def hold():
+    with g.call():
+      inside.set()
+      release.wait(5)
+  holder = Thread(target=hold)
+  holder.start()
+  inside.wait(5)
+  rejected = []
+  def wait_for_slot():
+    # Passes the breaker while it's closed, then waits on the bulkhead.
+    try:
+      with g.call():
+        pass
+    except m.DependencyUnavailable as e:
+      rejected.append(e.reason)
+  waiter = Thread(target=wait_for_slot)
+  waiter.start()
+  time.sleep(0.1)
+  # Meanwhile the circuit opens, its reset time passes, and someone else
+  # takes the trial slot.
+  g.breaker.state = m.OPEN
+  g.breaker.opened_at = time.time() - 61
+  assert(g.breaker.allow() == (0, True))
+  waiter.join(5)
+  assert(rejected == ['bulkhead-full'])
+  assert(g.breaker.state == m.HALF_OPEN)
+  assert(g.breaker.allow()[1] is False) # The trial is still taken.
+  release.set()
+  holder.join(5)
+
+def test_rejections_share_the_outage_start_until_closed():
+  g = m.Guard('t-since', {'failure-threshold': 1, 'reset-seconds': 0.05})
+  def since():
+    try:
+      with g.call():
+        assert(False)
+    except m.DependencyUnavailable as e:
+      return e.since
+  _fail(g)
+  first = since()
+  assert(first is not None)
+  time.sleep(0.1)
+  _fail(g) # Failed trial: opens again, but it's the same outage.
+  assert(since() == first)
+  time.sleep(0.1)
+  with g.call():
+    pass
+  _fail(g)
+  assert(since() > first) # A new outage.
@@ -0,0 +1,72 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+import ttlcache as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def test_miss_then_hit():
+  c = m.TTLCache()
+  assert(c.get('a') is m.MISSING)
+  c.put('a', 'yes')
+  assert(c.get('a') == 'yes')
+  assert(c.stats() == {'hits': 1, 'misses': 1, 'entries': 1})
+
+def test_none_is_cacheable():
+  c = m.TTLCache()
+  c.put('a', None)
+  assert(c.get('a') is None)
+
+def test_lru_eviction():
+  c = m.TTLCache(max_entries=2)
+  c.put('a', 1)
+  c.put('b', 2)
+  c.get('a') # 'b' is now least recently used
+  c.put('c', 3)
+  assert(c.get('b') is m.MISSING)
+  assert(c.get('a') == 1)
+  assert(c.get('c') == 3)
+
+def test_expiry():
+  c = m.TTLCache(ttl_seconds=0.05)
+  c.put('a', 1)
+  time.sleep(0.1)
+  assert(c.get('a') is m.MISSING)
+
+def test_update_if_present():
+  c = m.TTLCache()
+  c.update_if_present('a', lambda v: v + 1)
+  assert(c.get('a') is m.MISSING)
+  c.put('a', 1)
+  c.update_if_present('a', lambda v: v + 1)
+  assert(c.get('a') == 2)
+
+def test_fill_skipped_if_written_since_version():
+  c = m.TTLCache()
+  since = c.version()
+  c.put('a', 'new')
+  assert(not c.put_if_unchanged('a', 'old', since))
+  assert(c.get('a') == 'new')
+  since = c.version()
+  c.invalidate('a')
+  assert(not c.put_if_unchanged('a', 'old', since))
+  since = c.version()
+  c.update_if_present('b', lambda v: v) # Absent, but still a write.
+  assert(not c.put_if_unchanged('b', 'old', since))
+  assert(c.put_if_unchanged('a', 'new', c.version()))
+  assert(c.get('a') == 'new')
+
+def test_fill_skipped_once_write_forgotten():
+  c = m.TTLCache(max_entries=1)
+  since = c.version()
+  c.put('a', 1)
+  c.put('b', 2) # Drops the record of the write to 'a'.
+  assert(not c.put_if_unchanged('a', 0, since))
+  assert(c.put_if_unchanged('a', 1, c.version()))
@@ -0,0 +1,98 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import json
+
+import requests
+
+import wf_aou_confirm_affiliation as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+class _Response(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+def _fake_env(monkeypatch, get_records):
+  '''Stand in for the datastore (nothing stored yet) and the AoU API;
+  returns the list of (attrname, value) put.'''
+  puts = []
+  monkeypatch.setattr(m.store, 'get_latest_or_none',
+                      lambda env, pid, rid, attrname, snap=None: None)
+  monkeypatch.setattr(m.store, 'put',
+                      lambda env, pid, rid, attrname, val, snap=None:
+                        puts.append((attrname, val)))
+  monkeypatch.setattr(m.aou_session, 'spec', lambda: {})
+  monkeypatch.setattr(m.aou_session, 'session', lambda: None)
+  monkeypatch.setattr(m.aou_session, 'invalidate_if_auth_error',
+                      lambda ex: None)
+  monkeypatch.setattr(m.aoulib, 'get_records', get_records)
+  return puts
+
+def _raises(ex):
+  def get_records(spec, sess, param):
+    raise ex
+  return get_records
+
+def _request():
+  return {'redcap-server-tag': 'dev', 'pid': '1'
+         ,'full-record': [{'record_id': '7', m.PMI_ID_FIELD: 'P123'}]}
+
+def _recheck_entries(puts):
+  return [json.loads(val) for attrname, val in puts
+          if attrname == m.AOU_WCM_PAIRED_RECHECK]
+
+def test_no_participant_row_is_unknown(monkeypatch):
+  puts = _fake_env(monkeypatch, lambda spec, sess, param: [])
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNKNOWN)
+  rslt = m.go(_request())
+  assert(rslt['done'] == 'yes')
+  entries = _recheck_entries(puts)
+  assert(len(entries) == 1)
+  assert(entries[0]['pmi-id'] == 'P123' and entries[0]['misses'] == 1)
+
+def test_several_participant_rows_is_unknown(monkeypatch):
+  _fake_env(monkeypatch,
+            lambda spec, sess, param: [{'organization': 'COLUMBIA_WEILL'},
+                                       {'organization': 'COLUMBIA_WEILL'}])
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNKNOWN)
+
+def test_organization_unset_is_unknown(monkeypatch):
+  puts = _fake_env(monkeypatch,
+                   lambda spec, sess, param: [{'organization': 'UNSET'}])
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNKNOWN)
+  m.go(_request())
+  assert(len(_recheck_entries(puts)) == 1)
+
+def test_client_error_for_participant_is_unknown(monkeypatch):
+  _fake_env(monkeypatch, _raises(requests.exceptions.HTTPError(
+                                   response=_Response(404))))
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNKNOWN)
+
+def test_server_error_is_unanswered(monkeypatch):
+  puts = _fake_env(monkeypatch, _raises(requests.exceptions.HTTPError(
+                                          response=_Response(503))))
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNANSWERED)
+  rslt = m.go(_request())
+  assert(rslt['done'] == 'yes')
+  assert(puts == []) # No recheck entry, so the next DET tries again.
+
+def test_timeout_is_unanswered(monkeypatch):
+  puts = _fake_env(monkeypatch, _raises(requests.exceptions.Timeout()))
+  assert(m._aou_api_is_wcm_paired('P123') == m.UNANSWERED)
+  m.go(_request())
+  assert(puts == [])
+
+def test_wcm_pairing_is_stored(monkeypatch):
+  puts = _fake_env(monkeypatch,
+                   lambda spec, sess, param:
+                     [{'organization': 'COLUMBIA_WEILL'}])
+  rslt = m.go(_request())
+  assert(rslt.get('done') != 'yes')
+  assert(puts == [(m.AOU_WCM_PAIRED, m.YES)])
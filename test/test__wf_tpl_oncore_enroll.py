@@ -1,6 +1,11 @@
 import sys
 sys.path.insert(0, '../app/')
 
+import time
+import socket
+import httplib
+import urllib2
+
 import wf_tpl_oncore_enroll as m
 
 #------------------------------------------------------------------------------
@@ -41,6 +46,14 @@ d1 = {'first-name': 'james a.',
       'last-name': 'joyce',
       'birthdate': '1882-02-02'}
 d2 = { 'first-name': 'james',
+      'last-name': 'jones',
+      'birthdate': '1882-02-02'}
+
+# both names close: one last name contains the other
+e1 = {'first-name': 'james',
+      'last-name': 'joyce',
+      'birthdate': '1882-02-02'}
+e2 = { 'first-name': 'james',
       'last-name': 'joycee',
       'birthdate': '1882-02-02'}
 
@@ -56,4 +69,205 @@ def test_flex_c():
 def test_flex_d():
   assert(m.flexmatch_algo(d1, d2) == 1) 
 
+def test_flex_e():
+  assert(m.flexmatch_algo(e1, e2) == 2) 
+
+
+#------------------------------------------------------------------------------
+# OnCore demographics cache
+
+def _fake_oncore(monkeypatch, found=True):
+  '''Stand in for OnCore; returns the list of MRNs looked up.'''
+  lookups = []
+  def get_subject_data(oncore_spec, mrn):
+    lookups.append(mrn)
+    return {'mrn': mrn}
+  monkeypatch.setattr(m.oncore, 'get_subject_data', get_subject_data)
+  monkeypatch.setattr(m.oncore, 'subject_record_exists', lambda d: found)
+  monkeypatch.setattr(m.oncore, 'extract_subject_num', lambda d: 'S1')
+  monkeypatch.setattr(m.oncore, 'prep_subject_data',
+                      lambda d: dict(a1, mrn=d['mrn']))
+  return lookups
+
+def _enable_cache(monkeypatch, ttl_seconds=60, not_found_ttl_seconds=60):
+  monkeypatch.setattr(m, 'demographics_cache',
+                      m.ttlcache.TTLCache(ttl_seconds=ttl_seconds))
+  monkeypatch.setattr(m, 'not_found_cache',
+                      m.ttlcache.TTLCache(ttl_seconds=not_found_ttl_seconds))
+
+def test_cache_reuses_lookup_for_same_mrn_only(monkeypatch):
+  lookups = _fake_oncore(monkeypatch)
+  _enable_cache(monkeypatch)
+  rslt = m.lookup_demographics('dev', {}, '123')
+  assert(rslt == (True, 'S1', dict(a1, mrn='123')))
+  assert(m.lookup_demographics('dev', {}, '123') == rslt)
+  m.lookup_demographics('dev', {}, '456') # Different MRN: looked up.
+  m.lookup_demographics('prod', {}, '123') # Different env: looked up.
+  assert(lookups == ['123', '456', '123'])
+
+def test_cache_entries_expire(monkeypatch):
+  lookups = _fake_oncore(monkeypatch)
+  _enable_cache(monkeypatch, ttl_seconds=0.05)
+  m.lookup_demographics('dev', {}, '123')
+  time.sleep(0.1)
+  m.lookup_demographics('dev', {}, '123')
+  assert(lookups == ['123', '123'])
+
+def test_not_found_kept_only_for_its_own_ttl(monkeypatch):
+  lookups = _fake_oncore(monkeypatch, found=False)
+  _enable_cache(monkeypatch, ttl_seconds=60, not_found_ttl_seconds=0.05)
+  assert(m.lookup_demographics('dev', {}, '123') == (False, None, None))
+  m.lookup_demographics('dev', {}, '123')
+  assert(lookups == ['123'])
+  time.sleep(0.1)
+  m.lookup_demographics('dev', {}, '123')
+  assert(lookups == ['123', '123'])
+
+def test_no_caching_when_disabled(monkeypatch):
+  lookups = _fake_oncore(monkeypatch)
+  monkeypatch.setattr(m, 'demographics_cache', None)
+  m.lookup_demographics('dev', {}, '123')
+  m.lookup_demographics('dev', {}, '123')
+  assert(lookups == ['123', '123'])
+
+def _fake_enrollment_env(monkeypatch, flags=None):
+  '''Stand in for the datastore flags, the study config and OnCore
+  registration; returns (flags, registrations). Keys written with
+  sync=True are listed under flags['synced'].'''
+  flags = {} if flags is None else flags
+  registrations = []
+  def put(env, pid, rid, key, val, snap=None, sync=False):
+    flags[key] = val
+    if sync:
+      flags.setdefault('synced', []).append(key)
+  def set_flag(env, pid, rid, key, snap=None):
+    flags[key] = 'yes'
+  def unset_flag(env, pid, rid, key, snap=None):
+    flags.pop(key, None)
+  monkeypatch.setattr(m.store, 'flag_is_set',
+                      lambda env, pid, rid, key, snap=None:
+                        flags.get(key) == 'yes')
+  monkeypatch.setattr(m.store, 'put', put)
+  monkeypatch.setattr(m.store, 'set_flag_if_unset', set_flag)
+  monkeypatch.setattr(m.store, 'unset_flag_if_set', unset_flag)
+  monkeypatch.setattr(m.common, 'get_study_config',
+                      lambda tag: {'handler-tag-to-env-tag': {'dev1': 'dev'}
+                                  ,'dev': {'oncore-spec': {}}
+                                  ,'study-details':
+                                     {'protocol-number': 'P-1'}})
+  monkeypatch.setattr(m.oncore, 'register_subject_to_protocol',
+                      lambda spec, protocol, demographics, subject_num:
+                        registrations.append(subject_num))
+  return flags, registrations
+
+def _enrolled_request(first='james', last='joyce', dob='1882-02-02'):
+  return {'record-id': '7'
+         ,m.ENROLLED_KEY: m.YES
+         ,'full-record': [{'mrn': '123', 'name_first': first,
+                           'name_last': last, 'dob': dob}]}
+
+def test_cache_entry_dropped_after_registration(monkeypatch):
+  lookups = _fake_oncore(monkeypatch)
+  _enable_cache(monkeypatch)
+  flags, registrations = _fake_enrollment_env(monkeypatch)
+  m.lookup_demographics('dev', {}, '123')
+  m.compose('dev', 1, 'aou')(_enrolled_request())
+  assert(registrations == ['S1'])
+  assert(lookups == ['123']) # _go used the cached lookup...
+  m.lookup_demographics('dev', {}, '123')
+  assert(lookups == ['123', '123']) # ...and then dropped it.
+
+#------------------------------------------------------------------------------
+# sufficient_confidence and _go
+
+def _confidence_request(first, last, dob='1882-02-02'):
+  return {'full-record': [{'name_first': first, 'name_last': last,
+                           'dob': dob}]}
+
+def test_sufficient_confidence_at_3():
+  assert(m.sufficient_confidence(_confidence_request('James', 'Joyce'), a2))
+
+def test_sufficient_confidence_at_2():
+  assert(m.sufficient_confidence(_confidence_request('james a.', 'joyce'),
+                                 a2))
+
+def test_insufficient_confidence_at_1():
+  assert(not m.sufficient_confidence(_confidence_request('nora', 'joyce'),
+                                     a2))
+
+def test_insufficient_confidence_at_0():
+  assert(not m.sufficient_confidence(
+               _confidence_request('james', 'joyce', '1882-02-03'), a2))
+
+def test_go_registers_and_sets_flag_and_outcome(monkeypatch):
+  _fake_oncore(monkeypatch)
+  flags, registrations = _fake_enrollment_env(
+                           monkeypatch, {m.DEMOGRAPHICS_MISMATCH: 'yes'})
+  request = m.compose('dev', 1, 'aou')(_enrolled_request())
+  assert(registrations == ['S1'])
+  assert(request[m.OUTCOME_KEY] == m.REGISTERED)
+  # Recon flag cleared; registered flag written through.
+  assert(flags == {m.ONCORE_REGISTERED_KEY: 'yes'
+                  ,'synced': [m.ONCORE_REGISTERED_KEY]})
+  # Registered now, so the next DET does nothing.
+  request = m.compose('dev', 1, 'aou')(_enrolled_request())
+  assert(registrations == ['S1'])
+  assert(request[m.OUTCOME_KEY] == m.NO_ACTION)
+
+def test_go_flags_mismatch(monkeypatch):
+  _fake_oncore(monkeypatch)
+  flags, registrations = _fake_enrollment_env(monkeypatch)
+  request = m.compose('dev', 1, 'aou')(_enrolled_request(first='nora'))
+  assert(registrations == [])
+  assert(request[m.OUTCOME_KEY] == m.MISMATCH)
+  assert(flags == {m.DEMOGRAPHICS_MISMATCH: 'yes'})
+
+def test_go_flags_not_found(monkeypatch):
+  _fake_oncore(monkeypatch, found=False)
+  flags, registrations = _fake_enrollment_env(monkeypatch)
+  request = m.compose('dev', 1, 'aou')(_enrolled_request())
+  assert(registrations == [])
+  assert(request[m.OUTCOME_KEY] == m.NOT_FOUND)
+  assert(flags == {m.ONCORE_DEMOGRAPHICS_NOT_FOUND: 'yes'})
+
+#------------------------------------------------------------------------------
+# What counts as an OnCore outage
+
+class WebFault(Exception):
+  '''Named like suds' SOAP fault: OnCore's answer.'''
+
+class _Response(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+def _http_error(status_code):
+  ex = Exception('HTTP {}'.format(status_code))
+  ex.response = _Response(status_code)
+  return ex
+
+def test_oncore_transport_errors_are_outages():
+  for ex in [urllib2.URLError('connection refused'),
+             socket.timeout('timed out'),
+             socket.error(111, 'connection refused'),
+             httplib.BadStatusLine(''),
+             _http_error(503)]:
+    assert(m.oncore_is_outage(ex))
+
+def test_oncore_answers_are_not_outages():
+  assert(not m.oncore_is_outage(WebFault('subject already on protocol')))
+  assert(not m.oncore_is_outage(_http_error(404)))
 
+def test_oncore_transport_errors_open_the_circuit():
+  guard = m.resilience.Guard('t-oncore', {'failure-threshold': 2})
+  def call(ex):
+    try:
+      with guard.call(m.oncore_is_outage):
+        raise ex
+    except type(ex):
+      pass
+  call(WebFault('rejected'))
+  call(WebFault('rejected'))
+  assert(guard.breaker.state == m.resilience.CLOSED)
+  call(urllib2.URLError('connection refused'))
+  call(socket.timeout('timed out'))
+  assert(guard.breaker.state == m.resilience.OPEN)
@@ -0,0 +1,74 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import time
+
+import common
+import workflow_dag as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+def _slow_write(key, secs, log):
+  def f(request):
+    log.append(('start', key))
+    time.sleep(secs)
+    request[key] = 'yes'
+    log.append(('end', key))
+    return request
+  f.__name__ = 'write_' + key
+  return f
+
+def test_independent_stages_overlap_and_dependents_wait():
+  log = []
+  seen = {}
+  def use_both(request):
+    seen['a'], seen['b'] = request.get('a'), request.get('b')
+    return request
+  dag = m.Dag([m.stage(_slow_write('a', 0.2, log), writes=['a'])
+              ,m.stage(_slow_write('b', 0.2, log), writes=['b'])
+              ,m.stage(use_both, reads=['a', 'b'])])
+  start = time.time()
+  out = dag.run({})
+  assert(time.time() - start < 0.35) # a and b ran together
+  assert(log[:2] == [('start', 'a'), ('start', 'b')]
+         or log[:2] == [('start', 'b'), ('start', 'a')])
+  assert(seen == {'a': 'yes', 'b': 'yes'})
+  assert(len(out['timings']) == 3)
+
+def test_short_circuit_skips_later_stages():
+  ran = []
+  def stop(request):
+    return common.finalize(request, 202)
+  def later(request):
+    ran.append('later')
+    return request
+  def pure_read(request):
+    ran.append('pure')
+    request['snap'] = {}
+    return request
+  dag = m.Dag([m.stage(stop, may_finish=True)
+              ,m.stage(later, writes=['x'])
+              ,m.stage(pure_read, writes=['snap'], pure=True)])
+  out = dag.run({})
+  assert(out['response'] == {'status': 202})
+  assert('later' not in ran)
+
+def test_exception_is_reraised():
+  def boom(request):
+    raise KeyError('boom')
+  dag = m.Dag([m.stage(boom, writes=['x'])])
+  try:
+    dag.run({})
+    assert(False)
+  except KeyError:
+    pass
+
+def test_plain_list_runs_sequentially():
+  out = m.run({}, [lambda r: dict(r, a=1)])
+  assert(out['a'] == 1)
@@ -0,0 +1,84 @@
+import sys
+sys.path.insert(0, '../app/')
+
+import writebehind as m
+
+#------------------------------------------------------------------------------
+'''
+Usage: from the test folder, run:
+python -m pytest
+'''
+
+#------------------------------------------------------------------------------
+
+POISON = ('dev', '1', '7', 'attr', 'too long')
+
+class FakeTable(object):
+  '''Writes batches atomically, like the datastore backends; a batch with
+  the poison row in it fails as a whole. While down, every write fails.'''
+
+  def __init__(self):
+    self.rows = []
+    self.down = False
+
+  def write_rows(self, rows):
+    if self.down:
+      raise IOError('database is down')
+    if POISON in rows:
+      raise ValueError('data too long')
+    self.rows.extend(rows)
+
+def _writer(table, **kw):
+  # Long max_seconds, so only the test's own flush() calls write.
+  return m.BatchedWriter(table.write_rows, max_rows=1000, max_seconds=60,
+                         **kw)
+
+def _row(i):
+  return ('dev', '1', str(i), 'attr', 'yes')
+
+def test_poison_row_dropped_and_the_rest_written_in_order():
+  table = FakeTable()
+  writer = _writer(table)
+  for row in [_row(1), _row(2), POISON, _row(3)]:
+    writer.add(row)
+  assert(writer.flush() == 4)
+  assert(table.rows == [_row(1), _row(2), _row(3)])
+  assert(writer.pending_rows() == [])
+  # And later rows aren't held back.
+  writer.add(_row(4))
+  writer.flush()
+  assert(table.rows[-1] == _row(4))
+
+def test_rows_kept_while_database_down():
+  table = FakeTable()
+  writer = _writer(table)
+  writer.add(_row(1))
+  writer.add(_row(2))
+  table.down = True
+  try:
+    writer.flush()
+    assert(False)
+  except IOError:
+    pass
+  assert(writer.pending_rows() == [_row(1), _row(2)])
+  table.down = False
+  writer.flush()
+  assert(table.rows == [_row(1), _row(2)])
+
+def test_add_flushes_once_max_pending_rows_wait():
+  table = FakeTable()
+  writer = _writer(table, max_pending=2)
+  writer.add(_row(1))
+  writer.add(_row(2))
+  assert(table.rows == [])
+  writer.add(_row(3))
+  assert(table.rows == [_row(1), _row(2)])
+  assert(writer.pending_rows() == [_row(3)])
+  table.down = True
+  try:
+    writer.add(_row(4))
+    writer.add(_row(5))
+    assert(False)
+  except IOError:
+    pass
+  assert(writer.pending_rows() == [_row(3), _row(4)])